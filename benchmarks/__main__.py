@@ -0,0 +1,379 @@
+"""Time remarks' main stages on synthetic inputs and write the results as
+JSON, so that runs (e.g. before and after a change) can be compared:
+
+    python -m benchmarks --output before.json
+    python -m benchmarks --output after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import logging
+import pathlib
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fitz  # PyMuPDF
+import shapely
+
+import remarks
+from remarks.conversion.parsing import parse_rm_file, rescale_parsed_data
+from remarks.conversion.drawing import draw_annotations_on_pdf
+from remarks.conversion.text import (
+    extract_groups_from_pdf_ann_hl,
+    prepare_md_from_hl_groups,
+)
+
+from .synthetic import (
+    make_highlights,
+    make_library,
+    make_source_pdf,
+    make_strokes,
+    write_rm_file,
+    PAGE_WIDTH,
+    PAGE_HEIGHT,
+)
+
+
+def run_benchmark(name, params, setup, func, repeat):
+    """Call `func(*setup())` `repeat` times, timing `func` only."""
+
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    result = {
+        "name": name,
+        "params": params,
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+    }
+
+    params_str = ", ".join(f"{k}={v}" for k, v in params.items())
+    logging.warning(f"{name} ({params_str}): {result['median'] * 1000:.1f} ms")
+
+    return result
+
+
+def get_scale():
+    return remarks.rescale_given_device_aspect_ratio((PAGE_WIDTH, PAGE_HEIGHT))[1]
+
+
+def bench_parse_rm_file(work_dir, repeat, quick):
+    results = []
+    sizes = [(100, 50)] if quick else [(100, 50), (1000, 50), (100, 1000)]
+
+    for version in [3, 5]:
+        for num_strokes, num_points in sizes:
+            rm_file = pathlib.Path(f"{work_dir}/v{version}-{num_strokes}-{num_points}.rm")
+            strokes = make_strokes(random.Random(0), num_strokes, num_points)
+            write_rm_file(rm_file, strokes, version)
+
+            results.append(
+                run_benchmark(
+                    "parse_rm_file",
+                    {"version": version, "strokes": num_strokes, "points": num_points},
+                    lambda: (rm_file,),
+                    parse_rm_file,
+                    repeat,
+                )
+            )
+
+    return results
+
+
+def bench_draw_annotations_on_pdf(work_dir, repeat, quick):
+    results = []
+    sizes = [(100, 50)] if quick else [(100, 50), (1000, 50)]
+
+    for num_strokes, num_points in sizes:
+        rm_file = pathlib.Path(f"{work_dir}/draw-{num_strokes}-{num_points}.rm")
+        write_rm_file(rm_file, make_strokes(random.Random(0), num_strokes, num_points))
+
+        def setup():
+            parsed_data, _ = parse_rm_file(rm_file)
+            page = fitz.open().new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+            return rescale_parsed_data(parsed_data, get_scale()), page
+
+        results.append(
+            run_benchmark(
+                "draw_annotations_on_pdf",
+                {"strokes": num_strokes, "points": num_points},
+                setup,
+                draw_annotations_on_pdf,
+                repeat,
+            )
+        )
+
+    return results
+
+
+def make_highlighted_page(work_dir, num_highlights):
+    # A page of text with `num_highlights` lines highlighted (old style),
+    # exactly as `process_document` would have annotated it
+    pdf_path = pathlib.Path(f"{work_dir}/text-{num_highlights}.pdf")
+    rm_file = pathlib.Path(f"{work_dir}/hl-{num_highlights}.rm")
+
+    layout = make_source_pdf(pdf_path, 1)
+    strokes, _ = make_highlights(random.Random(0), layout[0], num_highlights)
+    write_rm_file(rm_file, strokes)
+
+    parsed_data, _ = parse_rm_file(rm_file)
+    doc = fitz.open(pdf_path)
+    draw_annotations_on_pdf(rescale_parsed_data(parsed_data, get_scale()), doc[0])
+    return doc[0]
+
+
+def bench_text_extraction(work_dir, repeat, quick):
+    results = []
+
+    for num_highlights in [5] if quick else [5, 40]:
+        page = make_highlighted_page(work_dir, num_highlights)
+        ann_hl_groups = extract_groups_from_pdf_ann_hl(page)
+
+        for malformed in [False, True]:
+            results.append(
+                run_benchmark(
+                    "extract_groups_from_pdf_ann_hl",
+                    {"highlights": num_highlights, "malformed": malformed},
+                    lambda: (page, malformed),
+                    extract_groups_from_pdf_ann_hl,
+                    repeat,
+                )
+            )
+
+        for presentation in ["whole_block", "bullet_points"]:
+            results.append(
+                run_benchmark(
+                    "prepare_md_from_hl_groups",
+                    {"highlights": num_highlights, "presentation": presentation},
+                    lambda: (page, ann_hl_groups, [], presentation),
+                    prepare_md_from_hl_groups,
+                    repeat,
+                )
+            )
+
+    return results
+
+
+def bench_run_remarks(work_dir, repeat, quick, sizes):
+    results = []
+
+    for num_documents in sizes:
+        input_dir = pathlib.Path(f"{work_dir}/library-{num_documents}")
+        make_library(input_dir, num_documents=num_documents)
+
+        def setup():
+            return input_dir, tempfile.mkdtemp(dir=work_dir)
+
+        def run(input_dir, output_dir):
+            remarks.run_remarks(
+                input_dir,
+                output_dir,
+                ann_type=["scribbles", "highlights"],
+                combined_pdf=True,
+                combined_md=True,
+                modified_pdf=True,
+            )
+
+        results.append(
+            run_benchmark(
+                "run_remarks",
+                {"documents": num_documents},
+                setup,
+                run,
+                repeat,
+            )
+        )
+
+    return results
+
+
+def bench_export(work_dir, repeat, quick, sizes):
+    # Same libraries as `bench_run_remarks`, exported without rendering
+    from remarks.export import run_export
+
+    results = []
+
+    for num_documents in sizes:
+        input_dir = pathlib.Path(f"{work_dir}/library-{num_documents}")
+        make_library(input_dir, num_documents=num_documents)
+
+        results.append(
+            run_benchmark(
+                "run_export",
+                {"documents": num_documents},
+                lambda: (input_dir, tempfile.mkdtemp(dir=work_dir)),
+                run_export,
+                repeat,
+            )
+        )
+
+    return results
+
+
+def bench_startup(work_dir, repeat, quick):
+    # Whole CLI invocations, i.e. what a cron job calling remarks once per
+    # document pays before any actual work gets done
+    input_dir = pathlib.Path(f"{work_dir}/library-startup")
+    make_library(input_dir, num_documents=1)
+
+    commands = {
+        "version": ["--version"],
+        "no_match": [str(input_dir), f"{work_dir}/out-startup", "--file_name", "no such document"],
+        "import_fitz": None,
+    }
+    if quick:
+        commands.pop("import_fitz")
+
+    results = []
+
+    for name, args in commands.items():
+        if args is None:
+            # For reference: what importing PyMuPDF alone takes
+            cmd = [sys.executable, "-c", "import fitz"]
+        else:
+            cmd = [sys.executable, "-m", "remarks"] + args
+
+        results.append(
+            run_benchmark(
+                "startup",
+                {"command": name},
+                lambda: (cmd,),
+                lambda cmd: subprocess.run(cmd, capture_output=True, check=True),
+                repeat,
+            )
+        )
+
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, prev_results):
+    def key(result):
+        return result["name"], json.dumps(result["params"], sort_keys=True)
+
+    prev = dict((key(r), r) for r in prev_results["benchmarks"])
+
+    print(f"\n{'benchmark':<72} {'before':>10} {'after':>10} {'change':>8}")
+    for result in results["benchmarks"]:
+        if key(result) not in prev:
+            continue
+        before, after = prev[key(result)]["median"], result["median"]
+        params_str = ", ".join(f"{k}={v}" for k, v in result["params"].items())
+        print(
+            f"{result['name'] + ' (' + params_str + ')':<72} {before * 1000:>8.1f}ms {after * 1000:>8.1f}ms {(after / before - 1) * 100:>+7.1f}%"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser("python -m benchmarks")
+    parser.add_argument(
+        "--output",
+        help="Write results to this JSON file. Defaults to benchmarks.json",
+        default="benchmarks.json",
+        metavar="OUTPUT_FILE",
+    )
+    parser.add_argument(
+        "--compare",
+        help="Compare results against a previous run's JSON file",
+        metavar="PREVIOUS_FILE",
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Run each benchmark REPEAT times and keep all timings. Defaults to 5",
+        default=5,
+        type=int,
+        metavar="REPEAT",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        help="Library sizes (number of documents) to time run_remarks with. Defaults to 1 5 20",
+        default=[1, 5, 20],
+        type=int,
+        metavar="NUM_DOCUMENTS",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        help="Run only these benchmarks: parse, draw, text, run_remarks, export, startup",
+        default=["parse", "draw", "text", "run_remarks", "export", "startup"],
+        metavar="BENCHMARK",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Run the smallest variant of each benchmark only, e.g. to check they all still work",
+    )
+    args = parser.parse_args()
+
+    # Benchmarks report through warnings, remarks' own info messages would
+    # drown them
+    logging.basicConfig(format="%(message)s", level="WARNING")
+
+    benchmarks = []
+
+    with tempfile.TemporaryDirectory(prefix="remarks-benchmarks-") as work_dir:
+        if "parse" in args.only:
+            benchmarks += bench_parse_rm_file(work_dir, args.repeat, args.quick)
+        if "draw" in args.only:
+            benchmarks += bench_draw_annotations_on_pdf(work_dir, args.repeat, args.quick)
+        if "text" in args.only:
+            benchmarks += bench_text_extraction(work_dir, args.repeat, args.quick)
+        if "run_remarks" in args.only:
+            sizes = args.sizes[:1] if args.quick else args.sizes
+            benchmarks += bench_run_remarks(work_dir, args.repeat, args.quick, sizes)
+        if "export" in args.only:
+            sizes = args.sizes[:1] if args.quick else args.sizes
+            benchmarks += bench_export(work_dir, args.repeat, args.quick, sizes)
+        if "startup" in args.only:
+            benchmarks += bench_startup(work_dir, args.repeat, args.quick)
+
+    results = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pymupdf": fitz.VersionBind,
+            "shapely": shapely.__version__,
+            "repeat": args.repeat,
+        },
+        "benchmarks": benchmarks,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f'\nWrote {len(benchmarks)} results to "{args.output}"')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
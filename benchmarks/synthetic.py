@@ -0,0 +1,261 @@
+"""Generate synthetic xochitl libraries: .metadata, .content, source PDFs,
+v3/v5 .rm files and .highlights/*.json files, all made up from a seed so
+that every run gets exactly the same inputs."""
+
+import json
+import pathlib
+import random
+import struct
+import uuid
+
+import fitz  # PyMuPDF
+
+from remarks.utils import (
+    rescale_given_device_aspect_ratio,
+    RM_WIDTH,
+    RM_HEIGHT,
+)
+
+RM_HEADERS = {
+    3: b"reMarkable .lines file, version=3          ",
+    5: b"reMarkable .lines file, version=5          ",
+}
+
+# Ballpoint, Fineliner, Marker and SharpPencil (v5 codes), see RM_TOOLS
+SCRIBBLE_PENS = [15, 17, 16, 13]
+HIGHLIGHTER_PEN = 18
+
+# PDF page layout of the synthetic source documents (A4)
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 72
+FONT_SIZE = 11
+LINE_HEIGHT = 16
+
+WORDS = (
+    "the machine tape symbol state computable number sequence figure "
+    "configuration table circle free process digit real function "
+    "definition theorem proof formula universal description standard "
+    "complete square scanned printed behaviour operation"
+).split()
+
+
+def make_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def make_strokes(rng, num_strokes, points_per_stroke, pens=SCRIBBLE_PENS):
+    """Random walks across the whole device area, as (pen, color, width,
+    points) tuples."""
+
+    strokes = []
+
+    for _ in range(num_strokes):
+        x, y = rng.uniform(0, RM_WIDTH), rng.uniform(0, RM_HEIGHT)
+        points = []
+        for _ in range(points_per_stroke):
+            x = min(max(x + rng.uniform(-8, 8), 0), RM_WIDTH)
+            y = min(max(y + rng.uniform(-8, 8), 0), RM_HEIGHT)
+            points.append((x, y))
+        strokes.append((rng.choice(pens), rng.choice([0, 1, 6, 7]), 2.0, points))
+
+    return strokes
+
+
+def write_rm_file(path, strokes, version=5):
+    data = [RM_HEADERS[version], struct.pack("<I", 1), struct.pack("<I", len(strokes))]
+
+    for pen, color, width, points in strokes:
+        if version == 3:
+            data.append(struct.pack("<IIIfI", pen, color, 0, width, len(points)))
+        else:
+            data.append(struct.pack("<IIIffI", pen, color, 0, width, 0.0, len(points)))
+
+        for x, y in points:
+            data.append(struct.pack("<ffffff", x, y, 0.5, 0.0, 0.0, 0.0))
+
+    pathlib.Path(path).write_bytes(b"".join(data))
+
+
+def make_line(rng, max_width):
+    words = []
+    while True:
+        word = rng.choice(WORDS)
+        if fitz.get_text_length(" ".join(words + [word]), fontsize=FONT_SIZE) > max_width:
+            return " ".join(words)
+        words.append(word)
+
+
+def make_source_pdf(path, num_pages, seed=0):
+    """Write a PDF of `num_pages` pages filled with lines of text. Return
+    the layout of each page as a list of (text, rect) per line."""
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    layout = []
+
+    for _ in range(num_pages):
+        page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        lines = []
+
+        y = MARGIN
+        while y < PAGE_HEIGHT - MARGIN:
+            text = make_line(rng, PAGE_WIDTH - 2 * MARGIN)
+            page.insert_text((MARGIN, y), text, fontsize=FONT_SIZE)
+            width = fitz.get_text_length(text, fontsize=FONT_SIZE)
+            lines.append((text, fitz.Rect(MARGIN, y - FONT_SIZE, MARGIN + width, y + 3)))
+            y += LINE_HEIGHT
+
+        layout.append(lines)
+
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+    return layout
+
+
+def make_highlights(rng, lines, num_highlights):
+    """Highlight `num_highlights` lines of a page both ways: as (old style)
+    highlighter strokes and as (smart) .highlights JSON."""
+
+    _, scale = rescale_given_device_aspect_ratio((PAGE_WIDTH, PAGE_HEIGHT))
+
+    strokes = []
+    smart_hls = []
+    start = 0
+
+    for text, rect in sorted(rng.sample(lines, min(num_highlights, len(lines))), key=lambda l: l[1].y0):
+        # A bit of a zigzag, just like a hand-drawn stroke (and so that its
+        # bounding box is not a flat line)
+        y = (rect.y0 + rect.y1) / 2 / scale
+        points = [
+            (rect.x0 / scale + i * (rect.width / scale) / 9, y + (i % 2) * 8 - 4)
+            for i in range(10)
+        ]
+        strokes.append((HIGHLIGHTER_PEN, 3, 2.0, points))
+
+        smart_hls.append(
+            {
+                "color": 3,
+                "length": len(text),
+                "rects": [
+                    {
+                        "height": rect.height / scale,
+                        "width": rect.width / scale,
+                        "x": rect.x0 / scale,
+                        "y": rect.y0 / scale,
+                    }
+                ],
+                "start": start,
+                "text": text,
+            }
+        )
+        start += len(text) + 100
+
+    return strokes, {"highlights": [smart_hls]}
+
+
+def write_meta_files(xochitl_dir, doc_uuid, name, doc_type, pages, parent=""):
+    metadata = {
+        "deleted": False,
+        "lastModified": "1606670817393",
+        "parent": parent,
+        "pinned": False,
+        "type": "DocumentType" if doc_type is not None else "CollectionType",
+        "version": 1,
+        "visibleName": name,
+    }
+    with open(xochitl_dir / f"{doc_uuid}.metadata", "w") as f:
+        json.dump(metadata, f, indent=4)
+
+    if doc_type is None:
+        return
+
+    content = {
+        "fileType": doc_type,
+        "pageCount": len(pages),
+        "pages": pages,
+    }
+    with open(xochitl_dir / f"{doc_uuid}.content", "w") as f:
+        json.dump(content, f, indent=4)
+
+
+def make_document(
+    xochitl_dir,
+    doc_type="pdf",
+    num_pages=20,
+    annotated_pages=5,
+    strokes_per_page=50,
+    points_per_stroke=30,
+    highlights_per_page=2,
+    rm_version=5,
+    parent="",
+    seed=0,
+):
+    """Write a single document into `xochitl_dir` and return its uuid.
+    Annotated pages get `strokes_per_page` scribbles, plus (for PDFs) some
+    highlighted lines of text."""
+
+    xochitl_dir = pathlib.Path(xochitl_dir)
+    rng = random.Random(seed)
+
+    doc_uuid = make_uuid(rng)
+    pages = [make_uuid(rng) for _ in range(num_pages)]
+
+    layout = None
+    if doc_type == "pdf":
+        layout = make_source_pdf(xochitl_dir / f"{doc_uuid}.pdf", num_pages, seed)
+
+    write_meta_files(
+        xochitl_dir, doc_uuid, f"Synthetic {doc_type} {doc_uuid[:8]}", doc_type, pages, parent
+    )
+
+    rm_dir = xochitl_dir / doc_uuid
+    hl_dir = xochitl_dir / f"{doc_uuid}.highlights"
+
+    for page_idx in sorted(rng.sample(range(num_pages), min(annotated_pages, num_pages))):
+        page_uuid = pages[page_idx]
+        strokes = make_strokes(rng, strokes_per_page, points_per_stroke)
+
+        if layout is not None and highlights_per_page > 0:
+            hl_strokes, smart_hl_data = make_highlights(rng, layout[page_idx], highlights_per_page)
+            strokes += hl_strokes
+
+            hl_dir.mkdir(exist_ok=True)
+            with open(hl_dir / f"{page_uuid}.json", "w") as f:
+                json.dump(smart_hl_data, f)
+
+        rm_dir.mkdir(exist_ok=True)
+        write_rm_file(rm_dir / f"{page_uuid}.rm", strokes, rm_version)
+
+    return doc_uuid
+
+
+def make_library(xochitl_dir, num_documents=10, num_folders=3, notebooks_every=4, seed=0, **kwargs):
+    """Write `num_documents` documents spread over `num_folders` folders,
+    every `notebooks_every`-th one being a notebook (the rest, PDFs). Any
+    other keyword argument is passed on to `make_document`."""
+
+    xochitl_dir = pathlib.Path(xochitl_dir)
+    xochitl_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+
+    folders = [""]
+    for i in range(num_folders):
+        folder_uuid = make_uuid(rng)
+        write_meta_files(xochitl_dir, folder_uuid, f"Folder {i}", None, [], rng.choice(folders))
+        folders.append(folder_uuid)
+
+    doc_uuids = []
+    for i in range(num_documents):
+        doc_type = "notebook" if notebooks_every and (i + 1) % notebooks_every == 0 else "pdf"
+        doc_uuids.append(
+            make_document(
+                xochitl_dir,
+                doc_type=doc_type,
+                parent=rng.choice(folders),
+                seed=seed * 100003 + i,
+                **kwargs,
+            )
+        )
+
+    return doc_uuids
@@ -1,6 +1,16 @@
 from . import conversion
 
-from .remarks import run_remarks
+from .remarks import (
+    run_remarks,
+    process_document_to_memory,
+    DocumentResult,
+    PageResult,
+)
+
+from .collection import (
+    build_collection_index,
+    filter_collection_index,
+)
 
 from .utils import (
     get_visible_name,
@@ -1,41 +1,55 @@
 import logging
 import pathlib
 import argparse
+import sys
 
 from remarks import run_remarks
+from remarks.watch import run_watch
+from remarks.profiling import start_profiling, summarize_profile, write_profile
 
 __prog_name__ = "remarks"
 __version__ = "0.3.1"
 
+# Optional first argument, `remarks INPUT OUTPUT` alone does a one-off run
+COMMANDS = ["watch", "serve", "export"]
+
 
 def main():
-    parser = argparse.ArgumentParser(__prog_name__, add_help=False)
+    argv = sys.argv[1:]
+    command = None
+    if len(argv) > 0 and argv[0] in COMMANDS:
+        command = argv.pop(0)
 
-    parser.add_argument(
-        "input_dir",
-        help="xochitl-derived directory that contains *.pdf, *.content, *.metadata, *.highlights/*.json and */*.rm files",
-        metavar="INPUT_DIRECTORY",
-    )
-    parser.add_argument(
-        "output_dir",
-        help="Base directory for all files created (*.pdf, *.png, *.md, and/or *.svg)",
-        metavar="OUTPUT_DIRECTORY",
-    )
-    parser.add_argument(
-        "--file_name",
-        help="Work only on files whose original document names (visibleName) contain this string",
-        metavar="FILENAME_STRING",
-    )
-    parser.add_argument(
-        "--file_uuid",
-        help="Work only on files whose uuid is this string",
-        metavar="UUID_STRING",
-    )
-    parser.add_argument(
-        "--file_path",
-        help="Work only on files whose (meaningful) path contains this string",
-        metavar="FILEPATH_STRING",
-    )
+    prog = __prog_name__ if command is None else f"{__prog_name__} {command}"
+    parser = argparse.ArgumentParser(prog, add_help=False)
+
+    # `remarks serve` gets its documents from requests, not from directories
+    if command != "serve":
+        parser.add_argument(
+            "input_dir",
+            help="xochitl-derived directory that contains *.pdf, *.content, *.metadata, *.highlights/*.json and */*.rm files. It can also be a .tar, .tar.gz or .zip archive of such a directory, which gets read without extracting it",
+            metavar="INPUT_DIRECTORY",
+        )
+        parser.add_argument(
+            "output_dir",
+            help="Base directory for all files created (*.pdf, *.png, *.md, and/or *.svg)",
+            metavar="OUTPUT_DIRECTORY",
+        )
+        parser.add_argument(
+            "--file_name",
+            help="Work only on files whose original document names (visibleName) contain this string",
+            metavar="FILENAME_STRING",
+        )
+        parser.add_argument(
+            "--file_uuid",
+            help="Work only on files whose uuid is this string",
+            metavar="UUID_STRING",
+        )
+        parser.add_argument(
+            "--file_path",
+            help="Work only on files whose (meaningful) path contains this string",
+            metavar="FILEPATH_STRING",
+        )
     parser.add_argument(
         "--ann_type",
         help="Force remarks to handle only a specific type of annotation: highlights or scribbles. If none is specified, remarks will handle both by default",
@@ -60,6 +74,12 @@ def main():
         action="store_true",
         help="Create a '*_remarks-only.pdf' file with annotated pages only (unannotated ones will be out)",
     )
+    parser.add_argument(
+        "--skip_templates",
+        dest="templates",
+        action="store_false",
+        help="Skip drawing notebook page templates (lines, grid or dots, as listed in *.pagedata files) underneath scribbles. Each template is drawn only once per PDF file and shared by every page that uses it",
+    )
     parser.add_argument(
         "--md_hl_format",
         help="Choose how highlighted text should be written in Markdown. Options are: bullet_points or whole_block. Defaults to whole_block",
@@ -87,12 +107,126 @@ def main():
         default=[],
         metavar="FILE_EXTENSION",
     )
+    parser.add_argument(
+        "--png_dpi",
+        nargs="+",
+        help="Resolution(s) of per-page PNG files. The first one goes to png/, every other one to its own png_<DPI>dpi/ (e.g. --png_dpi 144 36 for full-size images plus thumbnails). Pages are interpreted only once no matter how many PNGs (and SVGs) are made from them. Defaults to 144 (2x zoom)",
+        default=[144],
+        type=int,
+        metavar="DPI",
+    )
     parser.add_argument(
         "--assume_malformed_pdfs",
         dest="assume_malformed_pdfs",
         action="store_true",
         help="Assume PDF files are malformed, i.e. words are NOT in their natural reading order and/or fonts are obfuscated. By default, we're optimists and assume your PDFs are well-formed",
     )
+    parser.add_argument(
+        "--save_profile",
+        help="Choose how output PDF files are saved: fast (PyMuPDF defaults, biggest files), compact (garbage collection, compressed streams and object streams) or archive (compact + maximum garbage collection, compressed fonts/images and font subsetting, slowest). Defaults to compact",
+        default="compact",
+        choices=["fast", "compact", "archive"],
+        metavar="SAVE_PROFILE",
+    )
+    if command != "serve":
+        parser.add_argument(
+            "--incremental",
+            dest="incremental",
+            action="store_true",
+            default=False,
+            help="Update the outputs of a previous run in place, re-rendering only the pages whose scribbles or highlights have changed since then. Falls back to a full rebuild whenever the previous outputs can't be patched (e.g. pages were added or options changed)",
+        )
+    if command not in ["serve", "export"]:
+        parser.add_argument(
+            "--index_db",
+            help="Keep an SQLite database at INDEX_DB with every highlight (document, folder, page, color and text), full-text searchable with FTS5, e.g.: sqlite3 INDEX_DB \"SELECT text FROM highlights_fts WHERE highlights_fts MATCH 'turing'\". Each document processed gets its highlights replaced at once, documents gone from INPUT_DIRECTORY are removed",
+            metavar="INDEX_DB",
+        )
+    if command is None:
+        parser.add_argument(
+            "--plan",
+            action="store_true",
+            help="Dry run: print out, for every document to process, its estimated cost and what it's based on (pages, annotated pages, size of its .rm files, number of highlights, size of its PDF file and whether OCR is likely), most expensive first. Nothing gets rendered nor written",
+        )
+    if command != "serve":
+        parser.add_argument(
+            "--profile",
+            help="Time every stage of the work done (parsing, drawing, text extraction, OCR, saving, etc) and write it to PROFILE_FILE as a Chrome trace (open it with chrome://tracing or https://ui.perfetto.dev). A summary table with stage totals, counts of strokes, points and annotations, and bytes written per document is printed out and written next to it as *.summary.txt",
+            metavar="PROFILE_FILE",
+        )
+        parser.add_argument(
+            "--track_memory",
+            action="store_true",
+            help="Keep track of memory usage: peak RSS (resident set size) and peak memory allocated by Python, per document and per stage. Printed out after each document and, with --profile, added to the summary table and the trace. Makes everything slower",
+        )
+    parser.add_argument(
+        "--chunk_size",
+        help="Stream the *_remarks-only.pdf and *_highlights.md files to disk CHUNK_SIZE annotated pages at a time instead of building them whole in memory, so that memory usage depends on CHUNK_SIZE rather than on the size of the document. The resulting files are the same. Not used when patching the outputs of a previous run with --incremental",
+        type=int,
+        metavar="CHUNK_SIZE",
+    )
+    parser.add_argument(
+        "--max_memory_mb",
+        help="Try to keep memory usage (RSS) under MAX_MEMORY_MB megabytes: once over it, remarks drops its caches and PyMuPDF's, and flushes the *_remarks-only.pdf being built to disk page by page instead of holding it in memory. Slower, but big documents (e.g. scanned books) can be processed on small machines. Unlimited by default",
+        type=int,
+        metavar="MAX_MEMORY_MB",
+    )
+    if command == "watch":
+        parser.add_argument(
+            "--poll_interval",
+            help="Check INPUT_DIRECTORY for changes every POLL_INTERVAL seconds. If inotify_simple is installed, changes are picked up as soon as they happen. Defaults to 5",
+            default=5,
+            type=float,
+            metavar="POLL_INTERVAL",
+        )
+        parser.add_argument(
+            "--debounce",
+            help="Wait until a document has not changed for DEBOUNCE seconds before processing it, so that partially synced documents are left alone. Defaults to 10",
+            default=10,
+            type=float,
+            metavar="DEBOUNCE",
+        )
+    if command == "export":
+        parser.add_argument(
+            "--export_format",
+            help="Write strokes and highlights as npz (NumPy) or arrow (Arrow IPC, needs pyarrow) files. Nothing gets rendered, no PDF is opened: every stroke (document and page uuids, layer, tool, color, width and its points) and every highlight (text, color and rects) goes into OUTPUT_DIRECTORY as columns, for analysis or ML pipelines. Defaults to npz",
+            default="npz",
+            choices=["npz", "arrow"],
+            metavar="EXPORT_FORMAT",
+        )
+        parser.add_argument(
+            "--batch_size",
+            help="Write strokes and highlights out BATCH_SIZE rows (or so) at a time, so that memory usage doesn't grow with the size of the library. Defaults to 100000",
+            default=100000,
+            type=int,
+            metavar="BATCH_SIZE",
+        )
+    if command == "serve":
+        parser.add_argument(
+            "--host",
+            help="Listen on this address. Defaults to 127.0.0.1 (i.e. only this computer can reach it)",
+            default="127.0.0.1",
+            metavar="HOST",
+        )
+        parser.add_argument(
+            "--port",
+            help="Listen on this port. Defaults to 8000",
+            default=8000,
+            type=int,
+            metavar="PORT",
+        )
+        parser.add_argument(
+            "--workers",
+            help="Number of worker processes converting documents. They are started (with PyMuPDF already imported) as soon as the server starts. Defaults to the number of CPUs",
+            type=int,
+            metavar="NUM_WORKERS",
+        )
+        parser.add_argument(
+            "--max_concurrency",
+            help="Number of requests converted at the same time, any request beyond that is turned down with a 503 (Service Unavailable). Defaults to NUM_WORKERS",
+            type=int,
+            metavar="MAX_REQUESTS",
+        )
     parser.add_argument(
         "-v",
         "--version",
@@ -123,28 +257,59 @@ def main():
         modified_pdf=False,
         assume_malformed_pdfs=False,
         combined_md=True,
+        templates=True,
         avoid_ocr=False,
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args_dict = vars(args)
 
-    input_dir = args_dict.pop("input_dir")
-    output_dir = args_dict.pop("output_dir")
-
     log_level = args_dict.pop("log_level")
     logging.basicConfig(
         format="%(message)s",
         level=log_level,
     )
 
+    if command == "serve":
+        # Only `remarks serve` needs http.server and multiprocessing, no need
+        # for every other run to pay for importing them
+        from remarks.serve import run_serve
+
+        run_serve(**args_dict)
+        return
+
+    input_dir = args_dict.pop("input_dir")
+    output_dir = args_dict.pop("output_dir")
+
     if not pathlib.Path(input_dir).exists():
         parser.error(f'Directory "{input_dir}" does not exist')
 
-    if not pathlib.Path(output_dir).is_dir():
+    if command == "watch" and not pathlib.Path(input_dir).is_dir():
+        parser.error(f'"{input_dir}" is not a directory, only directories can be watched')
+
+    if not pathlib.Path(output_dir).is_dir() and not args_dict.get("plan"):
         pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    run_remarks(input_dir, output_dir, **args_dict)
+    profile_path = args_dict.pop("profile")
+    track_memory = args_dict.pop("track_memory")
+    if profile_path is not None or track_memory:
+        start_profiling(track_memory=track_memory)
+
+    try:
+        if command == "watch":
+            run_watch(input_dir, output_dir, **args_dict)
+        elif command == "export":
+            # numpy (and maybe pyarrow) are only needed here
+            from remarks.export import run_export
+
+            run_export(input_dir, output_dir, **args_dict)
+        else:
+            run_remarks(input_dir, output_dir, **args_dict)
+    finally:
+        if profile_path is not None:
+            write_profile(profile_path)
+        elif track_memory:
+            summarize_profile()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+import bz2
+import collections
+import gzip
+import lzma
+import pathlib
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+ARCHIVE_SUFFIXES = [".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".zip"]
+
+# Magic bytes of the compressed streams a tarball may come wrapped in
+COMPRESSIONS = [
+    (b"\x1f\x8b", gzip.open),
+    (b"BZh", bz2.open),
+    (b"\xfd7zXZ\x00", lzma.open),
+]
+
+ArchiveStat = collections.namedtuple("ArchiveStat", ["st_size", "st_mtime_ns"])
+
+
+def is_archive(path):
+    name = str(path).lower()
+    return pathlib.Path(path).is_file() and any(
+        name.endswith(suffix) for suffix in ARCHIVE_SUFFIXES
+    )
+
+
+class Archive:
+    """A tar (plain or compressed) or zip archive of a xochitl directory,
+    with all its members indexed in a single pass. Close it (or use it as a
+    context manager) once done, `file` is closed along with it if
+    `owns_file`."""
+
+    def __init__(self, file, name, owns_file=False):
+        self.name = name
+        self.lock = threading.Lock()
+        self.file = file if owns_file else None
+        # Where a compressed tarball gets decompressed to, see `decompress`
+        self.tmp = None
+
+        # Member name -> TarInfo/ZipInfo, and directory -> names of its
+        # children (files and directories), both keyed without trailing "/"
+        self.members = {}
+        self.children = collections.defaultdict(set)
+
+        if zipfile.is_zipfile(file):
+            self.zip = zipfile.ZipFile(file)
+            self.tar = None
+            for info in self.zip.infolist():
+                if not info.is_dir():
+                    self.add_member(info.filename, info)
+        else:
+            file.seek(0)
+            self.zip = None
+            self.tar = tarfile.open(fileobj=self.decompress(file))
+            for info in self.tar:
+                if info.isfile():
+                    self.add_member(info.name, info)
+
+    def decompress(self, file):
+        # Seeking back and forth in a compressed stream means decompressing
+        # it from the start over and over again. Decompress it to a (single)
+        # temporary file once instead, so every member can be read directly
+        magic = file.read(6)
+        file.seek(0)
+
+        for prefix, open_compressed in COMPRESSIONS:
+            if magic.startswith(prefix):
+                tmp = tempfile.TemporaryFile()
+                with open_compressed(file) as f:
+                    shutil.copyfileobj(f, tmp, 1024 * 1024)
+                tmp.seek(0)
+                self.tmp = tmp
+                return tmp
+
+        return file
+
+    def add_member(self, name, info):
+        name = posixpath.normpath(name).lstrip("/")
+        if name.startswith(".."):
+            return
+
+        self.members[name] = info
+
+        parent = posixpath.dirname(name)
+        while True:
+            self.children[parent].add(name)
+            if parent == "":
+                break
+            name, parent = parent, posixpath.dirname(parent)
+
+    def find_root(self):
+        # Backups may hold xochitl's files at the top level or within some
+        # directory (e.g. "xochitl/" or "home/root/.local/share/remarkable/xochitl/")
+        roots = [
+            posixpath.dirname(name)
+            for name in self.members
+            if name.endswith(".metadata")
+        ]
+        if len(roots) == 0:
+            return ""
+        return min(roots, key=lambda root: (root.count("/"), root))
+
+    def read(self, name):
+        info = self.members[name]
+        # The underlying file is shared by all members
+        with self.lock:
+            if self.zip is not None:
+                return self.zip.read(info)
+            return self.tar.extractfile(info).read()
+
+    def stat(self, name):
+        info = self.members[name]
+        if self.zip is not None:
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            return ArchiveStat(info.file_size, int(mtime * 1e9))
+        return ArchiveStat(info.size, int(info.mtime * 1e9))
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+        for f in [self.tmp, self.file]:
+            if f is not None:
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArchivePath:
+    """Just enough of `pathlib.Path` for remarks to work on files that live
+    within an `Archive`, without extracting them."""
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.path = pathlib.PurePosixPath(name or ".")
+
+    @property
+    def member_name(self):
+        return "" if str(self.path) == "." else str(self.path)
+
+    def __str__(self):
+        if self.member_name == "":
+            return self.archive.name
+        return posixpath.join(self.archive.name, self.member_name)
+
+    def __repr__(self):
+        return f"ArchivePath({str(self)!r})"
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ArchivePath)
+            and self.archive is other.archive
+            and self.path == other.path
+        )
+
+    def __lt__(self, other):
+        return self.path < other.path
+
+    def __hash__(self):
+        return hash((id(self.archive), self.path))
+
+    def __truediv__(self, name):
+        return ArchivePath(self.archive, self.path / name)
+
+    def joinpath(self, *names):
+        return ArchivePath(self.archive, self.path.joinpath(*names))
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def stem(self):
+        return self.path.stem
+
+    @property
+    def suffix(self):
+        return self.path.suffix
+
+    @property
+    def parent(self):
+        return ArchivePath(self.archive, self.path.parent)
+
+    def with_name(self, name):
+        return ArchivePath(self.archive, self.path.with_name(name))
+
+    def with_suffix(self, suffix):
+        return ArchivePath(self.archive, self.path.with_suffix(suffix))
+
+    def exists(self):
+        return self.is_file() or self.is_dir()
+
+    def is_file(self):
+        return self.member_name in self.archive.members
+
+    def is_dir(self):
+        return self.member_name in self.archive.children
+
+    def iterdir(self):
+        for name in sorted(self.archive.children.get(self.member_name, [])):
+            yield ArchivePath(self.archive, name)
+
+    def glob(self, pattern):
+        # Only patterns within a single directory (e.g. "*.rm") are needed
+        for child in self.iterdir():
+            if child.path.match(pattern):
+                yield child
+
+    def stat(self):
+        return self.archive.stat(self.member_name)
+
+    def read_bytes(self):
+        if not self.is_file():
+            raise FileNotFoundError(f'No such file in archive: "{self}"')
+        return self.archive.read(self.member_name)
+
+    def read_text(self, encoding="utf-8"):
+        return self.read_bytes().decode(encoding)
+
+
+def open_archive(file, name=None):
+    """Open a tar/zip archive, either a path or a binary file object, and
+    return an `ArchivePath` to the directory holding its xochitl files."""
+
+    if name is None:
+        name = str(file)
+
+    owns_file = isinstance(file, (str, pathlib.Path))
+    if owns_file:
+        file = open(file, "rb")
+
+    try:
+        archive = Archive(file, name, owns_file=owns_file)
+    except BaseException:
+        if owns_file:
+            file.close()
+        raise
+
+    return ArchivePath(archive, archive.find_root())
+
+
+def close_input_dir(input_dir):
+    # Whatever `open_input_dir` returned, directories need no closing
+    if isinstance(input_dir, ArchivePath):
+        input_dir.archive.close()
+
+
+def open_input_dir(input_dir):
+    if isinstance(input_dir, ArchivePath):
+        return input_dir
+    if is_archive(input_dir):
+        return open_archive(input_dir)
+    # Directories are read straight from disk, as usual
+    return pathlib.Path(input_dir)
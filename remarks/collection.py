@@ -0,0 +1,115 @@
+import json
+import logging
+import pathlib
+
+from .archive import open_input_dir
+
+# Both "Quick Sheets" and "Notebooks" have doc_type="notebook"
+SUPPORTED_TYPES = ["pdf", "epub", "notebook"]
+
+
+def load_meta_files(input_dir):
+    # Load every .metadata (and the matching .content) in a single pass, the
+    # whole tree of folders is resolved from these afterwards
+    entries = {}
+
+    for metadata_path in open_input_dir(input_dir).glob("*.metadata"):
+        try:
+            metadata = json.loads(metadata_path.read_bytes())
+        except (OSError, ValueError) as e:
+            logging.warning(f'- Could not read "{metadata_path}", will skip it: {e}')
+            continue
+
+        content = None
+        content_path = metadata_path.with_suffix(".content")
+        if content_path.exists():
+            try:
+                content = json.loads(content_path.read_bytes())
+            except (OSError, ValueError) as e:
+                logging.warning(f'- Could not read "{content_path}": {e}')
+
+        entries[metadata_path.stem] = {
+            "metadata_path": metadata_path,
+            "metadata": metadata,
+            "content": content,
+        }
+
+    return entries
+
+
+def resolve_ui_paths(entries):
+    # Same semantics as `get_ui_path`: the chain of visibleNames of all
+    # parent folders, or "." when any of them is missing (e.g. "trash").
+    # Folders are resolved only once, no matter how many documents they hold
+    ui_paths = {"": pathlib.Path("")}
+
+    def resolve(uuid):
+        chain = []
+        while uuid not in ui_paths:
+            if uuid not in entries or uuid in chain:
+                # None marks a broken chain of folders
+                ui_path = None
+                break
+            chain.append(uuid)
+            uuid = entries[uuid]["metadata"].get("parent", "")
+        else:
+            ui_path = ui_paths[uuid]
+
+        # Memoize every folder visited on the way up
+        for folder_uuid in reversed(chain):
+            if ui_path is not None:
+                ui_path = ui_path.joinpath(
+                    entries[folder_uuid]["metadata"]["visibleName"]
+                )
+            ui_paths[folder_uuid] = ui_path
+
+        return pathlib.Path(".") if ui_path is None else ui_path
+
+    return {
+        uuid: resolve(entry["metadata"].get("parent", ""))
+        for uuid, entry in entries.items()
+    }
+
+
+def build_collection_index(input_dir):
+    entries = load_meta_files(input_dir)
+    ui_paths = resolve_ui_paths(entries)
+
+    index = []
+
+    for uuid, entry in entries.items():
+        metadata, content = entry["metadata"], entry["content"]
+
+        if metadata.get("type") != "DocumentType":
+            continue
+
+        index.append(
+            {
+                "uuid": uuid,
+                "metadata_path": entry["metadata_path"],
+                "doc_type": content.get("fileType") if content else None,
+                "name": metadata.get("visibleName", ""),
+                "ui_path": ui_paths[uuid],
+                "page_count": len(content.get("pages", [])) if content else 0,
+            }
+        )
+
+    return index
+
+
+def filter_collection_index(index, file_name=None, file_uuid=None, file_path=None):
+    filtered = []
+
+    for doc in index:
+        if file_uuid is not None and doc["uuid"] != file_uuid:
+            continue
+
+        if (file_name and (file_name not in doc["name"])) or not doc["name"]:
+            continue
+
+        if file_path is not None and file_path not in str(doc["ui_path"]):
+            continue
+
+        filtered.append(doc)
+
+    return filtered
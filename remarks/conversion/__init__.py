@@ -1,13 +1,18 @@
 from .parsing import (
     check_rm_file_version,
     parse_rm_file,
+    apply_erasers,
     rescale_parsed_data,
     get_ann_max_bound,
+    count_strokes_and_points,
 )
 
 from .drawing import (
     draw_annotations_on_pdf,
     add_smart_highlight_annotations,
+    prepare_annotation_plan,
+    prepare_smart_highlight_plan,
+    apply_annotation_plan,
 )
 
 from .text import (
@@ -17,4 +22,9 @@ from .text import (
     prepare_md_from_hl_groups,
 )
 
+from .templates import (
+    show_template,
+    share_templates,
+)
+
 from .ocrmypdf import is_executable_available, run_ocr
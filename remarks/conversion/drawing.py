@@ -1,13 +1,21 @@
 import logging
 
-import fitz  # PyMuPDF
-import shapely.geometry as geom  # Shapely
-
+from ..lazy import lazy_import
 from ..utils import (
     RM_WIDTH,
     RM_HEIGHT,
 )
 
+fitz = lazy_import("fitz")  # PyMuPDF
+
+
+def get_bounds(points):
+    # Bounding box of (x, y) points. Plain Python is plenty fast for this,
+    # and spares us from importing Shapely (and numpy) at all
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return fitz.Rect(min(xs), min(ys), max(xs), max(ys))
+
 
 HL_COLOR_CODES = {
     3: "yellow",
@@ -89,7 +97,6 @@ def prepare_segments(data):
                 segs[name]["color-code"] = sg_content["style"]["color-code"]
 
                 segs[name]["points"] = []
-                segs[name]["lines"] = []
                 segs[name]["rects"] = []
 
                 for segment in sg_content["points"]:
@@ -101,19 +108,32 @@ def prepare_segments(data):
                         points.append((float(p[0]), float(p[1])))
 
                     segs[name]["points"].append(points)
-                    line = geom.LineString(points)
-                    segs[name]["lines"].append(line)
 
-                    if line.length > 0.0:
-                        segs[name]["rects"].append(fitz.Rect(*line.bounds))
+                    # Same as Shapely's `LineString(points).length > 0`, i.e.
+                    # skip segments that never leave their starting point
+                    if any(p != points[0] for p in points):
+                        segs[name]["rects"].append(get_bounds(points))
 
     return segs
 
 
-def draw_annotations_on_pdf(data, page, inplace=False):
-    segments = prepare_segments(data)
+def get_color(color_code, color_codes):
+    try:
+        return fitz.utils.getColor(color_codes[color_code])
+    except KeyError:
+        # Defaults to yellow if color hasn't been defined yet
+        return fitz.utils.getColor("yellow")
+
 
-    for seg_name, seg_data in segments.items():
+# An annotation plan is everything needed to annotate a page (kind, ink paths
+# or highlight quads, color, opacity and width of every annotation) worked
+# out once, so that it can be applied to as many pages as needed: e.g. the
+# page of the modified PDF and the original page in the combined PDF, which
+# share the same coordinates
+def prepare_annotation_plan(data):
+    plan = []
+
+    for seg_name, seg_data in prepare_segments(data).items():
         seg_type = seg_name.split("_")[0]
 
         # Highlights that were not recognized by reMarkable's own software,
@@ -124,66 +144,46 @@ def draw_annotations_on_pdf(data, page, inplace=False):
         # - https://support.remarkable.com/s/article/Software-release-2-11
 
         if seg_type == "Highlighter":
-            # print("seg_data:", seg_data)
-
             # If there are multiple rectangles per segment, do not want to
             # loop over them. Instead, just send them all to addHighlightAnnot.
             # It can handle a list of rectangles and will join them into one
             # annotation.
-
-            # Sometimes small highlights will not be valid. If so, just print
-            # a warning and carry on
-            try:
-                # https://pymupdf.readthedocs.io/en/latest/recipes-annotations.html#how-to-add-and-modify-annotations
-                annot = page.add_highlight_annot(seg_data["rects"])
-
-                # Now supporting colors
-                try:
-                    color_array = fitz.utils.getColor(
-                        HL_COLOR_CODES[seg_data["color-code"]]
-                    )
-                except KeyError:
-                    # Defaults to yellow if color hasn't been defined yet
-                    color_array = fitz.utils.getColor("yellow")
-
-                annot.set_colors(stroke=color_array)
-
-                annot.set_opacity(seg_data["opacity"])
-                annot.set_border(width=seg_data["stroke-width"])
-                annot.update()
-
-                # print("annot.rect:", annot.rect)
-                # print("annot.border:", annot.border)
-                # print("annot.opacity:", annot.opacity)
-                # print("annot.colors:", annot.colors)
-
-            except Exception as e:
-                logging.warning(
-                    f"- Just ran into an exception while adding a highlight. It probably happened because of a small highlight that PyMuPDF couldn't handle well enough: {e}"
-                )
+            plan.append(
+                {
+                    "kind": "highlight",
+                    "rects": seg_data["rects"],
+                    # Now supporting colors
+                    "color": get_color(seg_data["color-code"], HL_COLOR_CODES),
+                    "opacity": seg_data["opacity"],
+                    "width": seg_data["stroke-width"],
+                }
+            )
 
         # Scribbles
-        else:
-            for seg_points in seg_data["points"]:
-                # https://pymupdf.readthedocs.io/en/latest/recipes-annotations.html#how-to-use-ink-annotations
-                annot = page.add_ink_annot([seg_points])
-                annot.set_border(width=seg_data["stroke-width"])
-                annot.set_opacity(seg_data["opacity"])
-
-                color_array = fitz.utils.getColor(
-                    SC_COLOR_CODES[seg_data["color-code"]]
-                )
-                annot.set_colors(stroke=color_array)
-
-                annot.update()
+        elif len(seg_data["points"]) > 0:
+            plan.append(
+                {
+                    "kind": "ink",
+                    "points": seg_data["points"],
+                    "color": fitz.utils.getColor(
+                        SC_COLOR_CODES[seg_data["color-code"]]
+                    ),
+                    "opacity": seg_data["opacity"],
+                    "width": seg_data["stroke-width"],
+                }
+            )
 
-    if not inplace:
-        return page
+    return plan
 
 
 # Highlights from reMarkable's own "smart" highlighting (introduced in 2.7)
-def add_smart_highlight_annotations(hl_data, page, scale, inplace=False):
+def prepare_smart_highlight_plan(hl_data, page, scale):
+    """Same as `prepare_annotation_plan`, for smart highlights. Their quads
+    are looked up by searching for their text on `page`, the plan can be
+    applied to any page with the same text at the same place."""
+
     hl_list = hl_data["highlights"][0]
+    plan = []
 
     for hl in hl_list:
         # print("hl=", hl)
@@ -216,8 +216,8 @@ def add_smart_highlight_annotations(hl_data, page, scale, inplace=False):
                     )
                 )
 
-            envelope = geom.MultiPoint(points).bounds
-            # `bounds` returns minimum bounding region (minx, miny, maxx, maxy)
+            envelope = get_bounds(points)
+            # minimum bounding region (minx, miny, maxx, maxy)
 
             scaled_envelope = [float(coord) * scale for coord in envelope]
             # print("scaled_envelope", scaled_envelope)
@@ -247,18 +247,63 @@ def add_smart_highlight_annotations(hl_data, page, scale, inplace=False):
 
             # print("quads", quads)
 
-        annot = page.add_highlight_annot(quads)
+        plan.append(
+            {
+                "kind": "highlight",
+                "rects": quads,
+                # Support to colors
+                "color": get_color(hl.get("color"), HL_COLOR_CODES),
+            }
+        )
+
+    return plan
+
+
+def apply_annotation_plan(plan, page):
+    for item in plan:
+        if item["kind"] == "highlight":
+            # Sometimes small highlights will not be valid. If so, just print
+            # a warning and carry on
+            try:
+                # https://pymupdf.readthedocs.io/en/latest/recipes-annotations.html#how-to-add-and-modify-annotations
+                annot = page.add_highlight_annot(item["rects"])
+                annot.set_colors(stroke=item["color"])
+
+                if "opacity" in item:
+                    annot.set_opacity(item["opacity"])
+                if "width" in item:
+                    annot.set_border(width=item["width"])
+
+                annot.update()
+
+            except Exception as e:
+                logging.warning(
+                    f"- Just ran into an exception while adding a highlight. It probably happened because of a small highlight that PyMuPDF couldn't handle well enough: {e}"
+                )
+
+        else:
+            # A single annotation for all pieces of a stroke, which are only
+            # ever more than one if it has been partially erased
+            # https://pymupdf.readthedocs.io/en/latest/recipes-annotations.html#how-to-use-ink-annotations
+            annot = page.add_ink_annot(item["points"])
+            annot.set_border(width=item["width"])
+            annot.set_opacity(item["opacity"])
+            annot.set_colors(stroke=item["color"])
+
+            annot.update()
 
-        # Support to colors
-        try:
-            color_array = fitz.utils.getColor(HL_COLOR_CODES[hl["color"]])
-        except KeyError:
-            # Defaults to yellow if color hasn't been defined yet
-            color_array = fitz.utils.getColor("yellow")
+    return page
 
-        annot.set_colors(stroke=color_array)
 
-        annot.update()
+def draw_annotations_on_pdf(data, page, inplace=False):
+    apply_annotation_plan(prepare_annotation_plan(data), page)
+
+    if not inplace:
+        return page
+
+
+def add_smart_highlight_annotations(hl_data, page, scale, inplace=False):
+    apply_annotation_plan(prepare_smart_highlight_plan(hl_data, page, scale), page)
 
     if not inplace:
         return page
@@ -1,9 +1,8 @@
 import logging
 import struct
 
-import shapely.geometry as geom  # Shapely
-
 from ..utils import (
+    read_file_bytes,
     RM_WIDTH,
     RM_HEIGHT,
 )
@@ -105,8 +104,7 @@ def create_seg_dict(opacity, stroke_width, cc):
 
 
 def check_rm_file_version(file_path):
-    with open(file_path, "rb") as f:
-        data = f.read()
+    data = read_file_bytes(file_path)
     # print("data:", data)
 
     expected_header_fmt = b"reMarkable .lines file, version=0          "
@@ -142,8 +140,7 @@ def check_rm_file_version(file_path):
 def parse_rm_file(file_path, dims={
     "x": RM_WIDTH,
     "y": RM_HEIGHT}):
-    with open(file_path, "rb") as f:
-        data = f.read()
+    data = read_file_bytes(file_path)
 
     expected_header_fmt = b"reMarkable .lines file, version=0          "
 
@@ -171,7 +168,7 @@ def parse_rm_file(file_path, dims={
         l = {}
         l["strokes"] = {}
 
-        for _ in range(nstrokes):
+        for stroke_idx in range(nstrokes):
             if is_v3:
                 fmt = "<IIIfI"
                 # cc for color-code, w for stroke-width
@@ -193,6 +190,9 @@ def parse_rm_file(file_path, dims={
                 l["strokes"] = update_stroke_dict(l["strokes"], tool)
 
             sg = create_seg_dict(opacity, stroke_width, cc)
+            # Strokes are grouped by tool, this keeps track of which ones came
+            # first within the layer (see `apply_erasers`)
+            sg["index"] = stroke_idx
             p = []
 
             for _ in range(nsegs):
@@ -212,6 +212,106 @@ def parse_rm_file(file_path, dims={
     return output, has_highlighter
 
 
+ERASER_TOOLS = ["Eraser", "EraseArea"]
+
+
+def apply_erasers(parsed_data):
+    """Erase what Eraser and EraseArea strokes were drawn over, rather than
+    drawing them as ink: strokes that came before them in the same layer
+    are clipped (if partially erased) or dropped (if fully erased). Eraser
+    strokes themselves are dropped."""
+
+    for layer in parsed_data["layers"]:
+        erasers = []
+        for tool, st_value in layer["strokes"].items():
+            if tool.split("_")[0] in ERASER_TOOLS:
+                erasers += [(tool, sg_value) for sg_value in st_value["segments"]]
+
+        if len(erasers) == 0:
+            continue
+
+        for tool, _ in erasers:
+            layer["strokes"].pop(tool, None)
+
+        erase_layer_strokes(layer, erasers)
+
+    return parsed_data
+
+
+def erase_layer_strokes(layer, erasers):
+    # Shapely (and numpy) are only worth importing for pages that actually
+    # have something erased
+    import shapely
+
+    strokes = []
+    for tool, st_value in layer["strokes"].items():
+        for pos, sg_value in enumerate(st_value["segments"]):
+            points = [(float(x), float(y)) for x, y in sg_value["points"][0]]
+            # Single points are never drawn (see `prepare_segments`)
+            if len(points) > 1:
+                strokes.append((tool, pos, shapely.LineString(points)))
+
+    if len(strokes) == 0:
+        return
+
+    # Query a spatial index for the strokes each eraser may touch, instead of
+    # testing every eraser against every stroke
+    # - https://shapely.readthedocs.io/en/stable/strtree.html
+    tree = shapely.STRtree([geom for _, _, geom in strokes])
+    geoms = dict()
+
+    for tool, eraser in sorted(erasers, key=lambda e: e[1]["index"]):
+        points = [(float(x), float(y)) for x, y in eraser["points"][0]]
+        if len(points) == 0:
+            continue
+
+        if tool.split("_")[0] == "EraseArea":
+            # The area erased is the one enclosed by the stroke (a lasso)
+            if len(points) < 3:
+                continue
+            area = shapely.make_valid(shapely.Polygon(points))
+        else:
+            # Everything under the eraser's tip along its way
+            path = shapely.LineString(points) if len(points) > 1 else shapely.Point(points[0])
+            area = path.buffer(float(eraser["style"]["stroke-width"]) / 2)
+
+        for i in tree.query(area, predicate="intersects"):
+            tool, pos, geom = strokes[i]
+            # Erasers only erase what was there before them
+            if layer["strokes"][tool]["segments"][pos]["index"] > eraser["index"]:
+                continue
+            geoms[i] = shapely.difference(geoms.get(i, geom), area)
+
+    if len(geoms) == 0:
+        return
+
+    # Fully erased strokes, to be dropped
+    erased = dict()
+    for i, geom in geoms.items():
+        tool, pos, _ = strokes[i]
+        sg_value = layer["strokes"][tool]["segments"][pos]
+
+        # A clipped stroke may have been split into several pieces, they're
+        # all kept in the same segment (and drawn as a single annotation)
+        sg_value["points"] = [
+            [(f"{x:.3f}", f"{y:.3f}") for x, y in line.coords]
+            for line in shapely.get_parts(geom)
+            if isinstance(line, shapely.LineString) and not line.is_empty
+        ]
+        if len(sg_value["points"]) == 0:
+            erased[(tool, pos)] = []
+
+    for tool in list(layer["strokes"]):
+        segments = []
+        for pos, sg_value in enumerate(layer["strokes"][tool]["segments"]):
+            segments += erased.get((tool, pos), [sg_value])
+
+        if len(segments) > 0:
+            layer["strokes"][tool]["segments"] = segments
+        else:
+            del layer["strokes"][tool]
+
+
 # TODO: make the rescale part of the parsing (or perhaps drawing?) process
 def rescale_parsed_data(parsed_data, scale):
     if scale == 1:
@@ -236,6 +336,19 @@ def rescale_parsed_data(parsed_data, scale):
     return parsed_data
 
 
+def count_strokes_and_points(parsed_data):
+    num_strokes, num_points = 0, 0
+
+    for strokes in parsed_data["layers"]:
+        for _, st_value in strokes["strokes"].items():
+            for _, sg_value in enumerate(st_value["segments"]):
+                for points in sg_value["points"]:
+                    num_strokes += 1
+                    num_points += len(points)
+
+    return num_strokes, num_points
+
+
 # The line segment will pop up hundreds or thousands of times in notebooks where it is relevant.
 # this flag ensures it will print at most once.
 _line_segment_warning_has_been_shown = False
@@ -243,11 +356,11 @@ _line_segment_warning_has_been_shown = False
 
 def get_ann_max_bound(parsed_data):
     global _line_segment_warning_has_been_shown
-    # https://shapely.readthedocs.io/en/stable/manual.html#LineString
-    # https://shapely.readthedocs.io/en/stable/manual.html#MultiLineString
+    # Same as Shapely's `MultiLineString(lines).bounds`, without paying for
+    # importing Shapely (and numpy) at startup
     # https://shapely.readthedocs.io/en/stable/manual.html#object.bounds
 
-    collection = []
+    maxx, maxy = None, None
 
     for strokes in parsed_data["layers"]:
         for _, st_value in strokes["strokes"].items():
@@ -260,11 +373,13 @@ def get_ann_max_bound(parsed_data):
                                             "issue at: https://github.com/lucasrla/remarks/issues/64 ")
                             _line_segment_warning_has_been_shown = True
                         continue
-                    line = geom.LineString([(float(p[0]), float(p[1])) for p in points])
-                    collection.append(line)
+                    for p in points:
+                        if maxx is None or float(p[0]) > maxx:
+                            maxx = float(p[0])
+                        if maxy is None or float(p[1]) > maxy:
+                            maxy = float(p[1])
 
-    if len(collection) > 0:
-        (minx, miny, maxx, maxy) = geom.MultiLineString(collection).bounds
+    if maxx is not None:
         return (maxx, maxy)
     else:
         return (0, 0)
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import re
+
+from ..lazy import lazy_import
+from ..utils import (
+    RM_WIDTH,
+    RM_HEIGHT,
+)
+
+fitz = lazy_import("fitz")  # PyMuPDF
+
+
+# Template names as found in .pagedata files, e.g. "P Lines medium", "P Grid
+# small", "LS Dots large" (P for portrait, LS for landscape)
+TEMPLATE_NAME_PATTERN = re.compile(
+    r"^(P|LS)?\s*(Lines|Grid|Dots)\s*(small|medium|large|S|M|L)?\b", re.IGNORECASE
+)
+
+# In reMarkable pixels. These are eye-balled from the device's own templates
+# (which live on the device only, under /usr/share/remarkable/templates), not
+# copied from them
+TEMPLATE_SPACINGS = {
+    "small": 52,
+    "medium": 70,
+    "large": 104,
+}
+TEMPLATE_MARGIN = 156
+TEMPLATE_LINE_WIDTH = 2
+TEMPLATE_DOT_RADIUS = 3
+TEMPLATE_COLOR = (0.75, 0.75, 0.75)
+
+# Templates are added to output PDFs as Form XObjects named after what they
+# draw, so that the same template goes by the same name in every document
+TEMPLATE_XOBJECT_PREFIX = "rmTpl"
+
+
+def parse_template_name(name):
+    """Return (kind, spacing, landscape) for template names we know how to
+    draw, or None for anything else (including "Blank")."""
+
+    match = TEMPLATE_NAME_PATTERN.match(name.strip())
+    if match is None:
+        return None
+
+    orientation, kind, size = match.groups()
+    size = (size or "medium").lower()
+    size = {"s": "small", "m": "medium", "l": "large"}.get(size, size)
+
+    return kind.lower(), TEMPLATE_SPACINGS[size], (orientation or "").upper() == "LS"
+
+
+def render_template(name, page_dims):
+    """Draw template `name` on a page sized `page_dims`. Return the drawing
+    as a dict (XObject name, content stream, bounding box), or None if there
+    is nothing to draw."""
+
+    template = parse_template_name(name)
+    if template is None:
+        if name.strip() not in ["", "Blank", "LS Blank"]:
+            logging.debug(f'- Template "{name}" is not supported, will leave its pages blank')
+        return None
+
+    kind, spacing, landscape = template
+    scale = page_dims[0] / RM_WIDTH
+
+    doc = fitz.open()
+    page = doc.new_page(width=page_dims[0], height=page_dims[1])
+    shape = page.new_shape()
+
+    # Landscape templates are drawn across the page rather than along it,
+    # the same way the device shows them on a portrait page
+    width, height = (RM_HEIGHT, RM_WIDTH) if landscape else (RM_WIDTH, RM_HEIGHT)
+
+    def to_page(x, y):
+        if landscape:
+            x, y = y, RM_HEIGHT - x
+        return fitz.Point(x * scale, y * scale)
+
+    if kind == "lines":
+        for y in range(TEMPLATE_MARGIN, height, spacing):
+            shape.draw_line(to_page(0, y), to_page(width, y))
+        shape.finish(color=TEMPLATE_COLOR, width=TEMPLATE_LINE_WIDTH * scale)
+
+    elif kind == "grid":
+        for x in range(0, width, spacing):
+            shape.draw_line(to_page(x, 0), to_page(x, height))
+        for y in range(0, height, spacing):
+            shape.draw_line(to_page(0, y), to_page(width, y))
+        shape.finish(color=TEMPLATE_COLOR, width=TEMPLATE_LINE_WIDTH * scale)
+
+    elif kind == "dots":
+        for x in range(spacing, width, spacing):
+            for y in range(spacing, height, spacing):
+                shape.draw_circle(to_page(x, y), TEMPLATE_DOT_RADIUS * scale)
+        shape.finish(color=TEMPLATE_COLOR, fill=TEMPLATE_COLOR, width=0)
+
+    shape.commit()
+
+    # Only colors and paths: the page has no resources, its content stream
+    # is all there is to it
+    stream = page.read_contents()
+    doc.close()
+
+    return {
+        "name": TEMPLATE_XOBJECT_PREFIX + hashlib.sha1(stream).hexdigest()[:12],
+        "stream": stream,
+        "bbox": page_dims,
+    }
+
+
+def set_page_xobject(page, name, xref):
+    """Make XObject `xref` available to `page` as `name`. Page resources
+    (and their XObjects) are either inline or indirect objects of their
+    own, and PyMuPDF only sets keys down paths of inline ones."""
+
+    doc = page.parent
+    target, key = page.xref, "Resources"
+    for subkey in ["XObject", name]:
+        kind, value = doc.xref_get_key(target, key)
+        if kind == "xref":
+            target, key = int(value.split()[0]), subkey
+        else:
+            key = f"{key}/{subkey}"
+
+    doc.xref_set_key(target, key, f"{xref} 0 R")
+
+
+def show_template(page, name, templates, template_xrefs):
+    """Show template `name` underneath everything else on `page`.
+
+    Each template is drawn only once, into `templates` (template name ->
+    drawing, or None), and added only once to each document, as a Form
+    XObject that every page using it references: a 500-page lined notebook
+    holds a single copy of the lines. `template_xrefs` (XObject name ->
+    xref) keeps track of those of the document of `page`; start it over for
+    every new document."""
+
+    if name not in templates:
+        templates[name] = render_template(name, (page.rect.width, page.rect.height))
+
+    template = templates[name]
+    if template is None:
+        return
+
+    doc = page.parent
+    xref = template_xrefs.get(template["name"])
+    if xref is None:
+        width, height = template["bbox"]
+        xref = doc.get_new_xref()
+        doc.update_object(
+            xref,
+            f"<</Type/XObject/Subtype/Form/BBox[0 0 {width} {height}]/Resources<<>>>>",
+        )
+        doc.update_stream(xref, template["stream"])
+        template_xrefs[template["name"]] = xref
+
+    set_page_xobject(page, template["name"], xref)
+
+    # Shown first, so that it's underneath
+    contents_xref = doc.get_new_xref()
+    doc.update_object(contents_xref, "<<>>")
+    doc.update_stream(contents_xref, f"q /{template['name']} Do Q".encode())
+    contents = [contents_xref] + page.get_contents()
+    doc.xref_set_key(
+        page.xref, "Contents", "[" + " ".join(f"{x} 0 R" for x in contents) + "]"
+    )
+
+
+def share_templates(doc, from_page, template_xrefs):
+    """Pages copied over from another document (e.g. by `insert_pdf`) bring
+    a copy of their templates along. Point pages of `doc` from `from_page`
+    on to the templates `doc` already holds, as listed in `template_xrefs`
+    (see `show_template`), and list those it didn't hold yet. Left behind
+    copies go away with the next non-incremental save."""
+
+    for page in doc.pages(from_page):
+        for xref, name, _, _ in page.get_xobjects():
+            if not name.startswith(TEMPLATE_XOBJECT_PREFIX):
+                continue
+            shared_xref = template_xrefs.setdefault(name, xref)
+            if shared_xref != xref:
+                set_page_xobject(page, name, shared_xref)
@@ -1,7 +1,20 @@
-from itertools import groupby
-import operator
 
-import fitz
+from .drawing import HL_COLOR_CODES
+from ..lazy import lazy_import
+
+fitz = lazy_import("fitz")  # PyMuPDF
+
+
+def get_hl_color_name(rgb):
+    # Highlight annotations only keep their color as RGB, map it back to the
+    # closest of reMarkable's highlighter colors
+    if not rgb:
+        return "yellow"
+
+    def distance(name):
+        return sum((a - b) ** 2 for a, b in zip(fitz.utils.getColor(name), rgb))
+
+    return min(HL_COLOR_CODES.values(), key=distance)
 
 
 # TODO: improve this check, it is still very rudimentary
@@ -63,6 +76,15 @@ def get_highlight_rects(page, sort=True):
     return hl_rects
 
 
+def get_group_color(page, word_tuple):
+    # A group takes the color of the highlight its first word is under
+    word_rect = fitz.Rect(word_tuple[:4])
+    for ann in page.annots(types=(fitz.PDF_ANNOT_HIGHLIGHT,)):
+        if word_rect.intersects(ann.rect):
+            return get_hl_color_name(ann.colors["stroke"])
+    return get_hl_color_name(None)
+
+
 def get_page_text_tuples(
     page, option="words", flags=(1 + 2 + 16 + 64), sort=True, text_only=False
 ):
@@ -101,7 +123,34 @@ def get_page_text_tuples(
         return tuples_list
 
 
-def extract_groups_from_pdf_ann_hl(page, malformed=False):
+def cluster_words_by_line(word_tuples, tolerance=0.5):
+    """Group word tuples into lines, each one sorted by x0. Words of the
+    same (visual) line rarely share the exact same y1 on malformed PDFs
+    (e.g. scanned and OCRed pages), so words are sorted by y1 and a new line
+    starts only where y1 jumps by more than `tolerance` times the height of
+    the words around that jump."""
+
+    # w[3] is the y1 coord (sort of a "base line") of a word's bbox
+    words = sorted(word_tuples, key=lambda w: (w[3], w[0]))
+
+    lines = []
+    prev = None
+
+    for w in words:
+        if prev is not None:
+            height = min(prev[3] - prev[1], w[3] - w[1])
+            if w[3] - prev[3] <= tolerance * max(height, 1):
+                lines[-1].append(w)
+                prev = w
+                continue
+        lines.append([w])
+        prev = w
+
+    # w[0] is the x0 coord of a word's bbox
+    return [sorted(line, key=lambda w: w[0]) for line in lines]
+
+
+def extract_groups_from_pdf_ann_hl(page, malformed=False, with_colors=False):
     # https://pymupdf.readthedocs.io/en/latest/recipes-text.html#how-to-extract-text-from-within-a-rectangle
     # https://github.com/pymupdf/PyMuPDF-Utilities/tree/master/textbox-extraction
     # https://github.com/benlongo/remarkable-highlights/blob/0608dea6ba1f5ce46c540e623c55649f8f918b5c/remarkable_highlights/extract.py#L131
@@ -118,6 +167,8 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
     # print("hl_rects:", hl_rects)
 
     hl_word_groups = []
+    # First word tuple of each group, for `with_colors`
+    hl_first_words = []
 
     # An alternative for the method below would be to use word numbers
     # and order words within each "block"
@@ -137,6 +188,8 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
         curr_group = []
         for word_tuple, is_highlighted in zip(words_tuples_list, hl_words_mask):
             if is_highlighted:
+                if len(curr_group) == 0:
+                    hl_first_words.append(word_tuple)
                 # w[4] for the actual text content of a word tuple
                 curr_group.append(word_tuple[4])
             # If this word_tuple hasn't been highlighted, append current group
@@ -161,44 +214,50 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
         # are in the same line but were highlighted separately
         hl_word_tuples = []
         for word_tuple in words_tuples_list:
-            already_highlighted = False
+            word_rect = fitz.Rect(word_tuple[:4])
             for hl_rect in hl_rects:
-                if (
-                    fitz.Rect(word_tuple[:4]).intersects(hl_rect)
-                    and not already_highlighted
-                ):
+                if word_rect.intersects(hl_rect):
                     # print("hl_rect + word_tuple:", hl_rect, word_tuple)
                     hl_word_tuples.append(word_tuple)
-                    already_highlighted = True
+                    break
 
         # print("hl_word_tuples:", hl_word_tuples)
 
-        # w[3] is the y1 coord (sort of a "base line") of a word's bbox
-        hl_words_grouped_by_line = groupby(hl_word_tuples, key=lambda w: w[3])
-
-        for y1, hl_word_tuple in hl_words_grouped_by_line:
-            hl_word_groups.append([w[4] for w in hl_word_tuple])
+        for line in cluster_words_by_line(hl_word_tuples):
+            hl_first_words.append(line[0])
+            hl_word_groups.append([w[4] for w in line])
 
     # print("hl_word_groups:", hl_word_groups)
+    if with_colors:
+        return hl_word_groups, [get_group_color(page, w) for w in hl_first_words]
     return hl_word_groups
 
 
-def extract_groups_from_smart_hl(hl_data):
+def get_smart_hl_span(hl):
+    # `start` and `length` seem to be character-based counts. Some files
+    # lack them: such highlights go first (-1), as long as their text
+    return hl.get("start", -1), hl.get("length", len(hl["text"]))
+
+
+def extract_groups_from_smart_hl(hl_data, with_colors=False):
     hl_list = hl_data["highlights"][0]
 
     # Sorting is needed because highlights are added to list according to
     # "timestamp", not necessarily natural order
-    sorted_hl_list = sorted(hl_list, key=operator.itemgetter("start"))
+    sorted_hl_list = sorted(hl_list, key=lambda hl: get_smart_hl_span(hl)[0])
 
-    # Create a new key for easier iteration over highlights.
-    # `start` and `length` seem to be character-based counts
+    # Create new keys for easier iteration over highlights
     for hl in sorted_hl_list:
-        hl["end"] = hl["start"] + hl["length"]
+        start, length = get_smart_hl_span(hl)
+        hl["start"], hl["end"] = start, start + length
 
     curr_group = []
     hl_word_groups = []
+    hl_colors = []
 
     for i, hl in enumerate(sorted_hl_list):
+        if len(curr_group) == 0:
+            hl_colors.append(HL_COLOR_CODES.get(hl.get("color"), "yellow"))
         curr_group.append(hl["text"])
         # print("curr_group:", curr_group)
 
@@ -227,6 +286,8 @@ def extract_groups_from_smart_hl(hl_data):
             hl_word_groups.append(curr_group)
 
     # print("smart_hl_word_groups:", hl_word_groups)
+    if with_colors:
+        return hl_word_groups, hl_colors
     return hl_word_groups
 
 
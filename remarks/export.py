@@ -0,0 +1,320 @@
+import logging
+import pathlib
+import sys
+
+# numpy comes along with Shapely, but it's only ever needed here, see
+# `run_export`
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .archive import open_input_dir, close_input_dir
+from .collection import build_collection_index, filter_collection_index
+from .conversion.parsing import check_rm_file_version, parse_rm_file
+from .conversion.text import get_smart_hl_span
+from .profiling import span, document_span, count, is_profiling
+from .utils import (
+    get_pages_data,
+    list_ann_rm_files,
+    list_hl_json_files,
+    load_json_file,
+)
+
+EXPORT_FORMATS = ["npz", "arrow"]
+
+# Strokes and highlights are kept in columns, i.e. one list per field, and
+# all points (or rects) of a batch go into a single flat array. Row `i`
+# owns points[offsets[i]:offsets[i + 1]], the same layout Arrow uses for its
+# list columns, see:
+# - https://arrow.apache.org/docs/format/Columnar.html#variable-size-list-layout
+STROKE_COLUMNS = ["doc_uuid", "page_uuid", "page", "layer", "tool", "color", "width", "opacity"]
+HIGHLIGHT_COLUMNS = ["doc_uuid", "page_uuid", "page", "text", "color", "start", "length"]
+
+# Columns missing here are strings
+DTYPES = {
+    "page": "int32",
+    "layer": "int32",
+    "color": "int32",
+    "width": "float32",
+    "opacity": "float32",
+    "start": "int64",
+    "length": "int64",
+}
+
+
+def new_batch(columns):
+    batch = dict((column, []) for column in columns)
+    batch["offsets"] = [0]
+    batch["values"] = []
+    return batch
+
+
+def add_document_strokes(batch, doc_uuid, page_uuid, page_idx, parsed_data):
+    for layer_idx, layer in enumerate(parsed_data["layers"]):
+        for tool, st_value in layer["strokes"].items():
+            for sg_value in st_value["segments"]:
+                for points in sg_value["points"]:
+                    batch["doc_uuid"].append(doc_uuid)
+                    batch["page_uuid"].append(page_uuid)
+                    batch["page"].append(page_idx)
+                    batch["layer"].append(layer_idx)
+                    batch["tool"].append(tool)
+                    batch["color"].append(sg_value["style"]["color-code"])
+                    batch["width"].append(float(sg_value["style"]["stroke-width"]))
+                    batch["opacity"].append(float(sg_value["style"]["opacity"]))
+                    batch["values"] += points
+                    batch["offsets"].append(len(batch["values"]))
+
+
+def add_document_highlights(batch, doc_uuid, page_uuid, page_idx, hl_data):
+    for hl in hl_data["highlights"][0]:
+        batch["doc_uuid"].append(doc_uuid)
+        batch["page_uuid"].append(page_uuid)
+        batch["page"].append(page_idx)
+        batch["text"].append(hl["text"])
+        batch["color"].append(hl.get("color", 0))
+        start, length = get_smart_hl_span(hl)
+        batch["start"].append(start)
+        batch["length"].append(length)
+        batch["values"] += [
+            (r["x"], r["y"], r["width"], r["height"]) for r in hl["rects"]
+        ]
+        batch["offsets"].append(len(batch["values"]))
+
+
+def batch_to_arrays(batch, columns, width):
+    arrays = dict(
+        (column, np.array(batch[column], dtype=DTYPES.get(column, str)))
+        for column in columns
+    )
+
+    # Points were parsed as "%.3f" strings, numpy converts them straight away
+    arrays["offsets"] = np.array(batch["offsets"], dtype=np.int64)
+    arrays["values"] = np.array(batch["values"], dtype=np.float32).reshape(-1, width)
+
+    return arrays
+
+
+def open_arrow_writers(output_dir):
+    # pyarrow is optional, and a big one, so only `--export_format arrow`
+    # needs it
+    try:
+        import pyarrow as pa
+    except ImportError:
+        logging.error(
+            "- Exporting to Arrow needs pyarrow, which isn't installed. Install it (pip install pyarrow) or use --export_format npz"
+        )
+        sys.exit(1)
+
+    schemas = {
+        "strokes": pa.schema(
+            [
+                ("doc_uuid", pa.string()),
+                ("page_uuid", pa.string()),
+                ("page", pa.int32()),
+                ("layer", pa.int32()),
+                ("tool", pa.string()),
+                ("color", pa.int32()),
+                ("width", pa.float32()),
+                ("opacity", pa.float32()),
+                # x0, y0, x1, y1, ...
+                ("points", pa.list_(pa.float32())),
+            ]
+        ),
+        "highlights": pa.schema(
+            [
+                ("doc_uuid", pa.string()),
+                ("page_uuid", pa.string()),
+                ("page", pa.int32()),
+                ("text", pa.string()),
+                ("color", pa.int32()),
+                ("start", pa.int64()),
+                ("length", pa.int64()),
+                # x, y, width, height of every rect, one after another
+                ("rects", pa.list_(pa.float32())),
+            ]
+        ),
+    }
+
+    writers = {}
+    for name, schema in schemas.items():
+        # Arrow IPC files hold any number of record batches, so every batch
+        # goes into the same file
+        # - https://arrow.apache.org/docs/python/ipc.html
+        sink = pa.OSFile(str(output_dir / f"{name}.arrow"), "wb")
+        writers[name] = (pa, sink, pa.ipc.new_file(sink, schema))
+
+    return writers
+
+
+def write_arrow_batch(writer, arrays, columns, list_column):
+    pa, _, ipc_writer = writer
+    schema = ipc_writer.schema
+
+    values = arrays["values"].reshape(-1)
+    width = arrays["values"].shape[1]
+
+    data = [pa.array(arrays[column], type=schema.field(column).type) for column in columns]
+    data.append(
+        pa.ListArray.from_arrays(
+            pa.array(arrays["offsets"] * width, type=pa.int32()),
+            pa.array(values, type=pa.float32()),
+        )
+    )
+
+    ipc_writer.write_batch(pa.record_batch(data, names=columns + [list_column]))
+
+
+def close_arrow_writers(writers):
+    for _, sink, ipc_writer in writers.values():
+        ipc_writer.close()
+        sink.close()
+
+
+def run_export(
+    input_dir,
+    output_dir,
+    file_name=None,
+    file_uuid=None,
+    file_path=None,
+    ann_type=None,
+    export_format="npz",
+    batch_size=100000,
+    **kwargs,
+):
+    """Write the strokes and smart highlights of every matching document
+    into columnar files under `output_dir`, without rendering anything: no
+    source PDF is even opened. Coordinates are left as found on the device
+    (reMarkable's 1404x1872 units), for the analysis or ML pipelines that
+    come next to scale them however they see fit.
+
+    Strokes and highlights are gathered into batches that are written out
+    as soon as they hold more than `batch_size` rows, so memory stays flat
+    no matter how big the library is. With npz, every
+    batch is a file of its own (strokes-00000.npz, highlights-00000.npz,
+    etc). With arrow, batches are appended to strokes.arrow and
+    highlights.arrow."""
+
+    if np is None:
+        logging.error(
+            "- Exporting needs numpy, which isn't installed. Install it (pip install numpy) and try again"
+        )
+        sys.exit(1)
+
+    if ann_type is None:
+        ann_type = ["scribbles", "highlights"]
+
+    with span("index"):
+        input_dir = open_input_dir(input_dir)
+        index = build_collection_index(input_dir)
+
+    docs = filter_collection_index(index, file_name, file_uuid, file_path)
+    output_dir = pathlib.Path(output_dir)
+
+    logging.info(
+        f'\nFound {len(index)} documents in "{input_dir}" ({len(docs)} matching your filters), will export their annotations to {export_format} now',
+    )
+
+    writers = open_arrow_writers(output_dir) if export_format == "arrow" else None
+
+    tables = {
+        "strokes": {
+            "columns": STROKE_COLUMNS,
+            "list_column": "points",
+            "width": 2,
+            "batch": new_batch(STROKE_COLUMNS),
+            "num_batches": 0,
+            "num_rows": 0,
+        },
+        "highlights": {
+            "columns": HIGHLIGHT_COLUMNS,
+            "list_column": "rects",
+            "width": 4,
+            "batch": new_batch(HIGHLIGHT_COLUMNS),
+            "num_batches": 0,
+            "num_rows": 0,
+        },
+    }
+
+    def flush_batch(name):
+        table = tables[name]
+        num_rows = len(table["batch"]["offsets"]) - 1
+        if num_rows == 0:
+            return
+
+        with span("save", file=export_format):
+            arrays = batch_to_arrays(table["batch"], table["columns"], table["width"])
+
+            if writers is not None:
+                write_arrow_batch(
+                    writers[name], arrays, table["columns"], table["list_column"]
+                )
+            else:
+                # Uncompressed: no need to pay for compression on every batch,
+                # and readers can memory-map them
+                arrays[table["list_column"]] = arrays.pop("values")
+                np.savez(output_dir / f"{name}-{table['num_batches']:05}.npz", **arrays)
+
+        table["num_batches"] += 1
+        table["num_rows"] += num_rows
+        table["batch"] = new_batch(table["columns"])
+
+    try:
+        for doc in docs:
+            if doc["doc_type"] is None:
+                continue
+
+            with document_span(doc["name"]):
+                pages_list, _ = get_pages_data(doc["metadata_path"])
+                page_idxs = dict((page_uuid, i) for i, page_uuid in enumerate(pages_list))
+
+                if "scribbles" in ann_type:
+                    batch = tables["strokes"]["batch"]
+                    for rm_file in sorted(list_ann_rm_files(doc["metadata_path"])):
+                        if rm_file.stem not in page_idxs or not check_rm_file_version(rm_file):
+                            continue
+
+                        with span("parse"):
+                            parsed_data, _ = parse_rm_file(rm_file)
+                            add_document_strokes(
+                                batch, doc["uuid"], rm_file.stem, page_idxs[rm_file.stem], parsed_data
+                            )
+
+                        if is_profiling():
+                            count("pages")
+
+                        if len(batch["offsets"]) > batch_size:
+                            flush_batch("strokes")
+                            batch = tables["strokes"]["batch"]
+
+                if "highlights" in ann_type:
+                    batch = tables["highlights"]["batch"]
+                    for hl_json_file in sorted(list_hl_json_files(doc["metadata_path"])):
+                        if hl_json_file.stem not in page_idxs:
+                            continue
+
+                        add_document_highlights(
+                            batch,
+                            doc["uuid"],
+                            hl_json_file.stem,
+                            page_idxs[hl_json_file.stem],
+                            load_json_file(hl_json_file),
+                        )
+
+                        if len(batch["offsets"]) > batch_size:
+                            flush_batch("highlights")
+                            batch = tables["highlights"]["batch"]
+
+        for name in tables:
+            flush_batch(name)
+    finally:
+        if writers is not None:
+            close_arrow_writers(writers)
+        close_input_dir(input_dir)
+
+    logging.info(
+        f'\nExported {tables["strokes"]["num_rows"]} strokes and {tables["highlights"]["num_rows"]} highlights to "{output_dir}" ({tables["strokes"]["num_batches"]} + {tables["highlights"]["num_batches"]} batches)'
+    )
+
+    return dict((name, table["num_rows"]) for name, table in tables.items())
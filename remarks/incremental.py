@@ -0,0 +1,233 @@
+import hashlib
+import json
+import logging
+import pathlib
+import re
+
+from .lazy import lazy_import
+from .utils import save_pdf_to, replace_if_changed, write_file, delete_file
+
+fitz = lazy_import("fitz")  # PyMuPDF
+
+
+# Bump this whenever the layout of the state file changes, older states are
+# then simply ignored (which means a full rebuild)
+STATE_VERSION = 1
+
+MD_SECTION_PATTERNS = {
+    "atx": re.compile(r"\n## Page (-?\d+)\n\n"),
+    "setex": re.compile(r"\nPage (-?\d+)\n--------\n"),
+}
+
+
+def get_state_path(out_path):
+    # Hidden file, so it doesn't clutter vaults that sync the output dir
+    return pathlib.Path(f"{out_path.parent}/.{out_path.name}.remarks-state.json")
+
+
+def load_state(state_path):
+    if not state_path.exists():
+        return None
+
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if state.get("version") != STATE_VERSION:
+        return None
+
+    return state
+
+
+def save_state(state_path, state):
+    state = {"version": STATE_VERSION, **state}
+    with open(state_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def hash_file(path):
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+def get_options_fingerprint(options):
+    options_str = json.dumps(options, sort_keys=True, default=str)
+    return hashlib.sha1(options_str.encode("utf-8")).hexdigest()
+
+
+def get_source_fingerprint(path):
+    # For source PDFs (that can be huge) size + mtime is good enough, they
+    # are not expected to change at all after being synced
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def get_pages_fingerprints(ann_rm_files, hl_json_files):
+    # A page fingerprint covers every file that feeds into its rendering: its
+    # scribbles (*.rm) and its smart highlights (*.json)
+    hashes = {}
+
+    for f in ann_rm_files:
+        hashes.setdefault(f.stem, []).append(f"rm:{hash_file(f)}")
+
+    for f in hl_json_files:
+        hashes.setdefault(f.stem, []).append(f"json:{hash_file(f)}")
+
+    return {
+        page_uuid: hashlib.sha1("|".join(sorted(h)).encode("utf-8")).hexdigest()
+        for page_uuid, h in hashes.items()
+    }
+
+
+def get_changed_pages(prev_state, state, expected_outputs):
+    """Return the set of page uuids that must be re-rendered, or None if the
+    existing outputs can't be patched and a full rebuild is needed."""
+
+    if prev_state is None:
+        return None
+
+    for key in ["pages", "templates", "source", "options"]:
+        if prev_state.get(key) != state[key]:
+            logging.debug(f"- Incremental update not possible: {key} changed")
+            return None
+
+    for path in expected_outputs:
+        if not pathlib.Path(path).exists():
+            logging.debug(f'- Incremental update not possible: "{path}" is missing')
+            return None
+
+    prev_fps = prev_state.get("fingerprints", {})
+    curr_fps = state["fingerprints"]
+
+    return {
+        page_uuid
+        for page_uuid in set(prev_fps) | set(curr_fps)
+        if prev_fps.get(page_uuid) != curr_fps.get(page_uuid)
+    }
+
+
+def replace_pdf_pages(pdf_path, pdf_src, page_idxs, save_profile="compact"):
+    doc = fitz.open(pdf_path)
+
+    if len(doc) != len(pdf_src):
+        doc.close()
+        raise ValueError(
+            f'"{pdf_path}" has {len(doc)} pages, expected {len(pdf_src)}'
+        )
+
+    # Append the new versions of the pages and then reorder everything in a
+    # single pass (the same as `assemble_pdf` does), old versions are dropped
+    page_refs = list(range(len(doc)))
+    for page_idx in sorted(page_idxs):
+        doc.insert_pdf(pdf_src, from_page=page_idx, to_page=page_idx)
+        page_refs[page_idx] = len(doc) - 1
+
+    doc.select(page_refs)
+
+    return save_pdf_replacing(doc, pdf_path, save_profile)
+
+
+def merge_modified_pdf(
+    pdf_path, new_pdf, prev_pages, new_pages, changed_pages, save_profile="compact"
+):
+    """Rebuild the annotated-pages-only PDF by copying unchanged pages from
+    its previous version and changed ones from `new_pdf`.
+
+    `prev_pages` and `new_pages` are the (sorted) page indexes held by the
+    previous file and by `new_pdf`, respectively. `changed_pages` holds the
+    indexes of every page that was re-rendered in this run. Return the page
+    indexes held by the new file and its (size, seconds) if it was saved."""
+
+    prev_doc = fitz.open(pdf_path) if len(prev_pages) > 0 else None
+    doc = fitz.open()
+
+    pages = sorted(
+        set(p for p in prev_pages if p not in changed_pages) | set(new_pages)
+    )
+
+    for page_idx in pages:
+        if page_idx in changed_pages:
+            src, src_idx = new_pdf, new_pages.index(page_idx)
+        else:
+            src, src_idx = prev_doc, prev_pages.index(page_idx)
+        doc.insert_pdf(src, from_page=src_idx, to_page=src_idx)
+
+    if prev_doc is not None:
+        prev_doc.close()
+
+    saved = None
+    if len(doc) > 0:
+        saved = save_pdf_replacing(doc, pdf_path, save_profile)
+    else:
+        doc.close()
+        delete_file(pdf_path)
+
+    return pages, saved
+
+
+def save_pdf_replacing(doc, pdf_path, save_profile="compact"):
+    # PyMuPDF can't save (non-incrementally) over the file it has opened, so
+    # write to a sibling file first and then swap it in atomically
+    tmp_path = f"{pdf_path}.tmp"
+    saved = save_pdf_to(doc, tmp_path, save_profile, id_path=pdf_path)
+    doc.close()
+    replace_if_changed(tmp_path, pdf_path)
+    return saved
+
+
+def prepare_md_sections(md_sections, md_header_format="atx"):
+    if md_header_format == "atx":
+        return "".join([f"\n## Page {s[0]}\n\n" + s[1] for s in md_sections])
+
+    elif md_header_format == "setex":
+        return "".join([f"\nPage {s[0]}\n--------\n" + s[1] for s in md_sections])
+
+
+def prepare_combined_md(title, md_sections, md_header_format="atx"):
+    combined_md_str = prepare_md_sections(md_sections, md_header_format)
+
+    if md_header_format == "atx":
+        return f"# {title}\n" + combined_md_str
+
+    elif md_header_format == "setex":
+        return f"{title}\n========\n" + combined_md_str
+
+
+def parse_combined_md(md_str, md_header_format="atx"):
+    # Inverse of `prepare_combined_md`: split a combined Markdown file back
+    # into its title block and a list of (page number, section text) tuples
+    chunks = MD_SECTION_PATTERNS[md_header_format].split(md_str)
+    title_block = chunks[0]
+
+    md_sections = [
+        (int(chunks[i]), chunks[i + 1]) for i in range(1, len(chunks) - 1, 2)
+    ]
+
+    return title_block, md_sections
+
+
+def patch_combined_md(md_path, md_sections, removed_pages, md_header_format="atx"):
+    """Replace the sections of `removed_pages` in an existing combined
+    Markdown file with the new `md_sections`. Untouched sections are kept
+    verbatim. Return the number of sections left in the file."""
+
+    with open(md_path) as f:
+        title_block, prev_sections = parse_combined_md(f.read(), md_header_format)
+
+    patched = dict((s[0], s[1]) for s in prev_sections if s[0] not in removed_pages)
+    patched.update(dict(md_sections))
+
+    if len(patched) == 0:
+        delete_file(md_path)
+        return 0
+
+    combined_md_str = title_block + prepare_md_sections(
+        sorted(patched.items()), md_header_format
+    )
+
+    write_file(md_path, combined_md_str)
+
+    return len(patched)
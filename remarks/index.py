@@ -0,0 +1,135 @@
+import logging
+import sqlite3
+
+# Highlights live in a regular table (indexed by document, so that a
+# document's rows are replaced without scanning everybody else's) and their
+# text is indexed by an FTS5 table that triggers keep in sync with it, see:
+# - https://www.sqlite.org/fts5.html#external_content_tables
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    uuid TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    ui_path TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS highlights (
+    id INTEGER PRIMARY KEY,
+    doc_uuid TEXT NOT NULL REFERENCES documents(uuid),
+    page_uuid TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    color TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS highlights_doc_uuid ON highlights(doc_uuid, page_uuid);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS highlights_fts USING fts5(
+    text,
+    content='highlights',
+    content_rowid='id'
+);
+
+CREATE TRIGGER IF NOT EXISTS highlights_ai AFTER INSERT ON highlights BEGIN
+    INSERT INTO highlights_fts(rowid, text) VALUES (new.id, new.text);
+END;
+
+CREATE TRIGGER IF NOT EXISTS highlights_ad AFTER DELETE ON highlights BEGIN
+    INSERT INTO highlights_fts(highlights_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+
+def open_index(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def update_document_index(db_path, doc_uuid, name, ui_path, hl_rows, only_pages=None):
+    """Replace the highlights of a document with `hl_rows`, dicts holding
+    "page_uuid", "page", "color" and "text". With `only_pages` (page uuids),
+    only the rows of these pages are replaced. Everything happens in a
+    single transaction: readers see the document either as it was or as it
+    is now, never in between."""
+
+    conn = open_index(db_path)
+
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO documents(uuid, name, ui_path) VALUES (?, ?, ?) "
+                "ON CONFLICT(uuid) DO UPDATE SET name=excluded.name, ui_path=excluded.ui_path",
+                (doc_uuid, name, str(ui_path)),
+            )
+
+            if only_pages is None:
+                conn.execute("DELETE FROM highlights WHERE doc_uuid = ?", (doc_uuid,))
+            else:
+                conn.executemany(
+                    "DELETE FROM highlights WHERE doc_uuid = ? AND page_uuid = ?",
+                    [(doc_uuid, page_uuid) for page_uuid in only_pages],
+                )
+
+            conn.executemany(
+                "INSERT INTO highlights(doc_uuid, page_uuid, page, color, text) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (doc_uuid, row["page_uuid"], row["page"], row["color"], row["text"])
+                    for row in hl_rows
+                ],
+            )
+    finally:
+        conn.close()
+
+
+def prune_index(db_path, doc_uuids):
+    """Remove every document that isn't one of `doc_uuids` (i.e. documents
+    that are gone from the library) along with its highlights."""
+
+    conn = open_index(db_path)
+
+    try:
+        with conn:
+            conn.execute("CREATE TEMP TABLE present (uuid TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO present(uuid) VALUES (?)",
+                [(doc_uuid,) for doc_uuid in doc_uuids],
+            )
+
+            gone = [
+                uuid
+                for (uuid,) in conn.execute(
+                    "SELECT uuid FROM documents WHERE uuid NOT IN (SELECT uuid FROM present)"
+                )
+            ]
+            conn.executemany(
+                "DELETE FROM highlights WHERE doc_uuid = ?", [(uuid,) for uuid in gone]
+            )
+            conn.executemany(
+                "DELETE FROM documents WHERE uuid = ?", [(uuid,) for uuid in gone]
+            )
+    finally:
+        conn.close()
+
+    if len(gone) > 0:
+        logging.info(f"- Removed {len(gone)} document(s) that are gone from the highlights index")
+
+    return gone
+
+
+def search_index(db_path, query, limit=100):
+    """Return the highlights matching `query` (FTS5 syntax, e.g. `turing
+    machine`, `"computable numbers"` or `comput*`), best matches first, as
+    (document name, UI path, page, color, text) tuples."""
+
+    conn = open_index(db_path)
+
+    try:
+        return conn.execute(
+            "SELECT d.name, d.ui_path, h.page, h.color, h.text "
+            "FROM highlights_fts JOIN highlights h ON h.id = highlights_fts.rowid "
+            "JOIN documents d ON d.uuid = h.doc_uuid "
+            "WHERE highlights_fts MATCH ? ORDER BY rank LIMIT ?",
+            (query, limit),
+        ).fetchall()
+    finally:
+        conn.close()
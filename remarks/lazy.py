@@ -0,0 +1,25 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Return module `name`, but only actually import it the first time one
+    of its attributes is used. PyMuPDF takes most of remarks' startup time,
+    which is wasted whenever no document ends up being processed (e.g.
+    `--version`, a bad argument, filters that match nothing, etc). See:
+    - https://docs.python.org/3/library/importlib.html#implementing-lazy-imports"""
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
@@ -0,0 +1,111 @@
+import gc
+import logging
+import os
+
+from .lazy import lazy_import
+from .utils import read_meta_file
+from .conversion.templates import share_templates
+
+fitz = lazy_import("fitz")  # PyMuPDF
+
+
+def get_rss():
+    """Current resident set size of this process in bytes, or None where
+    it can't be told."""
+
+    # Linux (and WSL): the second field is the number of resident pages
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+
+    # Elsewhere the best we get is the peak RSS so far (in bytes on macOS,
+    # in kilobytes on the BSDs)
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+def is_over_budget(max_memory_mb):
+    if max_memory_mb is None:
+        return False
+    rss = get_rss()
+    return rss is not None and rss > max_memory_mb * 1024 * 1024
+
+
+def release_memory():
+    # Empty MuPDF's store of decoded resources (images, fonts, etc), it is
+    # the biggest chunk of memory by far on scanned books
+    # - https://pymupdf.readthedocs.io/en/latest/tools.html#Tools.store_shrink
+    fitz.TOOLS.store_shrink(100)
+    read_meta_file.cache_clear()
+    gc.collect()
+
+
+def flush_pdf(doc, path):
+    """Write the pages held by `doc` out to `path` and return the same
+    document reopened from there, so that only what is still needed gets
+    loaded back into memory. Documents flushed before are appended to with
+    an incremental save."""
+
+    if doc.name == str(path) and doc.can_save_incrementally():
+        doc.saveIncr()
+    else:
+        doc.save(str(path))
+    doc.close()
+
+    return fitz.open(str(path))
+
+
+def append_pdf(doc, path, append=True, template_xrefs=None):
+    """Add the pages of `doc` at the end of the PDF file at `path` with an
+    incremental save, i.e. whatever the file already holds stays on disk
+    and never gets loaded. Without `append`, `path` is started over.
+
+    With `template_xrefs`, the file keeps a single copy of each notebook
+    template however many times it gets appended to, see `share_templates`."""
+
+    if not append:
+        if template_xrefs is not None:
+            template_xrefs.clear()
+            share_templates(doc, 0, template_xrefs)
+        doc.save(str(path))
+        return
+
+    out = fitz.open(str(path))
+    from_page = len(out)
+    out.insert_pdf(doc)
+    if template_xrefs is not None:
+        share_templates(out, from_page, template_xrefs)
+    out.saveIncr()
+    out.close()
+
+
+# Over a long run (or `remarks watch`) the budget may be exceeded over and
+# over again, this ensures we say so at most once
+_budget_warning_has_been_shown = False
+
+
+def check_memory_budget(max_memory_mb):
+    """Release whatever can be released once over `max_memory_mb`. Return
+    True if the budget is exceeded, so that callers switch to their own
+    lower-memory strategies too."""
+
+    global _budget_warning_has_been_shown
+
+    if not is_over_budget(max_memory_mb):
+        return False
+
+    if not _budget_warning_has_been_shown:
+        logging.info(
+            f"- Using more than {max_memory_mb} MB of memory, will switch to lower-memory strategies (slower)"
+        )
+        _budget_warning_has_been_shown = True
+
+    release_memory()
+    return True
@@ -0,0 +1,147 @@
+import logging
+
+from .conversion.ocrmypdf import is_executable_available
+from .utils import format_size, list_ann_rm_files, list_hl_json_files, load_json_file
+
+# Rough seconds per unit of work on a laptop, from profiles (--profile) of
+# the demo, the test inputs and synthetic documents (see
+# benchmarks/synthetic.py). Estimates are only ever compared to one another,
+# so being in the right ballpark is all that matters
+COST_PER_DOCUMENT = 0.05
+# Every page gets copied into the combined PDF, annotated or not
+COST_PER_PAGE = 0.002
+COST_PER_ANNOTATED_PAGE = 0.05
+COST_PER_RM_MB = 1.0
+COST_PER_HIGHLIGHT = 0.005
+COST_PER_PDF_MB = 0.02
+# OCRmyPDF runs once per annotated page, and it's slow
+COST_PER_OCR_PAGE = 3.0
+
+# Scanned books weigh a lot more per page than born-digital PDFs do, that's
+# the tell-tale sign that their text won't be extractable without OCR
+SCANNED_BYTES_PER_PAGE = 100 * 1024
+
+
+def get_file_size(path):
+    return path.stat().st_size if path.exists() else 0
+
+
+def estimate_document_cost(
+    doc, ann_type=None, avoid_ocr=False, ocr_available=None, **kwargs
+):
+    """Guess how long processing `doc` (an entry of the collection index)
+    will take, without opening any of its files: only their sizes and the
+    highlights JSON files are looked at. Return the figures the estimate is
+    based on along with it, in "cost" (seconds, roughly)."""
+
+    if ann_type is None:
+        ann_type = ["scribbles", "highlights"]
+
+    metadata_path = doc["metadata_path"]
+    rm_files = list_ann_rm_files(metadata_path)
+    hl_json_files = list_hl_json_files(metadata_path)
+
+    estimate = {
+        "pages": doc["page_count"],
+        "annotated_pages": len(rm_files),
+        "rm_bytes": sum(get_file_size(rm_file) for rm_file in rm_files),
+        "highlights": 0,
+        "pdf_bytes": 0,
+        "ocr": False,
+    }
+
+    if "highlights" in ann_type:
+        for hl_json_file in hl_json_files:
+            try:
+                estimate["highlights"] += len(load_json_file(hl_json_file)["highlights"][0])
+            except (OSError, ValueError, KeyError, IndexError):
+                continue
+
+    if doc["doc_type"] in ["pdf", "epub"]:
+        estimate["pdf_bytes"] = get_file_size(metadata_path.with_suffix(".pdf"))
+
+    # Same conditions as in `render_document`, minus what can't be told
+    # without opening the PDF file (whether its text is extractable)
+    estimate["ocr"] = (
+        doc["doc_type"] == "pdf"
+        and "highlights" in ann_type
+        and len(rm_files) > 0
+        and estimate["pdf_bytes"] > SCANNED_BYTES_PER_PAGE * max(estimate["pages"], 1)
+        and not avoid_ocr
+        and (
+            is_executable_available("ocrmypdf")
+            if ocr_available is None
+            else ocr_available
+        )
+    )
+
+    estimate["cost"] = (
+        COST_PER_DOCUMENT
+        + COST_PER_PAGE * estimate["pages"]
+        + COST_PER_ANNOTATED_PAGE * estimate["annotated_pages"]
+        + COST_PER_RM_MB * estimate["rm_bytes"] / 1024 / 1024
+        + COST_PER_HIGHLIGHT * estimate["highlights"]
+        + COST_PER_PDF_MB * estimate["pdf_bytes"] / 1024 / 1024
+        + (COST_PER_OCR_PAGE * estimate["annotated_pages"] if estimate["ocr"] else 0)
+    )
+
+    return estimate
+
+
+def plan_documents(docs, **kwargs):
+    """Estimate the cost of every document of `docs` and return them as
+    (doc, estimate) tuples, most expensive first. That's the order to hand
+    them out in to parallel workers, if any: started right away, the
+    biggest documents are not left for last, when a single one of them
+    would keep everybody waiting (longest processing time first scheduling).
+    Documents processed one at a time take just as long in any order."""
+
+    # Looked up on PATH once, rather than once per document
+    ocr_available = is_executable_available("ocrmypdf")
+
+    planned = [
+        (doc, estimate_document_cost(doc, ocr_available=ocr_available, **kwargs))
+        for doc in docs
+    ]
+    planned.sort(key=lambda p: p[1]["cost"], reverse=True)
+    return planned
+
+
+def prepare_plan_table(planned):
+    header = ["document", "cost", "pages", "annotated", "rm", "highlights", "pdf", "ocr"]
+    rows = [header]
+
+    for doc, estimate in planned:
+        name = doc["name"] if len(doc["name"]) <= 40 else doc["name"][:37] + "..."
+        rows.append(
+            [
+                name,
+                f"{estimate['cost']:.1f}s",
+                str(estimate["pages"]),
+                str(estimate["annotated_pages"]),
+                format_size(estimate["rm_bytes"]),
+                str(estimate["highlights"]),
+                format_size(estimate["pdf_bytes"]),
+                "yes" if estimate["ocr"] else "no",
+            ]
+        )
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = [
+        "  ".join(
+            cell.ljust(width) if i == 0 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    ]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+
+    return "\n".join(lines)
+
+
+def log_plan(planned):
+    total = sum(estimate["cost"] for _, estimate in planned)
+    logging.info(f"\n{prepare_plan_table(planned)}")
+    logging.info(
+        f"\n{len(planned)} documents, {total:.1f}s of work estimated (most expensive first)"
+    )
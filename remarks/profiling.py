@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+from .memory import get_rss
+from .utils import format_size
+
+# Spans that hold other spans, they're left out of per-document stage totals
+# so that no time gets counted twice
+CONTAINER_SPANS = ["document", "page"]
+
+COUNTERS = ["pages", "strokes", "points", "annots", "bytes_written"]
+
+# Profiling is off unless `start_profiling` is called, and then every span
+# ends up in here. When off, `span` hands out the very same no-op context
+# manager every time, so instrumented code pays next to nothing for it
+_profile = None
+_NO_SPAN = nullcontext()
+
+
+def start_profiling(track_memory=False):
+    """Start recording spans. With `track_memory`, also keep track of the
+    peak RSS and of the peak memory allocated by Python (with tracemalloc,
+    which makes everything quite a bit slower) over each span."""
+
+    global _profile
+    _profile = {
+        "start": time.perf_counter_ns(),
+        "events": [],
+        "documents": [],
+        "document": None,
+        "track_memory": track_memory,
+    }
+
+    if track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop_profiling():
+    global _profile
+    profile, _profile = _profile, None
+
+    if profile is not None and profile["track_memory"]:
+        tracemalloc.stop()
+
+    return profile
+
+
+def is_profiling():
+    return _profile is not None
+
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if _profile["track_memory"]:
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+
+        if _profile["track_memory"]:
+            record_memory(self.name, end)
+
+        # Chrome's trace event format, see:
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/
+        _profile["events"].append(
+            {
+                "name": self.name,
+                "ph": "X",
+                "ts": (self.start - _profile["start"]) / 1000,
+                "dur": (end - self.start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": self.args,
+            }
+        )
+
+        doc = _profile["document"]
+        if doc is not None and self.name not in CONTAINER_SPANS:
+            doc["stages"][self.name] = doc["stages"].get(self.name, 0) + end - self.start
+
+        return False
+
+
+def record_memory(name, end):
+    _, traced_peak = tracemalloc.get_traced_memory()
+    rss = get_rss() or 0
+
+    _profile["events"].append(
+        {
+            "name": "memory",
+            "ph": "C",
+            "ts": (end - _profile["start"]) / 1000,
+            "pid": os.getpid(),
+            "args": {"rss_mb": rss / 2**20, "traced_mb": traced_peak / 2**20},
+        }
+    )
+
+    doc = _profile["document"]
+    if doc is None:
+        return
+
+    memory = doc["memory"]
+    memory["peak_rss"] = max(memory["peak_rss"], rss)
+    if traced_peak > memory["peak_traced"] and name not in CONTAINER_SPANS:
+        memory["peak_traced"] = traced_peak
+        memory["peak_traced_stage"] = name
+
+
+class DocumentSpan(Span):
+    def __enter__(self):
+        self.summary = {
+            "name": self.args["name"],
+            "stages": {},
+            "counts": dict((key, 0) for key in COUNTERS),
+            "total": 0,
+        }
+        if _profile["track_memory"]:
+            self.summary["memory"] = {
+                "peak_rss": 0,
+                "peak_traced": 0,
+                "peak_traced_stage": None,
+            }
+        _profile["documents"].append(self.summary)
+        _profile["document"] = self.summary
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        self.summary["total"] = time.perf_counter_ns() - self.start
+        _profile["document"] = None
+
+        if _profile["track_memory"]:
+            memory = self.summary["memory"]
+            logging.info(
+                f"- Memory: peak RSS of {format_size(memory['peak_rss'])}, peak Python allocations of {format_size(memory['peak_traced'])} (while in '{memory['peak_traced_stage']}')"
+            )
+
+        return False
+
+
+def span(name, **args):
+    if _profile is None:
+        return _NO_SPAN
+    return Span(name, args)
+
+
+def document_span(name):
+    if _profile is None:
+        return _NO_SPAN
+    return DocumentSpan("document", {"name": name})
+
+
+def count(key, n=1):
+    # Callers should check `is_profiling()` first whenever `n` isn't free
+    if _profile is not None and _profile["document"] is not None:
+        _profile["document"]["counts"][key] += n
+
+
+def prepare_summary_table(profile):
+    stages = []
+    for doc in profile["documents"]:
+        for stage in doc["stages"]:
+            if stage not in stages:
+                stages.append(stage)
+
+    header = ["document", "total"] + stages + COUNTERS
+    if profile["track_memory"]:
+        header += ["peak_rss", "peak_traced"]
+    rows = [header]
+
+    for doc in profile["documents"]:
+        name = doc["name"] if len(doc["name"]) <= 40 else doc["name"][:37] + "..."
+        row = (
+            [name, f"{doc['total'] / 1e9:.3f}s"]
+            + [f"{doc['stages'].get(stage, 0) / 1e9:.3f}s" for stage in stages]
+            + [str(doc["counts"][key]) for key in COUNTERS[:-1]]
+            + [format_size(doc["counts"]["bytes_written"])]
+        )
+        if profile["track_memory"]:
+            row += [
+                format_size(doc["memory"]["peak_rss"]),
+                format_size(doc["memory"]["peak_traced"]),
+            ]
+        rows.append(row)
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = [
+        "  ".join(
+            cell.ljust(width) if i == 0 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    ]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+
+    return "\n".join(lines)
+
+
+def summarize_profile():
+    # For runs that only track memory: there is nothing to write, the
+    # per-document numbers have been logged already
+    profile = stop_profiling()
+    if len(profile["documents"]) > 1:
+        logging.info(f"\n{prepare_summary_table(profile)}")
+
+
+def write_profile(trace_path):
+    """Stop profiling and write what was recorded: a Chrome trace (open it
+    with chrome://tracing or https://ui.perfetto.dev) to `trace_path` and a
+    per-document summary table right next to it."""
+
+    profile = stop_profiling()
+    trace_path = pathlib.Path(trace_path)
+
+    with open(trace_path, "w") as f:
+        json.dump(
+            {
+                "traceEvents": profile["events"],
+                "displayTimeUnit": "ms",
+                "otherData": {"documents": profile["documents"]},
+            },
+            f,
+        )
+
+    summary_table = prepare_summary_table(profile)
+    summary_path = trace_path.with_suffix(".summary.txt")
+    with open(summary_path, "w") as f:
+        f.write(summary_table + "\n")
+
+    logging.info(f"\n{summary_table}")
+    logging.info(f'\nWrote profile to "{trace_path}" and "{summary_path}"')
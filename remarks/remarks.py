@@ -1,15 +1,19 @@
 import logging
 import math
+import os
 import pathlib
+import shutil
 import sys
-
-import fitz  # PyMuPDF
+import tempfile
+from dataclasses import dataclass, field
 
 from .conversion.parsing import (
     check_rm_file_version,
     parse_rm_file,
+    apply_erasers,
     rescale_parsed_data,
     get_ann_max_bound,
+    count_strokes_and_points,
 )
 from .conversion.text import (
     check_if_text_extractable,
@@ -23,23 +27,74 @@ from .conversion.ocrmypdf import (
 )
 from .conversion.drawing import (
     draw_annotations_on_pdf,
-    add_smart_highlight_annotations,
+    prepare_annotation_plan,
+    prepare_smart_highlight_plan,
+    apply_annotation_plan,
+)
+from .conversion.templates import show_template
+from .lazy import lazy_import
+from .memory import check_memory_budget, flush_pdf, append_pdf
+from .plan import plan_documents, log_plan
+from .incremental import (
+    get_state_path,
+    load_state,
+    save_state,
+    get_options_fingerprint,
+    get_source_fingerprint,
+    get_pages_fingerprints,
+    get_changed_pages,
+    replace_pdf_pages,
+    merge_modified_pdf,
+    prepare_combined_md,
+    prepare_md_sections,
+    patch_combined_md,
+)
+from .archive import open_input_dir, close_input_dir
+from .index import update_document_index, prune_index
+from .profiling import span, document_span, count, is_profiling
+from .collection import (
+    build_collection_index,
+    filter_collection_index,
+    SUPPORTED_TYPES,
 )
 from .utils import (
-    is_document,
-    get_document_filetype,
     get_visible_name,
     get_ui_path,
     get_pages_data,
+    get_page_templates,
     list_ann_rm_files,
     list_hl_json_files,
     load_json_file,
+    open_pdf,
+    get_shared_size,
     prepare_subdir,
     rescale_given_device_aspect_ratio,
+    save_pdf,
+    pdf_to_bytes,
+    write_file,
+    replace_if_changed,
+    delete_file,
+    get_write_stats,
+    format_write_stats,
+    format_size,
     RM_WIDTH,
     RM_HEIGHT,
 )
 
+fitz = lazy_import("fitz")  # PyMuPDF
+
+# 2x zoom, PDF user space is 72 DPI
+DEFAULT_PNG_DPI = [144]
+
+# PyMuPDF's A4 default is width=595, height=842
+# - https://pymupdf.readthedocs.io/en/latest/document.html#Document.new_page
+# The 0.42 below is just me eye-balling PyMuPDF's defaults:
+# 1404*0.42 ~= 590 and 1872*0.42 ~= 786
+#
+# reMarkable's desktop app exports notebooks to PDF with 445 x 594, in
+# terms of scale it is 445/1404 = ~0.316
+NOTE_PAGE_DIMS = (RM_WIDTH * 0.42, RM_HEIGHT * 0.42)
+
 # TODO: add support to `.textconversion/*.json` files, that's an easy way to
 # start offering some support to handwriting conversion...
 #
@@ -49,61 +104,537 @@ from .utils import (
 
 
 def run_remarks(
-    input_dir, output_dir, file_name=None, file_uuid=None, file_path=None, **kwargs
+    input_dir,
+    output_dir,
+    file_name=None,
+    file_uuid=None,
+    file_path=None,
+    index_db=None,
+    plan=False,
+    **kwargs,
 ):
-    num_docs = sum(1 for _ in pathlib.Path(f"{input_dir}/").glob("*.metadata"))
+    # Either a directory or a tar/zip archive of one, opened only once (and
+    # closed once done with it)
+    input_dir = open_input_dir(input_dir)
+    try:
+        with span("index"):
+            index = build_collection_index(input_dir)
+        num_docs = len(index)
+
+        if num_docs == 0:
+            logging.warning(
+                f'No .metadata files found in "{input_dir}". Are you sure you\'re running remarks on a valid xochitl-like directory? See: https://github.com/lucasrla/remarks#1-copy-remarkables-raw-document-files-to-your-computer'
+            )
+            sys.exit(1)
+
+        # Filters run against the index only, nothing else is opened for
+        # documents that don't match them
+        docs = filter_collection_index(index, file_name, file_uuid, file_path)
 
-    if num_docs == 0:
-        logging.warning(
-            f'No .metadata files found in "{input_dir}". Are you sure you\'re running remarks on a valid xochitl-like directory? See: https://github.com/lucasrla/remarks#1-copy-remarkables-raw-document-files-to-your-computer'
+        if plan:
+            logging.info(
+                f'\nFound {num_docs} documents in "{input_dir}" ({len(docs)} matching your filters), nothing will be processed (--plan)',
+            )
+            with span("plan"):
+                log_plan(plan_documents(docs, **kwargs))
+            return
+
+        logging.info(
+            f'\nFound {num_docs} documents in "{input_dir}" ({len(docs)} matching your filters), will process them now',
+        )
+
+        write_stats = get_write_stats()
+
+        for doc in docs:
+            run_document(doc, output_dir, index_db=index_db, **kwargs)
+
+        if index_db is not None:
+            # Against the whole library, documents left out by filters are
+            # still around
+            prune_index(index_db, [doc["uuid"] for doc in index])
+
+        logging.info(
+            f'\nDone processing "{input_dir}" (output files: {format_write_stats(write_stats)})',
         )
-        sys.exit(1)
+    finally:
+        close_input_dir(input_dir)
 
-    logging.info(
-        f'\nFound {num_docs} documents in "{input_dir}", will process them now',
+
+def run_document(doc, output_dir, **kwargs):
+    if doc["doc_type"] not in SUPPORTED_TYPES:
+        logging.info(
+            f'\nFile skipped: "{doc["name"]}" ({doc["uuid"]}) due to unsupported filetype: {doc["doc_type"]}. remarks only supports: {", ".join(SUPPORTED_TYPES)}'
+        )
+        return False
+
+    logging.info(f'\nFile: "{doc["name"]}.{doc["doc_type"]}" ({doc["uuid"]})')
+
+    out_path = pathlib.Path(f"{output_dir}/{doc['ui_path']}/{doc['name']}/")
+    # print("out_path:", out_path)
+
+    with document_span(doc["name"]):
+        process_document(
+            doc["metadata_path"],
+            out_path,
+            doc["doc_type"],
+            ui_path=doc["ui_path"],
+            **kwargs,
+        )
+    return True
+
+
+@dataclass
+class PageResult:
+    idx: int
+    uuid: str
+    pdf: bytes = None
+    png: bytes = None
+    svg: str = None
+    md: str = None
+    # PNGs at any DPI after the first one of `png_dpi`, e.g. "png_36dpi"
+    extra: dict = field(default_factory=dict)
+
+
+@dataclass
+class DocumentResult:
+    combined_pdf: bytes = None
+    modified_pdf: bytes = None
+    combined_md: str = None
+    # Only filled in for the formats in `per_page_targets`
+    pages: list = field(default_factory=list)
+
+
+def process_document_to_memory(
+    metadata_path,
+    doc_type,
+    title=None,
+    md_header_format="atx",
+    save_profile="compact",
+    png_dpi=None,
+    ann_type=None,
+    **kwargs,
+):
+    """Same as `process_document`, but nothing is written to disk: all
+    outputs are returned in a `DocumentResult` (or None if there is nothing
+    annotated on this document)."""
+
+    if isinstance(metadata_path, str):
+        metadata_path = pathlib.Path(metadata_path)
+    if title is None:
+        title = get_visible_name(metadata_path)
+    if ann_type is None:
+        ann_type = ["scribbles", "highlights"]
+
+    per_page_targets = kwargs.get("per_page_targets") or []
+    pages = []
+
+    def on_page(page):
+        page_result = PageResult(idx=page["idx"], uuid=page["uuid"])
+
+        if "pdf" in per_page_targets:
+            page_result.pdf = pdf_to_bytes(page["work_doc"], save_profile)
+
+        targets = render_page_targets(page, per_page_targets, png_dpi)
+        for fmt, data in targets.items():
+            if hasattr(page_result, fmt):
+                setattr(page_result, fmt, data)
+            else:
+                page_result.extra[fmt] = data
+
+        pages.append(page_result)
+
+    rendering = render_document(
+        metadata_path,
+        doc_type,
+        save_profile=save_profile,
+        on_page=on_page,
+        ann_type=ann_type,
+        **kwargs,
     )
 
-    for metadata_path in pathlib.Path(f"{input_dir}/").glob("*.metadata"):
-        if file_uuid is not None and metadata_path.stem != file_uuid:
-            continue
+    if rendering is None:
+        return None
 
-        if not is_document(metadata_path):
-            continue
+    result = DocumentResult(pages=pages)
 
-        doc_type = get_document_filetype(metadata_path)
-        # Both "Quick Sheets" and "Notebooks" have doc_type="notebook"
-        supported_types = ["pdf", "epub", "notebook"]
+    if rendering["combined_pdf"] is not None:
+        result.combined_pdf = pdf_to_bytes(rendering["combined_pdf"], save_profile)
 
-        doc_name = get_visible_name(metadata_path)
+    if rendering["modified_pdf"] is not None:
+        result.modified_pdf = pdf_to_bytes(rendering["modified_pdf"], save_profile)
 
-        if (file_name and (file_name not in doc_name)) or not doc_name:
-            continue
+    if len(rendering["md_sections"]) > 0:
+        result.combined_md = prepare_combined_md(
+            title, rendering["md_sections"], md_header_format
+        )
 
-        if doc_type in supported_types:
-            logging.info(f'\nFile: "{doc_name}.{doc_type}" ({metadata_path.stem})')
+    close_rendering(rendering)
 
-            in_device_dir = get_ui_path(metadata_path)
-            out_path = pathlib.Path(f"{output_dir}/{in_device_dir}/{doc_name}/")
-            # print("out_path:", out_path)
+    return result
 
-            if file_path is not None and file_path not in str(in_device_dir):
-                continue
 
-            process_document(metadata_path, out_path, doc_type, **kwargs)
+# TODO: review args
+def process_document(
+    metadata_path,
+    out_path,
+    doc_type,
+    md_header_format="atx",
+    incremental=False,
+    save_profile="compact",
+    max_memory_mb=None,
+    png_dpi=None,
+    chunk_size=None,
+    index_db=None,
+    ui_path=None,
+    **kwargs,
+):
+    out_doc_path_str = f"{out_path.parent}/{out_path.name}"
+    # print("out_doc_path_str:", out_doc_path_str)
+
+    per_page_targets = kwargs.get("per_page_targets") or []
+
+    # When patching the outputs of a previous run, `changed_pages` holds the
+    # uuids of pages whose scribbles or highlights changed since then. It is
+    # None whenever everything needs to be (re)built from scratch
+    changed_pages = None
+
+    if incremental:
+        pages_list, _ = get_pages_data(metadata_path)
+
+        state_path = get_state_path(out_path)
+        prev_state = load_state(state_path)
+
+        state = {
+            "pages": pages_list,
+            "templates": get_page_templates(metadata_path),
+            "source": get_source_fingerprint(
+                metadata_path.with_name(f"{metadata_path.stem}.pdf")
+            ),
+            "options": get_options_fingerprint(
+                [kwargs, md_header_format, save_profile, png_dpi]
+                # A new index has to be filled in with every page
+                + ([index_db] if index_db is not None else [])
+            ),
+            "fingerprints": get_pages_fingerprints(
+                list_ann_rm_files(metadata_path), list_hl_json_files(metadata_path)
+            ),
+        }
+
+        expected_outputs = []
+        if kwargs.get("combined_pdf"):
+            expected_outputs.append(f"{out_doc_path_str} _remarks.pdf")
+        if prev_state and prev_state.get("modified_pages"):
+            expected_outputs.append(f"{out_doc_path_str} _remarks-only.pdf")
+        if prev_state and prev_state.get("md_pages"):
+            expected_outputs.append(f"{out_doc_path_str} _highlights.md")
+
+        changed_pages = get_changed_pages(prev_state, state, expected_outputs)
+
+        if changed_pages is None:
+            logging.info("- Incremental update: no usable previous run, will build everything")
+        elif len(changed_pages) == 0:
+            logging.info("- Incremental update: nothing changed since the previous run")
+            return
         else:
             logging.info(
-                f'\nFile skipped: "{doc_name}" ({metadata_path.stem}) due to unsupported filetype: {doc_type}. remarks only supports: {", ".join(supported_types)}'
+                f"- Incremental update: {len(changed_pages)} page(s) changed since the previous run"
             )
 
-    logging.info(
-        f'\nDone processing "{input_dir}"',
+    # (size, seconds) of every PDF file written
+    saved_pdfs = []
+
+    # Absolute paths of every output file of this run, whether its content
+    # changed or not. Whatever else is found where outputs go is stale, see
+    # `prune_outputs`
+    outputs = set()
+    write_stats = get_write_stats()
+
+    def on_page(page):
+        out_path.mkdir(parents=True, exist_ok=True)
+        page_name = f"{page['idx']:0{page['magnitude']}}"
+
+        if "pdf" in per_page_targets:
+            subdir = prepare_subdir(out_path, "pdf")
+            with span("save", file="pdf"):
+                saved_pdfs.append(
+                    save_pdf(
+                        page["work_doc"], f"{subdir}/{page_name}.pdf", save_profile
+                    )
+                )
+            outputs.add(os.path.abspath(f"{subdir}/{page_name}.pdf"))
+
+        targets = render_page_targets(page, per_page_targets, png_dpi)
+        for fmt, data in targets.items():
+            subdir = prepare_subdir(out_path, fmt)
+            file_path = f"{subdir}/{page_name}.{get_target_extension(fmt)}"
+            write_file(file_path, data)
+            outputs.add(os.path.abspath(file_path))
+            if is_profiling():
+                count("bytes_written", os.path.getsize(file_path))
+
+    # Streaming: rather than holding them until the end, write the modified
+    # PDF and the Markdown out `chunk_size` pages at a time, to files that
+    # take their final names once complete. Patching the outputs of a
+    # previous run needs them as a whole, so that's done the usual way
+    stream = None
+    if chunk_size and changed_pages is None:
+        stream = {
+            "pdf_path": f"{out_doc_path_str} _remarks-only.pdf.part",
+            "md_path": f"{out_doc_path_str} _highlights.md.part",
+            "pdf_pages": 0,
+            "md_pages": [],
+            # XObject name -> xref in the streamed PDF, see `share_templates`
+            "template_xrefs": {},
+        }
+
+    def on_chunk(chunk_pdf, md_sections):
+        if chunk_pdf is not None:
+            append_pdf(
+                chunk_pdf,
+                stream["pdf_path"],
+                append=stream["pdf_pages"] > 0,
+                template_xrefs=stream["template_xrefs"],
+            )
+            stream["pdf_pages"] += len(chunk_pdf)
+
+        if len(md_sections) > 0:
+            if len(stream["md_pages"]) == 0:
+                with open(stream["md_path"], "w", encoding="utf-8") as f:
+                    f.write(prepare_combined_md(out_path.name, md_sections, md_header_format))
+            else:
+                with open(stream["md_path"], "a", encoding="utf-8") as f:
+                    f.write(prepare_md_sections(md_sections, md_header_format))
+            stream["md_pages"] += [s[0] for s in md_sections]
+
+    rendering = render_document(
+        metadata_path,
+        doc_type,
+        save_profile=save_profile,
+        only_pages=changed_pages,
+        on_page=on_page,
+        max_memory_mb=max_memory_mb,
+        chunk_size=chunk_size if stream is not None else None,
+        on_chunk=on_chunk if stream is not None else None,
+        **kwargs,
     )
 
+    if index_db is not None:
+        # Documents with nothing left to render lose all their highlights
+        # The collection index knows the folder already, when processing a
+        # whole directory
+        if ui_path is None:
+            ui_path = get_ui_path(metadata_path)
+        with span("index"):
+            update_document_index(
+                index_db,
+                metadata_path.stem,
+                out_path.name,
+                ui_path,
+                rendering["hl_rows"] if rendering is not None else [],
+                only_pages=changed_pages,
+            )
 
-# TODO: review args
-def process_document(
+    if rendering is None:
+        # Nothing left to render, so nothing from a previous run is current
+        prune_outputs(out_doc_path_str, outputs, png_dpi=png_dpi, **kwargs)
+        log_write_stats(write_stats)
+        return
+
+    pdf_src = rendering["combined_pdf"]
+    mod_pdf = rendering["modified_pdf"]
+    combined_md_strs = rendering["md_sections"]
+
+    # Indexes of every page re-rendered in this run, including the ones that
+    # lost all their annotations (and now must look like the original again)
+    if changed_pages is not None:
+        page_idxs = dict(
+            (page_uuid, i) for i, page_uuid in enumerate(rendering["pages_list"])
+        )
+        changed_idxs = set(
+            page_idxs[page_uuid] for page_uuid in changed_pages if page_uuid in page_idxs
+        )
+
+    if pdf_src is not None and changed_pages is not None:
+        with span("save", file="combined_pdf"):
+            saved_pdfs.append(
+                replace_pdf_pages(
+                    f"{out_doc_path_str} _remarks.pdf",
+                    pdf_src,
+                    changed_idxs,
+                    save_profile,
+                )
+            )
+    elif pdf_src is not None:
+        with span("save", file="combined_pdf"):
+            saved_pdfs.append(
+                save_pdf(pdf_src, f"{out_doc_path_str} _remarks.pdf", save_profile)
+            )
+        outputs.add(os.path.abspath(f"{out_doc_path_str} _remarks.pdf"))
+
+    # Page indexes held by the '*_remarks-only.pdf' and '*_highlights.md'
+    # files, these are kept around to patch them in an incremental update
+    modified_pages = []
+    md_pages = []
+
+    if mod_pdf is not None and changed_pages is not None:
+        with span("save", file="modified_pdf"):
+            modified_pages, saved = merge_modified_pdf(
+                f"{out_doc_path_str} _remarks-only.pdf",
+                mod_pdf,
+                prev_state.get("modified_pages", []),
+                rendering["modified_pages"],
+                changed_idxs,
+                save_profile,
+            )
+        if saved is not None:
+            saved_pdfs.append(saved)
+    elif mod_pdf is not None:
+        modified_pages = rendering["modified_pages"]
+        with span("save", file="modified_pdf"):
+            saved_pdfs.append(
+                save_pdf(
+                    mod_pdf, f"{out_doc_path_str} _remarks-only.pdf", save_profile
+                )
+            )
+        outputs.add(os.path.abspath(f"{out_doc_path_str} _remarks-only.pdf"))
+
+    if stream is not None and stream["pdf_pages"] > 0:
+        # A last full save, so that the file looks just like an unstreamed
+        # one (no trail of incremental updates). Pages are copied over from
+        # disk one by one, they're not all loaded at once
+        modified_pages = rendering["modified_pages"]
+        with span("save", file="modified_pdf"):
+            streamed_pdf = fitz.open(stream["pdf_path"])
+            saved_pdfs.append(
+                save_pdf(
+                    streamed_pdf, f"{out_doc_path_str} _remarks-only.pdf", save_profile
+                )
+            )
+            streamed_pdf.close()
+        os.remove(stream["pdf_path"])
+        outputs.add(os.path.abspath(f"{out_doc_path_str} _remarks-only.pdf"))
+
+    if stream is not None and len(stream["md_pages"]) > 0:
+        replace_if_changed(stream["md_path"], f"{out_doc_path_str} _highlights.md")
+        outputs.add(os.path.abspath(f"{out_doc_path_str} _highlights.md"))
+        md_pages = stream["md_pages"]
+
+    if kwargs.get("combined_md") and changed_pages is not None:
+        md_path = f"{out_doc_path_str} _highlights.md"
+        md_page_offset = kwargs.get("md_page_offset", 0)
+        removed_md_pages = set(i + md_page_offset for i in changed_idxs)
+
+        if prev_state.get("md_pages"):
+            patch_combined_md(
+                md_path, combined_md_strs, removed_md_pages, md_header_format
+            )
+        elif len(combined_md_strs) > 0:
+            write_file(
+                md_path,
+                prepare_combined_md(out_path.name, combined_md_strs, md_header_format),
+            )
+
+        md_pages = sorted(
+            set(prev_state.get("md_pages", [])) - removed_md_pages
+            | set(s[0] for s in combined_md_strs)
+        )
+
+    elif kwargs.get("combined_md") and len(combined_md_strs) > 0:
+        combined_md_str = prepare_combined_md(
+            out_path.name, combined_md_strs, md_header_format
+        )
+
+        write_file(f"{out_doc_path_str} _highlights.md", combined_md_str)
+        outputs.add(os.path.abspath(f"{out_doc_path_str} _highlights.md"))
+
+        md_pages = [s[0] for s in combined_md_strs]
+
+    if is_profiling():
+        count("bytes_written", sum(s[0] for s in saved_pdfs))
+        if os.path.exists(f"{out_doc_path_str} _highlights.md"):
+            count("bytes_written", os.path.getsize(f"{out_doc_path_str} _highlights.md"))
+
+    if len(saved_pdfs) > 0:
+        logging.info(
+            f"- Wrote {len(saved_pdfs)} PDF file(s): {format_size(sum(s[0] for s in saved_pdfs))} in {sum(s[1] for s in saved_pdfs):.2f}s (save profile: {save_profile})"
+        )
+
+    if changed_pages is None:
+        prune_outputs(out_doc_path_str, outputs, png_dpi=png_dpi, **kwargs)
+    else:
+        # Combined outputs have been patched already, what's left are the
+        # per-page outputs of pages that are not annotated anymore
+        prune_outputs(
+            out_doc_path_str,
+            outputs,
+            per_page_targets=per_page_targets,
+            png_dpi=png_dpi,
+            only_idxs=changed_idxs,
+        )
+
+    log_write_stats(write_stats)
+
+    if incremental:
+        state["modified_pages"] = modified_pages
+        state["md_pages"] = md_pages
+        save_state(state_path, state)
+
+    close_rendering(rendering)
+
+
+def prune_outputs(
+    out_doc_path_str,
+    outputs,
+    per_page_targets=None,
+    png_dpi=None,
+    only_idxs=None,
+    combined_pdf=False,
+    modified_pdf=False,
+    combined_md=False,
+    **kwargs,
+):
+    """Delete the output files of a previous run that this run didn't
+    produce (i.e. whose absolute paths are not in `outputs`), e.g. the PNG
+    of a page that lost its annotations. With `only_idxs`, only per-page
+    outputs of these page indexes are looked at."""
+
+    if only_idxs is None:
+        for suffix, asked_for in [
+            (" _remarks.pdf", combined_pdf),
+            (" _remarks-only.pdf", modified_pdf),
+            (" _highlights.md", combined_md),
+        ]:
+            path = f"{out_doc_path_str}{suffix}"
+            if asked_for and os.path.abspath(path) not in outputs:
+                delete_file(path)
+
+    fmts = list(per_page_targets or [])
+    if "png" in fmts and png_dpi:
+        fmts += [f"png_{dpi}dpi" for dpi in png_dpi[1:]]
+
+    for fmt in fmts:
+        subdir = pathlib.Path(f"{out_doc_path_str}/{fmt}")
+        if not subdir.is_dir():
+            continue
+
+        for path in subdir.iterdir():
+            # Only files named like our own, e.g. 07.png
+            if not path.stem.isdigit() or path.suffix != f".{get_target_extension(fmt)}":
+                continue
+            if only_idxs is not None and int(path.stem) not in only_idxs:
+                continue
+            if os.path.abspath(path) not in outputs:
+                delete_file(path)
+
+
+def log_write_stats(write_stats):
+    after = get_write_stats()
+    if after != write_stats:
+        logging.info(f"- Output files: {format_write_stats(write_stats, after)}")
+
+
+def render_document(
     metadata_path,
-    out_path,
     doc_type,
     per_page_targets=None,
     ann_type=None,
@@ -114,12 +645,38 @@ def process_document(
     avoid_ocr=False,
     md_hl_format="whole_block",
     md_page_offset=0,
-    md_header_format="atx",
+    save_profile="compact",
+    only_pages=None,
+    on_page=None,
+    max_memory_mb=None,
+    chunk_size=None,
+    on_chunk=None,
+    templates=True,
 ):
+    """Render all annotated pages of a document, without writing anything.
+
+    `on_page` is called with a dict for each annotated page as soon as it is
+    rendered (only when there are `per_page_targets`). Its "work_doc" (only
+    the page itself when "pdf" is one of the targets) and "ann_page" are not
+    to be used afterwards. Return None if there is nothing
+    to render, or a dict holding the combined and modified PDF documents
+    (None if not asked for), the (page number, text) sections of the
+    combined Markdown and every group of highlighted text ("hl_rows", see
+    `update_document_index`). Close them with `close_rendering`.
+
+    Once over `max_memory_mb` (of RSS), caches are dropped and the modified
+    PDF is flushed to a temporary file every page instead of being held in
+    memory as a whole.
+
+    With `chunk_size` and `on_chunk`, the modified PDF and the Markdown
+    sections are handed over to `on_chunk` every `chunk_size` pages (and
+    then dropped) rather than returned, so that they never have to be held
+    in memory as a whole. Pages come in the same order as in the document."""
+
     pages_list, pages_map = get_pages_data(metadata_path)
 
     if len(pages_list) == 0:
-        return
+        return None
 
     pages_magnitude = math.floor(math.log10(len(pages_list))) + 1
 
@@ -132,161 +689,156 @@ def process_document(
         logging.info(
             "- You asked for scribbles, but we couldn't find any of those on this document. Will skip this one"
         )
-        return
+        return None
 
     if ann_type == "highlights" and len(hl_json_files) == 0 and len(ann_rm_files) == 0:
         logging.info(
             "- You asked for highlights, but we couldn't find anything highlighted on this document. Will skip this one"
         )
-        return
+        return None
 
     if len(hl_json_files) == 0 and len(ann_rm_files) == 0:
         logging.info(
             "- Found nothing annotated on this document (no scribbles, no highlights). Will skip this one"
         )
-        return
+        return None
 
-    if combined_md:
-        combined_md_strs = []
+    if modified_pdf and (doc_type == "notebook" and combined_pdf):
+        logging.info(
+            "- You asked for the modified PDF, but we won't bother generated it for this notebook. It would be the same as the combined PDF, which you're already getting anyway"
+        )
+        modified_pdf = False
+
+    if doc_type == "notebook":
+        return render_notebook(
+            metadata_path,
+            pages_list,
+            ann_rm_files,
+            hl_json_files,
+            per_page_targets=per_page_targets,
+            ann_type=ann_type,
+            combined_pdf=combined_pdf,
+            modified_pdf=modified_pdf,
+            combined_md=combined_md,
+            md_hl_format=md_hl_format,
+            md_page_offset=md_page_offset,
+            only_pages=only_pages,
+            on_page=on_page,
+            max_memory_mb=max_memory_mb,
+            chunk_size=chunk_size,
+            on_chunk=on_chunk,
+            templates=templates,
+        )
 
+    combined_md_strs = []
+    # Every group of highlighted text, for the highlights index
+    hl_rows = []
+
+    # Where the modified PDF gets flushed to, if it ever comes to that
+    flush_dir = None
+
+    # Pages rendered since the last chunk was handed over to `on_chunk`
+    chunk_pages = 0
+
+    # Bytes of source resources shared by pages of the modified PDF (rather
+    # than copied once per page), and the size of every object seen so far
+    shared_size = 0
+    object_sizes = {}
+
+    def flush_chunk(mod_pdf, combined_md_strs):
+        has_pages = modified_pdf and len(mod_pdf) > 0
+        with span("flush_chunk"):
+            on_chunk(mod_pdf if has_pages else None, combined_md_strs)
+        if has_pages:
+            mod_pdf.close()
+            mod_pdf = fitz.open()
+            # A new document: new objects, and nothing to share with the
+            # chunk before
+            object_sizes.clear()
+        return mod_pdf, []
+
+    # Stays None without a modified PDF, even when streaming (the Markdown
+    # is streamed all the same)
+    mod_pdf = None
     if modified_pdf:
         mod_pdf = fitz.open()
         pages_order = []
+    # Open the original PDF source document (notebooks have none, see
+    # `render_notebook`)
+    f = metadata_path.with_name(f"{metadata_path.stem}.pdf")
+    with span("open"):
+        pdf_src = open_pdf(f)
+
+    # Blank pages inserted into PDF/EPUBs take the dimensions of their first
+    # page (index=0)
+    blank_page_dims = (pdf_src[0].rect.width, pdf_src[0].rect.height)
+
+    with span("plan"):
+        # For each note page, add a blank page to the original document
+        page_refs = add_blank_pages(pdf_src, pages_map, blank_page_dims)
+
+        page_plan = build_page_plan(
+            pages_list,
+            ann_rm_files,
+            hl_json_files,
+            pdf_src,
+            page_refs,
+            only_pages=only_pages,
+        )
 
-    # PyMuPDF's A4 default is width=595, height=842
-    # - https://pymupdf.readthedocs.io/en/latest/document.html#Document.new_page
-    # The 0.42 below is just me eye-balling PyMuPDF's defaults:
-    # 1404*0.42 ~= 590 and 1872*0.42 ~= 786
-    #
-    # reMarkable's desktop app exports notebooks to PDF with 445 x 594, in
-    # terms of scale it is 445/1404 = ~0.316
-    note_page_dims = (RM_WIDTH * 0.42, RM_HEIGHT * 0.42)
-
-    # Open the original PDF source document
-    if doc_type in ["pdf", "epub"]:
-        f = metadata_path.with_name(f"{metadata_path.stem}.pdf")
-        pdf_src = fitz.open(f)
-
-    # Thanks to @apoorvkh
-    # - https://github.com/lucasrla/remarks/issues/11#issuecomment-1287175782
-    # - https://github.com/apoorvkh/remarks/blob/64dd3b586b96195b00e727fc1f1e537b90d841dc/remarks/remarks.py#L16-L38
-    elif doc_type == "notebook":
-        # Open an empty PDF to be treated as if it were the original document
-        pdf_src = fitz.open()
-
-        # Create its first page according to reMarkable device's aspect ratio
-        pdf_src.new_page(width=note_page_dims[0], height=note_page_dims[1])
-
-        # The mapped value of any first page is always `0`, any other note
-        # pages are always `-1` (including the ones inserted into PDF/EPUBs)
-        pages_map = [0] + [-1 for _ in range(len(pages_list) - 1)]
-
-    # print("pages_list, pages_map", pages_list, pages_map)
-
-    # If this is part of a notebook, use those arbitrary dimensions
-    if doc_type == "notebook":
-        blank_page_dims = note_page_dims
-    # If this is part of an actual PDF/EPUB, use dimensions of its first page
-    # (index=0)
-    else:
-        blank_page_dims = (pdf_src[0].rect.width, pdf_src[0].rect.height)
-
-    # For each note page, add a blank page to the original document
-    for i, page_idx in enumerate(pages_map):
-        if page_idx == -1:
-            pdf_src.new_page(
-                width=blank_page_dims[0],
-                height=blank_page_dims[1],
-                pno=i,
-            )
-
-    pages_to_process = set(
-        [f.stem for f in ann_rm_files] + [f.stem for f in hl_json_files]
-    )
-
-    for page_uuid in pages_to_process:
-        page_idx = pages_list.index(f"{page_uuid}")
-        # print("page_uuid:", page_uuid)
+    for page_task in page_plan:
+        page_idx = page_task["idx"]
+        # print("page_uuid:", page_task["uuid"])
         # print("page_idx", page_idx)
 
-        ann_rm_file = None
-        hl_json_file = None
+        ann_rm_file = page_task["rm_file"]
+        hl_json_file = page_task["json_file"]
 
-        has_ann = False
-        has_smart_hl = False
+        has_ann = ann_rm_file is not None
+        has_smart_hl = hl_json_file is not None
         has_ann_hl = False
 
-        for f in ann_rm_files:
-            if page_uuid == f.stem and check_rm_file_version(f):
-                ann_rm_file = f
-                has_ann = True
-
-        for f in hl_json_files:
-            if page_uuid == f.stem:
-                hl_json_file = f
-                has_smart_hl = True
-
-        # Create a new PDF document to hold the page that will be annotated
-        work_doc = fitz.open()
-
-        # Get document page dimensions and calculate what scale should be
-        # applied to fit it into the device (given the device's own dimensions)
-        pdf_src_dims = (
-            pdf_src.load_page(page_idx).rect.width,
-            pdf_src.load_page(page_idx).rect.height,
-        )
-        pdf_src_dims_downscaled, scale = rescale_given_device_aspect_ratio(
-            pdf_src_dims,
-        )
-        # print("pdf_src_dims:", pdf_src_dims)
-        # print("scale:", scale)
-        # print("pdf_src_dims_downscaled:", pdf_src_dims_downscaled)
-
-        # Create page to annotate using the device's dimensions to allow for
-        # "margin" annotations that would be outside the original doc dimensions
-        device_dims_downscaled = RM_WIDTH * scale, RM_HEIGHT * scale
-        # print("device_dims_downscaled", device_dims_downscaled)
-
-        ann_page = work_doc.new_page(
-            width=device_dims_downscaled[0],
-            height=device_dims_downscaled[1],
-        )
-
-        pdf_src_page_rect = fitz.Rect(
-            0, 0, pdf_src_dims_downscaled[0], pdf_src_dims_downscaled[1]
-        )
+        src_pno = page_task["src_pno"]
+        pdf_src_dims_downscaled = page_task["src_dims_downscaled"]
+        scale = page_task["scale"]
 
-        # This check is necessary because PyMuPDF doesn't let us
-        # "show_pdf_page" from an empty (blank) page
-        # - https://github.com/pymupdf/PyMuPDF/blob/9d2af43230f6d9944734320813acc79abe95d514/fitz/utils.py#L185-L186
-        if len(pdf_src[page_idx].get_contents()) != 0:
-            # Resize content of original page and copy it to the page that will
-            # be annotated
-            ann_page.show_pdf_page(pdf_src_page_rect, pdf_src, pno=page_idx)
+        count("pages")
 
-            # `show_pdf_page()` works as a way to copy and resize content from
-            # one doc/page/rect into another, but unlike `insert_pdf()` it will
-            # not carry over in-PDF links, annotations, etc:
-            # - https://pymupdf.readthedocs.io/en/latest/page.html#Page.show_pdf_page
-            # - https://pymupdf.readthedocs.io/en/latest/document.html#Document.insert_pdf
+        if check_memory_budget(max_memory_mb) and modified_pdf and len(mod_pdf) > 0:
+            with span("flush", page=page_idx):
+                if flush_dir is None:
+                    flush_dir = tempfile.mkdtemp(prefix="remarks-")
+                mod_pdf = flush_pdf(mod_pdf, pathlib.Path(flush_dir) / "modified.pdf")
 
-        is_text_extractable = check_if_text_extractable(
-            pdf_src[page_idx],
-            malformed=assume_malformed_pdfs,
-        )
+        with span("check_text", page=page_idx):
+            is_text_extractable = check_if_text_extractable(
+                pdf_src[src_pno],
+                malformed=assume_malformed_pdfs,
+            )
 
         is_ann_out_page = False
         ann_data = None
 
         if "scribbles" in ann_type and has_ann:
-            parsed_data, has_ann_hl = parse_rm_file(ann_rm_file)
-            # print(parsed_data)
+            with span("parse", page=page_idx):
+                parsed_data, has_ann_hl = parse_rm_file(ann_rm_file)
+                # print(parsed_data)
+
+            with span("erase", page=page_idx):
+                parsed_data = apply_erasers(parsed_data)
 
-            ann_data = rescale_parsed_data(parsed_data, scale)
-            # print(ann_data)
+            with span("parse", page=page_idx):
+                ann_data = rescale_parsed_data(parsed_data, scale)
+                # print(ann_data)
+
+                # Check if there are annotations outside the original page limits
+                x_max, y_max = get_ann_max_bound(ann_data)
+
+            if is_profiling():
+                num_strokes, num_points = count_strokes_and_points(ann_data)
+                count("strokes", num_strokes)
+                count("points", num_points)
 
-            # Check if there are annotations outside the original page limits
-            x_max, y_max = get_ann_max_bound(ann_data)
             is_ann_out_page = (x_max > pdf_src_dims_downscaled[0]) or (
                 y_max > pdf_src_dims_downscaled[1]
             )
@@ -305,179 +857,665 @@ def process_document(
         #
         # TODO: isn't it faster to run ocr through the whole PDF document at
         # once? (as opposed to doing it per page)
-        if (
+        needs_ocr = (
             doc_type == "pdf"
             and "highlights" in ann_type
             and has_ann_hl
             and not is_text_extractable
             and is_executable_available("ocrmypdf")
             and not avoid_ocr
-        ):
+        )
+
+        # Pages of the modified PDF are annotated right where they end up.
+        # PyMuPDF then shows every source page through the very same copies
+        # of its fonts, images, etc, rather than through a fresh copy for
+        # each page. OCR needs a document of its own, though
+        # - https://pymupdf.readthedocs.io/en/latest/page.html#Page.show_pdf_page
+        in_mod_pdf = modified_pdf and (has_ann or has_smart_hl) and not needs_ocr
+
+        if in_mod_pdf:
+            work_doc = mod_pdf
+        else:
+            # Create a new PDF document to hold the page that will be annotated
+            work_doc = fitz.open()
+
+        # Create page to annotate using the device's dimensions to allow for
+        # "margin" annotations that would be outside the original doc dimensions
+        device_dims_downscaled = RM_WIDTH * scale, RM_HEIGHT * scale
+        # print("device_dims_downscaled", device_dims_downscaled)
+
+        ann_page = work_doc.new_page(
+            width=device_dims_downscaled[0],
+            height=device_dims_downscaled[1],
+        )
+
+        pdf_src_page_rect = fitz.Rect(
+            0, 0, pdf_src_dims_downscaled[0], pdf_src_dims_downscaled[1]
+        )
+
+        # This check is necessary because PyMuPDF doesn't let us
+        # "show_pdf_page" from an empty (blank) page
+        # - https://github.com/pymupdf/PyMuPDF/blob/9d2af43230f6d9944734320813acc79abe95d514/fitz/utils.py#L185-L186
+        if len(pdf_src[src_pno].get_contents()) != 0:
+            # Resize content of original page and copy it to the page that will
+            # be annotated
+            with span("show_pdf_page", page=page_idx):
+                xobject_xref = ann_page.show_pdf_page(
+                    pdf_src_page_rect, pdf_src, pno=src_pno
+                )
+
+            if in_mod_pdf:
+                shared_size += get_shared_size(mod_pdf, xobject_xref, object_sizes)
+
+            # `show_pdf_page()` works as a way to copy and resize content from
+            # one doc/page/rect into another, but unlike `insert_pdf()` it will
+            # not carry over in-PDF links, annotations, etc:
+            # - https://pymupdf.readthedocs.io/en/latest/page.html#Page.show_pdf_page
+            # - https://pymupdf.readthedocs.io/en/latest/document.html#Document.insert_pdf
+
+        if needs_ocr:
             logging.warning("- Will run OCRmyPDF on this document. Hold on!")
-            work_doc, ann_page = process_ocr(work_doc)
+            with span("ocr", page=page_idx):
+                work_doc, ann_page = process_ocr(work_doc)
             is_ocred = True
 
-        if has_ann:
-            ann_page = draw_annotations_on_pdf(ann_data, ann_page)
+        # Annotations are worked out once and then applied to every page
+        # they go on: `ann_page` and, for the combined PDF, the original page
+        # (see below). Both show the source page at the same place
+        ann_plan, smart_hl_plan = [], []
+
+        if has_ann and ann_data is not None:
+            with span("draw", page=page_idx):
+                ann_plan = prepare_annotation_plan(ann_data)
+                apply_annotation_plan(ann_plan, ann_page)
 
         # TODO: add ability to extract highlighted images / tables (via pixmaps)?
 
-        ann_hl_groups = []
+        ann_hl_groups, ann_hl_colors = [], []
         if (
             "highlights" in ann_type
             and has_ann_hl
             and (is_text_extractable or is_ocred)
         ):
-            ann_hl_groups = extract_groups_from_pdf_ann_hl(
-                ann_page,
-                malformed=assume_malformed_pdfs,
-            )
+            with span("extract_text", page=page_idx):
+                ann_hl_groups, ann_hl_colors = extract_groups_from_pdf_ann_hl(
+                    ann_page,
+                    malformed=assume_malformed_pdfs,
+                    with_colors=True,
+                )
         elif "highlights" in ann_type and has_ann_hl and doc_type == "pdf":
             logging.info(
                 f"- Found highlights on page #{page_idx} but couldn't extract them to Markdown. Maybe run it through OCRmyPDF next time?"
             )
 
-        smart_hl_groups = []
+        smart_hl_groups, smart_hl_colors = [], []
         if "highlights" in ann_type and has_smart_hl:
-            smart_hl_data = load_json_file(hl_json_file)
-            # print("smart_hl_data", smart_hl_data)
-            ann_page = add_smart_highlight_annotations(smart_hl_data, ann_page, scale)
-            smart_hl_groups = extract_groups_from_smart_hl(smart_hl_data)
+            with span("highlights", page=page_idx):
+                smart_hl_data = load_json_file(hl_json_file)
+                # print("smart_hl_data", smart_hl_data)
+                smart_hl_plan = prepare_smart_highlight_plan(
+                    smart_hl_data, ann_page, scale
+                )
+                apply_annotation_plan(smart_hl_plan, ann_page)
+                smart_hl_groups, smart_hl_colors = extract_groups_from_smart_hl(
+                    smart_hl_data, with_colors=True
+                )
+
+        if is_profiling():
+            count("annots", len(ann_page.annot_xrefs()))
 
         hl_text = ""
         if len(ann_hl_groups + smart_hl_groups) > 0:
-            hl_text = prepare_md_from_hl_groups(
-                ann_page,
-                ann_hl_groups,
-                smart_hl_groups,
-                presentation=md_hl_format,
-            )
+            with span("markdown", page=page_idx):
+                hl_text = prepare_md_from_hl_groups(
+                    ann_page,
+                    ann_hl_groups,
+                    smart_hl_groups,
+                    presentation=md_hl_format,
+                )
 
-        if per_page_targets and (has_ann or has_smart_hl):
-            out_path.mkdir(parents=True, exist_ok=True)
+        for hl_group, color in zip(
+            ann_hl_groups + smart_hl_groups, ann_hl_colors + smart_hl_colors
+        ):
+            hl_rows.append(
+                {
+                    "page_uuid": page_task["uuid"],
+                    "page": page_idx + md_page_offset,
+                    "color": color,
+                    "text": " ".join(hl_group),
+                }
+            )
 
-            if "pdf" in per_page_targets:
-                subdir = prepare_subdir(out_path, "pdf")
-                work_doc.save(f"{subdir}/{page_idx:0{pages_magnitude}}.pdf")
-
-            if "png" in per_page_targets:
-                # (2, 2) is a short-hand for 2x zoom on (x, y)
-                # https://pymupdf.readthedocs.io/en/latest/page.html#Page.get_pixmap
-                ann_pixmap = ann_page.get_pixmap(matrix=fitz.Matrix(2, 2))
-
-                subdir = prepare_subdir(out_path, "png")
-                ann_pixmap.save(f"{subdir}/{page_idx:0{pages_magnitude}}.png")
-
-            if "svg" in per_page_targets:
-                # (2, 2) is a short-hand for 2x zoom on (x, y)
-                # https://pymupdf.readthedocs.io/en/latest/page.html#Page.get_svg_image
-                ann_svg_str = ann_page.get_svg_image(
-                    matrix=fitz.Matrix(2, 2), text_as_path=False
+        if per_page_targets and (has_ann or has_smart_hl) and on_page:
+            page_doc = work_doc
+            if in_mod_pdf and "pdf" in per_page_targets:
+                page_doc = fitz.open()
+                page_doc.insert_pdf(
+                    mod_pdf, from_page=ann_page.number, to_page=ann_page.number
                 )
 
-                subdir = prepare_subdir(out_path, "svg")
-                with open(f"{subdir}/{page_idx:0{pages_magnitude}}.svg", "w") as f:
-                    f.write(ann_svg_str)
+            on_page(
+                {
+                    "idx": page_idx,
+                    "uuid": page_task["uuid"],
+                    "magnitude": pages_magnitude,
+                    "work_doc": page_doc,
+                    "ann_page": ann_page,
+                    "hl_text": hl_text,
+                }
+            )
 
-            if "md" in per_page_targets:
-                subdir = prepare_subdir(out_path, "md")
-                with open(f"{subdir}/{page_idx:0{pages_magnitude}}.md", "w") as f:
-                    f.write(hl_text)
+            if page_doc is not work_doc:
+                page_doc.close()
 
         if modified_pdf and (has_ann or has_smart_hl):
-            mod_pdf.insert_pdf(work_doc, start_at=-1)
+            if not in_mod_pdf:
+                with span("insert_page", page=page_idx):
+                    mod_pdf.insert_pdf(work_doc, start_at=-1)
             pages_order.append(page_idx)
 
         if combined_md and (has_ann_hl or has_smart_hl):
             combined_md_strs += [(page_idx + md_page_offset, hl_text + "\n")]
 
         # If there are annotations outside the original page limits
-        # or if the PDF has been OCRed by us, insert the annotated page
-        # that we've just (re)created from scratch
+        # or if the PDF has been OCRed by us, use the annotated page that
+        # we've just (re)created from scratch in place of the original one.
+        # It's appended for now, pages are put in their final order at once
+        # by `assemble_pdf` below
         if combined_pdf and (is_ann_out_page or is_ocred):
-            pdf_src.insert_pdf(work_doc, start_at=page_idx)
-            pdf_src.delete_page(page_idx + 1)
+            with span("insert_page", page=page_idx):
+                pdf_src.insert_pdf(
+                    work_doc, from_page=ann_page.number, to_page=ann_page.number
+                )
+            page_refs[page_idx] = len(pdf_src) - 1
 
         # Else, draw annotations on the original PDF page (in-place) to do
         # our best to preserve in-PDF links and the original page size
         elif combined_pdf:
-            if has_ann:
-                draw_annotations_on_pdf(
-                    ann_data,
-                    pdf_src[page_idx],
-                    inplace=True,
+            if len(ann_plan) > 0:
+                with span("draw", page=page_idx):
+                    apply_annotation_plan(ann_plan, pdf_src[src_pno])
+
+            # The text searches that placed them on `ann_page` hold here too
+            if len(smart_hl_plan) > 0:
+                with span("highlights", page=page_idx):
+                    apply_annotation_plan(smart_hl_plan, pdf_src[src_pno])
+
+        # Only once the combined PDF is done with it: in the modified PDF,
+        # `work_doc` is the very document that gets flushed (and closed)
+        if on_chunk is not None and chunk_size:
+            chunk_pages += 1
+            if chunk_pages >= chunk_size:
+                mod_pdf, combined_md_strs = flush_chunk(mod_pdf, combined_md_strs)
+                chunk_pages = 0
+
+        if not in_mod_pdf:
+            work_doc.close()
+
+    if on_chunk is not None and chunk_size:
+        mod_pdf, combined_md_strs = flush_chunk(mod_pdf, combined_md_strs)
+        if modified_pdf:
+            mod_pdf.close()
+            mod_pdf = None
+
+    with span("assemble"):
+        assemble_pdf(pdf_src, page_refs)
+
+        if not combined_pdf:
+            pdf_src.close()
+            pdf_src = None
+
+        # Pages are rendered in the same order as they appear in the document
+        # (see `build_page_plan`), so the modified PDF needs no reordering
+        modified_pages = []
+        if modified_pdf:
+            modified_pages = pages_order
+        else:
+            mod_pdf = None
+
+    if shared_size > 0:
+        logging.info(
+            f"- Shared the source's fonts, images, etc between pages of the modified PDF: {format_size(shared_size)} that would have been stored once per page otherwise"
+        )
+
+    return {
+        "pages_list": pages_list,
+        "combined_pdf": pdf_src,
+        "modified_pdf": mod_pdf,
+        "modified_pages": modified_pages,
+        "md_sections": sorted(combined_md_strs, key=lambda t: t[0]),
+        "hl_rows": hl_rows,
+        "flush_dir": flush_dir,
+    }
+
+
+# Notebook support, thanks to @apoorvkh
+# - https://github.com/lucasrla/remarks/issues/11#issuecomment-1287175782
+# - https://github.com/apoorvkh/remarks/blob/64dd3b586b96195b00e727fc1f1e537b90d841dc/remarks/remarks.py#L16-L38
+def render_notebook(
+    metadata_path,
+    pages_list,
+    ann_rm_files,
+    hl_json_files,
+    per_page_targets=None,
+    ann_type=None,
+    combined_pdf=False,
+    modified_pdf=False,
+    combined_md=False,
+    md_hl_format="whole_block",
+    md_page_offset=0,
+    only_pages=None,
+    on_page=None,
+    max_memory_mb=None,
+    chunk_size=None,
+    on_chunk=None,
+    templates=True,
+):
+    """Same as `render_document`, for notebooks. There is no source document
+    to copy pages from nor any text to extract, so the output PDF is built
+    straight from the strokes: one page per notebook page, drawn on once.
+
+    With `combined_pdf`, that PDF holds every page of the notebook. Without
+    it, it only holds annotated pages, i.e. it is the modified PDF.
+
+    With `templates`, pages are laid over their template (lines, grid, etc,
+    see `show_template`), each of them drawn only once."""
+
+    pages_magnitude = math.floor(math.log10(len(pages_list))) + 1
+
+    # All pages share the same dimensions, and so their scale
+    note_page_dims = NOTE_PAGE_DIMS
+    _, scale = rescale_given_device_aspect_ratio(note_page_dims)
+
+    rm_files = dict((f.stem, f) for f in ann_rm_files)
+    json_files = dict((f.stem, f) for f in hl_json_files)
+
+    page_uuids = set(rm_files) | set(json_files)
+    if only_pages is not None:
+        page_uuids &= set(only_pages)
+
+    for page_uuid in page_uuids - set(pages_list):
+        logging.debug(
+            f"- Found annotations for page {page_uuid}, which is not part of this document anymore. Will ignore them"
+        )
+
+    page_templates = get_page_templates(metadata_path) if templates else []
+    # Template name -> its drawing, and XObject name -> xref in `note_pdf`,
+    # see `show_template`
+    template_drawings = {}
+    template_xrefs = {}
+
+    def new_note_page(page_idx):
+        page = note_pdf.new_page(width=note_page_dims[0], height=note_page_dims[1])
+        if page_idx < len(page_templates):
+            with span("template", page=page_idx):
+                show_template(
+                    page, page_templates[page_idx], template_drawings, template_xrefs
                 )
+        return page
+
+    note_pdf = fitz.open()
+    modified_pages = []
+    combined_md_strs = []
+    hl_rows = []
+
+    flush_dir = None
+    chunk_pages = 0
+
+    for page_idx, page_uuid in enumerate(pages_list):
+        ann_rm_file, hl_json_file = None, None
+        if page_uuid in page_uuids:
+            ann_rm_file = rm_files.get(page_uuid)
+            if ann_rm_file is not None and not check_rm_file_version(ann_rm_file):
+                ann_rm_file = None
+            hl_json_file = json_files.get(page_uuid)
+
+        has_ann = ann_rm_file is not None
+        has_smart_hl = hl_json_file is not None
+        has_ann_hl = False
+
+        if not has_ann and not has_smart_hl:
+            if combined_pdf:
+                new_note_page(page_idx)
+            continue
+
+        count("pages")
+
+        if check_memory_budget(max_memory_mb) and not combined_pdf and len(note_pdf) > 0:
+            with span("flush", page=page_idx):
+                if flush_dir is None:
+                    flush_dir = tempfile.mkdtemp(prefix="remarks-")
+                note_pdf = flush_pdf(note_pdf, pathlib.Path(flush_dir) / "modified.pdf")
+
+        ann_page = new_note_page(page_idx)
+
+        if "scribbles" in ann_type and has_ann:
+            with span("parse", page=page_idx):
+                parsed_data, has_ann_hl = parse_rm_file(ann_rm_file)
+
+            with span("erase", page=page_idx):
+                parsed_data = apply_erasers(parsed_data)
+
+            with span("parse", page=page_idx):
+                ann_data = rescale_parsed_data(parsed_data, scale)
 
-            if has_smart_hl:
-                add_smart_highlight_annotations(
-                    smart_hl_data,
-                    pdf_src[page_idx],
-                    scale,
-                    inplace=True,
+            if is_profiling():
+                num_strokes, num_points = count_strokes_and_points(ann_data)
+                count("strokes", num_strokes)
+                count("points", num_points)
+
+            with span("draw", page=page_idx):
+                draw_annotations_on_pdf(ann_data, ann_page, inplace=True)
+
+        if "highlights" not in ann_type and has_ann_hl:
+            logging.info(
+                f"- Found highlighted text on page #{page_idx} but `--ann_type` flag is set to `scribbles` only, so we won't bother with it"
+            )
+
+        # Notebook pages have no text: highlighter strokes are drawn like any
+        # other stroke, and there is nothing for smart highlights to be laid
+        # over. Their text still goes to the Markdown and the index
+        smart_hl_groups, smart_hl_colors = [], []
+        if "highlights" in ann_type and has_smart_hl:
+            with span("highlights", page=page_idx):
+                smart_hl_groups, smart_hl_colors = extract_groups_from_smart_hl(
+                    load_json_file(hl_json_file), with_colors=True
                 )
 
-        work_doc.close()
+        if is_profiling():
+            count("annots", len(ann_page.annot_xrefs()))
 
-    out_doc_path_str = f"{out_path.parent}/{out_path.name}"
-    # print("out_doc_path_str:", out_doc_path_str)
+        hl_text = ""
+        if len(smart_hl_groups) > 0:
+            with span("markdown", page=page_idx):
+                hl_text = prepare_md_from_hl_groups(
+                    ann_page, [], smart_hl_groups, presentation=md_hl_format
+                )
 
-    if combined_pdf:
-        pdf_src.save(f"{out_doc_path_str} _remarks.pdf")
+        for hl_group, color in zip(smart_hl_groups, smart_hl_colors):
+            hl_rows.append(
+                {
+                    "page_uuid": page_uuid,
+                    "page": page_idx + md_page_offset,
+                    "color": color,
+                    "text": " ".join(hl_group),
+                }
+            )
 
-    if modified_pdf and (doc_type == "notebook" and combined_pdf):
-        logging.info(
-            "- You asked for the modified PDF, but we won't bother generated it for this notebook. It would be the same as the combined PDF, which you're already getting anyway"
-        )
-    elif modified_pdf:
-        pages_order = sorted(
-            range(len(pages_order)),
-            key=pages_order.__getitem__,
+        if per_page_targets and on_page:
+            page_doc = None
+            if "pdf" in per_page_targets:
+                page_doc = fitz.open()
+                page_doc.insert_pdf(
+                    note_pdf, from_page=ann_page.number, to_page=ann_page.number
+                )
+
+            on_page(
+                {
+                    "idx": page_idx,
+                    "uuid": page_uuid,
+                    "magnitude": pages_magnitude,
+                    "work_doc": page_doc,
+                    "ann_page": ann_page,
+                    "hl_text": hl_text,
+                }
+            )
+
+            if page_doc is not None:
+                page_doc.close()
+
+        if modified_pdf:
+            modified_pages.append(page_idx)
+
+        if combined_md and (has_ann_hl or has_smart_hl):
+            combined_md_strs += [(page_idx + md_page_offset, hl_text + "\n")]
+
+        if on_chunk is not None and chunk_size:
+            chunk_pages += 1
+            if chunk_pages >= chunk_size:
+                note_pdf, combined_md_strs = flush_notebook_chunk(
+                    note_pdf, combined_md_strs, on_chunk, modified_pdf, template_xrefs
+                )
+                chunk_pages = 0
+
+    if on_chunk is not None and chunk_size:
+        note_pdf, combined_md_strs = flush_notebook_chunk(
+            note_pdf, combined_md_strs, on_chunk, modified_pdf, template_xrefs
         )
-        # print("pages_order:", pages_order)
-        mod_pdf.select(pages_order)
-        mod_pdf.save(f"{out_doc_path_str} _remarks-only.pdf")
-        mod_pdf.close()
 
-    if combined_md and len(combined_md_strs) > 0:
-        combined_md_strs = sorted(combined_md_strs, key=lambda t: t[0])
+    if not combined_pdf and not (modified_pdf and on_chunk is None):
+        note_pdf.close()
+        note_pdf = None
+
+    return {
+        "pages_list": pages_list,
+        "combined_pdf": note_pdf if combined_pdf else None,
+        "modified_pdf": note_pdf if not combined_pdf else None,
+        "modified_pages": modified_pages,
+        "md_sections": combined_md_strs,
+        "hl_rows": hl_rows,
+        "flush_dir": flush_dir,
+    }
 
-        if md_header_format == "atx":
-            combined_md_str = "".join(
-                [f"\n## Page {s[0]}\n\n" + s[1] for s in combined_md_strs]
-            )
-            combined_md_str = f"# {out_path.name}\n" + combined_md_str
 
-        elif md_header_format == "setex":
-            combined_md_str = "".join(
-                [f"\nPage {s[0]}\n--------\n" + s[1] for s in combined_md_strs]
+def flush_notebook_chunk(
+    note_pdf, combined_md_strs, on_chunk, modified_pdf, template_xrefs
+):
+    # Only the modified PDF is ever streamed, a combined one stays whole
+    has_pages = modified_pdf and len(note_pdf) > 0
+    with span("flush_chunk"):
+        on_chunk(note_pdf if has_pages else None, combined_md_strs)
+    if has_pages:
+        note_pdf.close()
+        note_pdf = fitz.open()
+        # Templates are added to the next chunk anew, and `on_chunk` points
+        # them back to those already streamed out
+        template_xrefs.clear()
+    return note_pdf, []
+
+
+def close_rendering(rendering):
+    for key in ["combined_pdf", "modified_pdf"]:
+        if rendering[key] is not None:
+            rendering[key].close()
+
+    if rendering["flush_dir"] is not None:
+        shutil.rmtree(rendering["flush_dir"], ignore_errors=True)
+
+
+def get_target_extension(fmt):
+    # PNGs at extra DPIs ("png_36dpi") go to their own subdirectory, but
+    # they're PNGs all the same
+    return fmt.split("_")[0]
+
+
+def render_page_targets(page, per_page_targets, png_dpi=None):
+    """Per-page outputs that are the same whether they're written to disk or
+    kept in memory. PDFs are left out, they depend on how they're saved.
+
+    PNGs are rendered at every DPI of `png_dpi` (144 by default, i.e. 2x
+    zoom): at the first one as "png", at any other one as "png_<DPI>dpi"."""
+
+    targets = {}
+
+    if png_dpi is None or len(png_dpi) == 0:
+        png_dpi = DEFAULT_PNG_DPI
+
+    # Interpret the page (contents and annotations) just once, into a display
+    # list, and render every PNG and SVG from there
+    # - https://pymupdf.readthedocs.io/en/latest/displaylist.html
+    if "png" in per_page_targets or "svg" in per_page_targets:
+        with span("display_list", page=page["idx"]):
+            display_list = page["ann_page"].get_displaylist()
+
+    if "png" in per_page_targets:
+        for i, dpi in enumerate(png_dpi):
+            # https://pymupdf.readthedocs.io/en/latest/displaylist.html#DisplayList.get_pixmap
+            with span("render_png", page=page["idx"], dpi=dpi):
+                zoom = dpi / 72
+                ann_pixmap = display_list.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+                targets["png" if i == 0 else f"png_{dpi}dpi"] = ann_pixmap.tobytes("png")
+
+    if "svg" in per_page_targets:
+        # (2, 2) is a short-hand for 2x zoom on (x, y)
+        with span("render_svg", page=page["idx"]):
+            targets["svg"] = get_svg_image(
+                display_list, page["ann_page"], fitz.Matrix(2, 2)
             )
-            combined_md_str = f"{out_path.name}\n========\n" + combined_md_str
 
-        with open(f"{out_doc_path_str} _highlights.md", "w") as f:
-            f.write(combined_md_str)
+    if "md" in per_page_targets:
+        targets["md"] = page["hl_text"]
 
-    pdf_src.close()
+    return targets
 
 
-def process_ocr(work_doc):
-    tmp_fname = "_tmp.pdf"
-    work_doc.save(tmp_fname)
+def get_svg_image(display_list, page, matrix):
+    # Same as `page.get_svg_image(matrix, text_as_path=False)`, but run from
+    # `display_list` rather than interpreting the page all over again. That
+    # takes MuPDF's own API, only exposed by PyMuPDF >= 1.24 (as `fitz.mupdf`)
+    # - https://pymupdf.readthedocs.io/en/latest/page.html#Page.get_svg_image
+    # - https://mupdf.readthedocs.io/en/latest/reference/c/fitz/device.html
+    if not hasattr(fitz, "mupdf"):
+        return page.get_svg_image(matrix=matrix, text_as_path=False)
+
+    mupdf = fitz.mupdf
+
+    ctm = mupdf.FzMatrix(matrix.a, matrix.b, matrix.c, matrix.d, matrix.e, matrix.f)
+    bounds = mupdf.fz_transform_rect(
+        mupdf.fz_bound_display_list(display_list.this), ctm
+    )
+
+    buf = mupdf.fz_new_buffer(1024)
+    out = mupdf.FzOutput(buf)
+    dev = mupdf.fz_new_svg_device(
+        out,
+        bounds.x1 - bounds.x0,
+        bounds.y1 - bounds.y0,
+        mupdf.FZ_SVG_TEXT_AS_TEXT,
+        1,  # reuse images
+    )
+    mupdf.fz_run_display_list(
+        display_list.this,
+        dev,
+        ctm,
+        mupdf.FzRect(mupdf.FzRect.Fixed_INFINITE),
+        mupdf.FzCookie(),
+    )
+    mupdf.fz_close_device(dev)
+    out.fz_close_output()
+
+    return mupdf.fz_buffer_extract_copy(buf).decode("utf-8", errors="replace")
+
+
+def add_blank_pages(pdf_src, pages_map, blank_page_dims):
+    # Rather than inserting each note page at its position (which shifts all
+    # the pages after it), append them all and keep track of where each page
+    # should end up: `page_refs[i]` is the page number in `pdf_src` of what
+    # will be the i-th page of the final document
+    orig_pnos = iter(range(len(pdf_src)))
+    page_refs = []
+
+    for page_idx in pages_map:
+        if page_idx == -1:
+            pdf_src.new_page(width=blank_page_dims[0], height=blank_page_dims[1])
+            page_refs.append(len(pdf_src) - 1)
+        else:
+            pno = next(orig_pnos, None)
+            if pno is not None:
+                page_refs.append(pno)
+
+    # Original pages that the redirection map doesn't know about stay last
+    page_refs.extend(orig_pnos)
+
+    return page_refs
+
+
+def assemble_pdf(pdf_src, page_refs):
+    # Put all pages in their final order in a single pass, which also drops
+    # the original pages that got replaced along the way
+    if page_refs != list(range(len(pdf_src))):
+        pdf_src.select(page_refs)
+
+
+def build_page_plan(
+    pages_list, ann_rm_files, hl_json_files, pdf_src, page_refs, only_pages=None
+):
+    # Map page uuids to everything we need to know about them once, so that
+    # each page is a dict lookup away instead of a scan over all files
+    page_idxs = dict((page_uuid, i) for i, page_uuid in enumerate(pages_list))
+    rm_files = dict((f.stem, f) for f in ann_rm_files)
+    json_files = dict((f.stem, f) for f in hl_json_files)
+
+    page_uuids = set(rm_files) | set(json_files)
+
+    if only_pages is not None:
+        page_uuids &= set(only_pages)
+
+    page_plan = []
+
+    for page_uuid in page_uuids:
+        if page_uuid not in page_idxs or page_idxs[page_uuid] >= len(page_refs):
+            logging.debug(
+                f"- Found annotations for page {page_uuid}, which is not part of this document anymore. Will ignore them"
+            )
+            continue
+
+        page_idx = page_idxs[page_uuid]
+
+        rm_file = rm_files.get(page_uuid)
+        if rm_file is not None and not check_rm_file_version(rm_file):
+            rm_file = None
+
+        # Get document page dimensions and calculate what scale should be
+        # applied to fit it into the device (given the device's own dimensions)
+        src_pno = page_refs[page_idx]
+        page_rect = pdf_src[src_pno].rect
+        pdf_src_dims = (page_rect.width, page_rect.height)
+        pdf_src_dims_downscaled, scale = rescale_given_device_aspect_ratio(
+            pdf_src_dims,
+        )
+        # print("pdf_src_dims:", pdf_src_dims)
+        # print("scale:", scale)
+        # print("pdf_src_dims_downscaled:", pdf_src_dims_downscaled)
 
-    # Note that OCRmyPDF does not recognize handwriting (as of Oct 2022)
-    # https://github.com/ocrmypdf/OCRmyPDF/blob/7bd0e43243a05e56a92d6b00fcaa3c826fb3cccd/docs/introduction.rst#L152
-    # "- It is not capable of recognizing handwriting."
-    tmp_fname = run_ocr(tmp_fname)
+        page_plan.append(
+            {
+                "uuid": page_uuid,
+                "idx": page_idx,
+                "src_pno": src_pno,
+                "rm_file": rm_file,
+                "json_file": json_files.get(page_uuid),
+                "src_dims": pdf_src_dims,
+                "src_dims_downscaled": pdf_src_dims_downscaled,
+                "scale": scale,
+            }
+        )
 
-    tmp_doc = fitz.open(tmp_fname)
+    # Work through pages in the same order as they appear in the document
+    return sorted(page_plan, key=lambda page_task: page_task["idx"])
 
-    # Insert the brand new OCRed page as the first one (index=0)
-    work_doc.insert_pdf(tmp_doc, start_at=0)
-    # Delete the non-OCRed page, now in the second position (index=1)
-    work_doc.delete_page(1)
-    # Update ann_page reference to the OCRed page
-    ann_page = work_doc[0]
 
-    tmp_doc.close()
-    pathlib.Path(tmp_fname).unlink()
+def process_ocr(work_doc):
+    # A directory of its own, so that documents OCRed at the same time (e.g.
+    # by `remarks serve` workers) don't step on each other's files
+    with tempfile.TemporaryDirectory(prefix="remarks-ocr-") as tmp_dir:
+        tmp_fname = os.path.join(tmp_dir, "page.pdf")
+        work_doc.save(tmp_fname)
+
+        # Note that OCRmyPDF does not recognize handwriting (as of Oct 2022)
+        # https://github.com/ocrmypdf/OCRmyPDF/blob/7bd0e43243a05e56a92d6b00fcaa3c826fb3cccd/docs/introduction.rst#L152
+        # "- It is not capable of recognizing handwriting."
+        tmp_fname = run_ocr(tmp_fname)
+
+        tmp_doc = fitz.open(tmp_fname)
+
+        # Insert the brand new OCRed page as the first one (index=0)
+        work_doc.insert_pdf(tmp_doc, start_at=0)
+        # Delete the non-OCRed page, now in the second position (index=1)
+        work_doc.delete_page(1)
+        # Update ann_page reference to the OCRed page
+        ann_page = work_doc[0]
+
+        tmp_doc.close()
 
     return work_doc, ann_page
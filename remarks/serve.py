@@ -0,0 +1,398 @@
+import collections
+import io
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import signal
+import tarfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from .archive import open_archive, close_input_dir
+from .collection import build_collection_index, SUPPORTED_TYPES
+from .remarks import process_document_to_memory, get_target_extension
+from .utils import format_size
+
+# Outputs that can be requested with `?outputs=...`, mapped to the options
+# of `process_document_to_memory` that produce them
+OUTPUTS = {
+    "combined_pdf": "combined_pdf",
+    "modified_pdf": "modified_pdf",
+    "combined_md": "combined_md",
+}
+
+CONTENT_TYPES = {
+    ".pdf": "application/pdf",
+    ".md": "text/markdown; charset=utf-8",
+    ".png": "image/png",
+    ".svg": "image/svg+xml",
+}
+
+# Latencies of the last requests, used for the percentiles in `/stats`
+LATENCY_WINDOW = 1000
+
+
+class BadBundleError(ValueError):
+    pass
+
+
+def warm_up_worker():
+    # Let the parent process deal with Ctrl+C, it will tear the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # The whole point of keeping workers around: importing PyMuPDF (which is
+    # only done on first use, see `lazy_import`) and the first document it
+    # opens take a good chunk of a one-off CLI run
+    import fitz  # PyMuPDF
+
+    fitz.open().close()
+
+
+def find_bundle_document(bundle, file_uuid=None):
+    try:
+        # Bundles may or may not wrap the xochitl files in a top-level
+        # directory, `open_archive` finds them either way
+        bundle_dir = open_archive(io.BytesIO(bundle), name="bundle")
+    except (tarfile.TarError, zipfile.BadZipFile, OSError, EOFError) as e:
+        raise BadBundleError(f"Not a tar/zip file: {e}")
+
+    try:
+        doc = pick_bundle_document(bundle_dir, file_uuid)
+    except BaseException:
+        close_input_dir(bundle_dir)
+        raise
+
+    return doc
+
+
+def pick_bundle_document(bundle_dir, file_uuid=None):
+    docs = build_collection_index(bundle_dir)
+    if len(docs) == 0:
+        raise BadBundleError("No document found in bundle")
+
+    if file_uuid is not None:
+        docs = [doc for doc in docs if doc["uuid"] == file_uuid]
+
+    if len(docs) != 1:
+        raise BadBundleError(
+            f"Expected a single document in bundle, found {len(docs)} (use ?uuid=... to pick one)"
+        )
+
+    doc = docs[0]
+    if doc["doc_type"] not in SUPPORTED_TYPES:
+        raise BadBundleError(
+            f"Unsupported filetype: {doc['doc_type']}. remarks only supports: {', '.join(SUPPORTED_TYPES)}"
+        )
+
+    return doc
+
+
+def convert_bundle(bundle, options, file_uuid=None):
+    """Run in a pool worker: convert a tar bundle of a single document and
+    return its outputs as a list of (file name, bytes), named just like
+    `remarks` names them on disk."""
+
+    start = time.perf_counter()
+
+    # Read straight from the bundle, nothing gets extracted to disk
+    doc = find_bundle_document(bundle, file_uuid)
+    try:
+        result = process_document_to_memory(
+            doc["metadata_path"], doc["doc_type"], title=doc["name"], **options
+        )
+    finally:
+        # Closes the whole bundle, everything is in `result` by now
+        close_input_dir(doc["metadata_path"])
+
+    files = []
+
+    if result is not None:
+        name = doc["name"]
+
+        if result.combined_pdf is not None:
+            files.append((f"{name} _remarks.pdf", result.combined_pdf))
+        if result.modified_pdf is not None:
+            files.append((f"{name} _remarks-only.pdf", result.modified_pdf))
+        if result.combined_md is not None:
+            files.append((f"{name} _highlights.md", result.combined_md.encode("utf-8")))
+
+        # Same zero-padding of page numbers as `process_document` uses
+        magnitude = len(str(doc["page_count"]))
+        for page in result.pages:
+            for fmt in options.get("per_page_targets") or []:
+                data = getattr(page, fmt)
+                if data is None:
+                    continue
+                if isinstance(data, str):
+                    data = data.encode("utf-8")
+                files.append((f"{name}/{fmt}/{page.idx:0{magnitude}}.{fmt}", data))
+            for fmt, data in page.extra.items():
+                files.append(
+                    (f"{name}/{fmt}/{page.idx:0{magnitude}}.{get_target_extension(fmt)}", data)
+                )
+
+    return files, time.perf_counter() - start
+
+
+def pack_files(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for file_name, data in files:
+            info = tarfile.TarInfo(file_name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def parse_request_options(query, default_options):
+    params = parse_qs(query)
+    options = dict(default_options)
+
+    if "outputs" in params:
+        outputs = ",".join(params["outputs"]).split(",")
+        unknown = [o for o in outputs if o not in OUTPUTS]
+        if len(unknown) > 0:
+            raise BadBundleError(
+                f"Unknown output(s): {', '.join(unknown)}. Choose from: {', '.join(OUTPUTS)}"
+            )
+        for output, option in OUTPUTS.items():
+            options[option] = output in outputs
+
+    if "per_page_targets" in params:
+        targets = [t for t in ",".join(params["per_page_targets"]).split(",") if t]
+        unknown = [t for t in targets if t not in ["md", "pdf", "png", "svg"]]
+        if len(unknown) > 0:
+            raise BadBundleError(f"Unknown per-page target(s): {', '.join(unknown)}")
+        options["per_page_targets"] = targets
+
+    if "png_dpi" in params:
+        try:
+            options["png_dpi"] = [
+                int(dpi) for dpi in ",".join(params["png_dpi"]).split(",") if dpi
+            ]
+        except ValueError:
+            raise BadBundleError("png_dpi must be a comma-separated list of integers")
+
+    file_uuid = params["uuid"][0] if "uuid" in params else None
+
+    return options, file_uuid
+
+
+class RemarksHandler(BaseHTTPRequestHandler):
+    server_version = "remarks"
+    # Needed to answer "Expect: 100-continue" (curl sends it for any big
+    # upload, and otherwise waits a whole second before sending the body)
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(f"- {self.address_string()} {format % args}")
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, indent=2).encode("utf-8")
+        self.send_body(status, body, "application/json", headers)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            self.send_json(200, self.server.get_stats())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        # The request body is left unread in all early replies below, so the
+        # connection can't be reused
+        if url.path != "/convert":
+            self.send_json(404, {"error": "Not found"}, {"Connection": "close"})
+            return
+
+        if "Content-Length" not in self.headers:
+            self.send_json(
+                411, {"error": "Content-Length is required"}, {"Connection": "close"}
+            )
+            return
+
+        # Never queue more requests than we are willing to, clients should
+        # rather retry later than have their uploads pile up in memory
+        if not self.server.slots.acquire(blocking=False):
+            self.server.record_request(None, rejected=True)
+            logging.info(
+                f"- POST {url.path} 503: already {self.server.max_concurrency} requests in flight"
+            )
+            self.send_json(
+                503,
+                {"error": "Too many requests in flight"},
+                {"Retry-After": "1", "Connection": "close"},
+            )
+            return
+
+        start = time.perf_counter()
+        bundle = b""
+        headers = {}
+        try:
+            bundle = self.rfile.read(int(self.headers["Content-Length"]))
+            options, file_uuid = parse_request_options(
+                url.query, self.server.default_options
+            )
+
+            files, worker_secs = self.server.pool.apply_async(
+                convert_bundle, (bundle, options, file_uuid)
+            ).get()
+
+            headers["Server-Timing"] = (
+                f"total;dur={(time.perf_counter() - start) * 1000:.1f}, convert;dur={worker_secs * 1000:.1f}"
+            )
+
+            if len(files) == 0:
+                # Nothing annotated, hence nothing to return
+                status, body, content_type = 204, b"", "application/octet-stream"
+            elif len(files) == 1:
+                file_name, body = files[0]
+                status = 200
+                content_type = CONTENT_TYPES.get(
+                    pathlib.PurePosixPath(file_name).suffix, "application/octet-stream"
+                )
+                headers["Content-Disposition"] = (
+                    f'attachment; filename="{os.path.basename(file_name)}"'
+                )
+            else:
+                status, body, content_type = 200, pack_files(files), "application/x-tar"
+
+        except BadBundleError as e:
+            status, body, content_type = 400, None, None
+            error = str(e)
+
+        except Exception as e:
+            logging.error(f"- Failed to convert bundle: {e}")
+            status, body, content_type = 500, None, None
+            error = str(e)
+
+        finally:
+            self.server.slots.release()
+
+        latency = time.perf_counter() - start
+        self.server.record_request(latency, failed=status >= 400)
+        logging.info(
+            f"- POST {url.path} {status} in {latency:.2f}s ({format_size(len(bundle))} in, {self.server.in_flight()} in flight)"
+        )
+
+        try:
+            if body is None:
+                self.send_json(status, {"error": error}, headers)
+            else:
+                self.send_body(status, body, content_type, headers)
+        except OSError as e:
+            logging.warning(f"- Could not send response to {self.address_string()}: {e}")
+
+
+class RemarksServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workers, max_concurrency, default_options):
+        # `server_close` gets called already if binding to `address` fails
+        self.pool = None
+        super().__init__(address, RemarksHandler)
+
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.default_options = default_options
+
+        # All workers are started (and warmed up) right away, not on the
+        # first request that needs them
+        self.pool = multiprocessing.Pool(workers, initializer=warm_up_worker)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "failed": 0,
+            "rejected": 0,
+        }
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.started_at = time.time()
+
+    def in_flight(self):
+        # BoundedSemaphore keeps no public count, but `_value` has been there
+        # forever and this is only used for reporting
+        return self.max_concurrency - self.slots._value
+
+    def record_request(self, latency, failed=False, rejected=False):
+        with self.stats_lock:
+            self.stats["requests"] += 1
+            if failed:
+                self.stats["failed"] += 1
+            if rejected:
+                self.stats["rejected"] += 1
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+            latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if len(latencies) == 0:
+                return None
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)], 4)
+
+        stats.update(
+            {
+                "workers": self.workers,
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight(),
+                "uptime": round(time.time() - self.started_at, 1),
+                "latency_p50": percentile(0.5),
+                "latency_p95": percentile(0.95),
+                "latency_max": round(latencies[-1], 4) if latencies else None,
+            }
+        )
+        return stats
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+
+def make_server(host="127.0.0.1", port=8000, workers=None, max_concurrency=None, **kwargs):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_concurrency is None:
+        max_concurrency = workers
+
+    return RemarksServer((host, port), workers, max_concurrency, kwargs)
+
+
+def run_serve(host="127.0.0.1", port=8000, workers=None, max_concurrency=None, **kwargs):
+    server = make_server(host, port, workers, max_concurrency, **kwargs)
+    host, port = server.server_address[:2]
+
+    logging.info(
+        f"\nServing on http://{host}:{port} ({server.workers} workers, up to {server.max_concurrency} requests at a time)"
+    )
+    logging.info(
+        f"- POST a tar bundle of a document to http://{host}:{port}/convert, see http://{host}:{port}/stats for latencies"
+    )
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info(f"\nStopped serving on http://{host}:{port}")
+    finally:
+        server.server_close()
@@ -1,5 +1,22 @@
 import remarks
+import io
+import json
+import logging
 import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import urllib.request
+
+import fitz  # PyMuPDF
+
+from remarks.watch import run_watch
+from remarks.serve import make_server
+from remarks.profiling import start_profiling, write_profile
 
 
 def test_can_process_demo_with_default_args():
@@ -39,3 +56,638 @@ def test_can_handle_drawing_with_many_scribbles():
     remarks.run_remarks("tests/in/v2_notebook_complex", "tests/out", **initial_args)
 
     assert os.path.isfile("tests/out/Gosper _remarks.pdf")
+
+
+def test_incremental_run_leaves_unchanged_outputs_alone():
+    initial_args = {
+        'file_name': None,
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': True,
+        'combined_md': True,
+        'modified_pdf': True,
+        'md_hl_format': 'whole_block',
+        'md_page_offset': 0,
+        'md_header_format': 'atx',
+        'per_page_targets': [],
+        'assume_malformed_pdfs': False,
+        'avoid_ocr': False,
+        'incremental': True
+    }
+    os.makedirs("tests/out/incremental", exist_ok=True)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/incremental", **initial_args)
+
+    out_pdf = "tests/out/incremental/1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing _remarks.pdf"
+    assert os.path.isfile(out_pdf)
+    assert os.path.isfile("tests/out/incremental/.1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing.remarks-state.json")
+
+    mtime = os.path.getmtime(out_pdf)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/incremental", **initial_args)
+    assert os.path.getmtime(out_pdf) == mtime
+
+
+def get_pdf_annotations(path):
+    with fitz.open(path) as doc:
+        return [
+            sorted((annot.type[1], tuple(round(c, 2) for c in annot.rect)) for annot in page.annots())
+            for page in doc
+        ]
+
+
+def test_incremental_run_matches_a_full_rebuild(caplog):
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': True,
+        'combined_md': True,
+        'modified_pdf': True,
+    }
+    shutil.rmtree("tests/out/incremental_patch", ignore_errors=True)
+    shutil.copytree("demo/on-computable-numbers/xochitl", "tests/out/incremental_patch/in")
+    for out_dir in ["incremental", "full"]:
+        os.makedirs(f"tests/out/incremental_patch/{out_dir}")
+
+    remarks.run_remarks("tests/out/incremental_patch/in", "tests/out/incremental_patch/incremental", incremental=True, **args)
+
+    # Page #27 gets the scribbles (and highlighter strokes) of page #1
+    rm_dir = pathlib.Path("tests/out/incremental_patch/in/d3954b55-8429-4220-a2d5-64f1daab9727")
+    shutil.copyfile(rm_dir / "3e38ed38-08b7-42d2-8bbe-fa8b936b4a45.rm", rm_dir / "a8cee983-7203-4218-a1af-e2f4fcf3d073.rm")
+
+    with caplog.at_level(logging.INFO):
+        remarks.run_remarks("tests/out/incremental_patch/in", "tests/out/incremental_patch/incremental", incremental=True, **args)
+    assert "1 page(s) changed since the previous run" in caplog.text
+
+    remarks.run_remarks("tests/out/incremental_patch/in", "tests/out/incremental_patch/full", **args)
+
+    name = "1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing"
+    for suffix in [" _remarks.pdf", " _remarks-only.pdf"]:
+        patched = get_pdf_annotations(f"tests/out/incremental_patch/incremental/{name}{suffix}")
+        rebuilt = get_pdf_annotations(f"tests/out/incremental_patch/full/{name}{suffix}")
+        assert patched == rebuilt
+
+    with open(f"tests/out/incremental_patch/incremental/{name} _highlights.md") as f1, open(f"tests/out/incremental_patch/full/{name} _highlights.md") as f2:
+        assert f1.read() == f2.read()
+
+
+def test_watch_processes_nothing_when_nothing_changes():
+    initial_args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': True,
+        'combined_md': True,
+        'per_page_targets': [],
+    }
+    stats = run_watch("demo/on-computable-numbers/xochitl", "tests/out", poll_interval=0, debounce=0, max_rounds=2, **initial_args)
+
+    assert stats["processed"] == 0
+    assert stats["queue_depth"] == 0
+
+
+def test_watch_processes_a_document_once_it_settles_down(monkeypatch):
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': True,
+        'combined_md': True,
+        'per_page_targets': [],
+    }
+    shutil.rmtree("tests/out/watch_sync", ignore_errors=True)
+    shutil.copytree("demo/on-computable-numbers/xochitl", "tests/out/watch_sync/in")
+    os.makedirs("tests/out/watch_sync/out")
+
+    doc_uuid = "d3954b55-8429-4220-a2d5-64f1daab9727"
+    rm_dir = pathlib.Path(f"tests/out/watch_sync/in/{doc_uuid}")
+    name = "1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing"
+    out_pdf = f"tests/out/watch_sync/out/{name} _remarks.pdf"
+
+    def sync_page_while_waiting(src_page):
+        # A sync lands during the first round: page #27 gets the scribbles
+        # of another page
+        synced = []
+
+        def wait_for_changes(inotify, timeout):
+            if len(synced) == 0:
+                shutil.copyfile(rm_dir / f"{src_page}.rm", rm_dir / "a8cee983-7203-4218-a1af-e2f4fcf3d073.rm")
+                synced.append(src_page)
+            time.sleep(timeout)
+
+        monkeypatch.setattr("remarks.watch.wait_for_changes", wait_for_changes)
+
+    # The document is still settling down when the watch is over
+    sync_page_while_waiting("3e38ed38-08b7-42d2-8bbe-fa8b936b4a45")
+    stats = run_watch("tests/out/watch_sync/in", "tests/out/watch_sync/out", poll_interval=0, debounce=60, max_rounds=3, **args)
+    assert stats["processed"] == 0
+    assert stats["queue_depth"] == 1
+
+    annotations = get_pdf_annotations(out_pdf)[27]
+
+    # Once the debounce passes, it gets processed
+    sync_page_while_waiting("bd1287ac-b54f-4024-a117-020194385543")
+    stats = run_watch("tests/out/watch_sync/in", "tests/out/watch_sync/out", poll_interval=0.05, debounce=0.1, max_rounds=6, **args)
+    assert stats["processed"] == 1
+    assert stats["failed"] == 0
+    assert stats["queue_depth"] == 0
+    assert stats["last_processed"] == doc_uuid
+    assert get_pdf_annotations(out_pdf)[27] != annotations
+    assert get_pdf_annotations(out_pdf)[27] == get_pdf_annotations(out_pdf)[0]
+
+
+def test_can_process_demo_from_archive():
+    os.makedirs("tests/out/archive", exist_ok=True)
+    with tarfile.open("tests/out/archive/xochitl.tar.gz", "w:gz") as tar:
+        tar.add("demo/on-computable-numbers/xochitl", arcname="xochitl")
+
+    remarks.run_remarks(
+        "tests/out/archive/xochitl.tar.gz",
+        "tests/out/archive",
+        ann_type=['scribbles', 'highlights'],
+        combined_pdf=True,
+        combined_md=True,
+    )
+
+    assert os.path.isfile("tests/out/archive/1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing _remarks.pdf")
+    assert os.path.isfile("tests/out/archive/1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing _highlights.md")
+
+    # The archive is closed once the run is over
+    if os.path.isdir("/proc/self/fd"):
+        open_files = [os.path.realpath(f"/proc/self/fd/{fd}") for fd in os.listdir("/proc/self/fd")]
+        assert os.path.realpath("tests/out/archive/xochitl.tar.gz") not in open_files
+
+
+def test_can_process_document_to_memory():
+    result = remarks.process_document_to_memory(
+        "demo/on-computable-numbers/xochitl/d3954b55-8429-4220-a2d5-64f1daab9727.metadata",
+        "pdf",
+        ann_type=['scribbles', 'highlights'],
+        combined_pdf=True,
+        combined_md=True,
+        per_page_targets=['png', 'md'],
+    )
+
+    assert result.combined_pdf.startswith(b"%PDF")
+    assert result.modified_pdf is None
+    assert result.combined_md.startswith("# 1936 On Computable Numbers")
+    assert [p.idx for p in result.pages] == [0, 1, 27]
+    assert all(p.png.startswith(b"\x89PNG") and p.pdf is None for p in result.pages)
+
+    # Both types of annotations by default, same as the CLI
+    result = remarks.process_document_to_memory(
+        "demo/on-computable-numbers/xochitl/d3954b55-8429-4220-a2d5-64f1daab9727.metadata",
+        "pdf",
+        combined_md=True,
+    )
+    assert result.combined_md.startswith("# 1936 On Computable Numbers")
+
+
+def test_can_render_pngs_at_several_dpis():
+    result = remarks.process_document_to_memory(
+        "demo/on-computable-numbers/xochitl/d3954b55-8429-4220-a2d5-64f1daab9727.metadata",
+        "pdf",
+        ann_type=['scribbles', 'highlights'],
+        per_page_targets=['png', 'svg'],
+        png_dpi=[144, 36],
+    )
+
+    for page in result.pages:
+        full_size = fitz.Pixmap(page.png)
+        thumbnail = fitz.Pixmap(page.extra["png_36dpi"])
+        assert abs(full_size.width - 4 * thumbnail.width) <= 4
+        assert page.svg.startswith("<svg")
+
+
+def test_serve_converts_a_bundle():
+    bundle = io.BytesIO()
+    with tarfile.open(fileobj=bundle, mode="w") as tar:
+        tar.add("demo/on-computable-numbers/xochitl", arcname="xochitl")
+
+    server = make_server(
+        port=0,
+        workers=1,
+        ann_type=['scribbles', 'highlights'],
+        combined_pdf=True,
+        combined_md=True,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/convert?outputs=combined_md"
+        with urllib.request.urlopen(url, data=bundle.getvalue()) as response:
+            assert response.status == 200
+            assert response.read().startswith(b"# 1936 On Computable Numbers")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_profile_records_stages_of_each_document():
+    os.makedirs("tests/out/profile", exist_ok=True)
+
+    start_profiling()
+    remarks.run_remarks(
+        "demo/on-computable-numbers/xochitl",
+        "tests/out/profile",
+        ann_type=['scribbles', 'highlights'],
+        combined_pdf=True,
+        combined_md=True,
+    )
+    write_profile("tests/out/profile/trace.json")
+
+    with open("tests/out/profile/trace.json") as f:
+        trace = json.load(f)
+
+    span_names = set(e["name"] for e in trace["traceEvents"])
+    assert {"index", "document", "parse", "draw", "save"} <= span_names
+
+    [doc] = trace["otherData"]["documents"]
+    assert doc["counts"]["pages"] == 3
+    assert doc["counts"]["strokes"] > 0 and doc["counts"]["bytes_written"] > 0
+    assert os.path.isfile("tests/out/profile/trace.summary.txt")
+
+
+def test_max_memory_mb_still_writes_every_output():
+    os.makedirs("tests/out/memory", exist_ok=True)
+
+    # Any process is over 1 MB, so the modified PDF gets flushed every page
+    start_profiling(track_memory=True)
+    remarks.run_remarks(
+        "demo/on-computable-numbers/xochitl",
+        "tests/out/memory",
+        ann_type=['scribbles', 'highlights'],
+        combined_pdf=True,
+        combined_md=True,
+        modified_pdf=True,
+        max_memory_mb=1,
+    )
+    write_profile("tests/out/memory/trace.json")
+
+    with open("tests/out/memory/trace.json") as f:
+        trace = json.load(f)
+
+    assert "flush" in set(e["name"] for e in trace["traceEvents"])
+    [doc] = trace["otherData"]["documents"]
+    assert doc["memory"]["peak_rss"] > 1024 * 1024
+
+    out_doc_path_str = "tests/out/memory/1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing"
+    with fitz.open(f"{out_doc_path_str} _remarks-only.pdf") as mod_pdf:
+        assert len(mod_pdf) == 3
+    assert os.path.isfile(f"{out_doc_path_str} _highlights.md")
+
+
+def test_importing_remarks_does_not_import_pymupdf():
+    # Run in a fresh interpreter, PyMuPDF is long imported in this one
+    code = "import sys, remarks.__main__; assert 'pymupdf' not in sys.modules and 'shapely' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_streamed_outputs_are_the_same():
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': False,
+        'combined_md': True,
+        'modified_pdf': True,
+    }
+    os.makedirs("tests/out/whole", exist_ok=True)
+    os.makedirs("tests/out/stream", exist_ok=True)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/whole", **args)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/stream", chunk_size=1, **args)
+
+    name = "1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing"
+    with open(f"tests/out/whole/{name} _highlights.md") as f1, open(f"tests/out/stream/{name} _highlights.md") as f2:
+        assert f1.read() == f2.read()
+
+    with fitz.open(f"tests/out/whole/{name} _remarks-only.pdf") as doc1, fitz.open(f"tests/out/stream/{name} _remarks-only.pdf") as doc2:
+        assert [p.get_text() for p in doc1] == [p.get_text() for p in doc2]
+        assert [len(p.annot_xrefs()) for p in doc1] == [len(p.annot_xrefs()) for p in doc2]
+
+    assert not os.path.exists(f"tests/out/stream/{name} _remarks-only.pdf.part")
+
+
+def test_streaming_with_default_outputs():
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': True,
+        'combined_md': True,
+        'modified_pdf': False,
+    }
+    os.makedirs("tests/out/stream_default", exist_ok=True)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/stream_default", chunk_size=1, **args)
+
+    name = "1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing"
+    assert os.path.isfile(f"tests/out/stream_default/{name} _remarks.pdf")
+    assert os.path.isfile(f"tests/out/stream_default/{name} _highlights.md")
+    assert not os.path.exists(f"tests/out/stream_default/{name} _remarks-only.pdf")
+
+
+def test_streaming_with_every_pdf_output():
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': True,
+        'combined_md': True,
+        'modified_pdf': True,
+    }
+    os.makedirs("tests/out/stream_all", exist_ok=True)
+    os.makedirs("tests/out/whole_all", exist_ok=True)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/whole_all", **args)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/stream_all", chunk_size=1, **args)
+
+    # The demo has ink outside of its pages, so those pages are copied from
+    # the modified PDF into the combined one
+    name = "1936 On Computable Numbers, with an Application to the Entscheidungsproblem - A. M. Turing"
+    for suffix in [" _remarks.pdf", " _remarks-only.pdf"]:
+        with fitz.open(f"tests/out/whole_all/{name}{suffix}") as doc1, fitz.open(f"tests/out/stream_all/{name}{suffix}") as doc2:
+            assert [len(p.annot_xrefs()) for p in doc1] == [len(p.annot_xrefs()) for p in doc2]
+
+
+def test_pages_shown_from_the_same_source_share_its_resources():
+    src = fitz.open("demo/on-computable-numbers/xochitl/d3954b55-8429-4220-a2d5-64f1daab9727.pdf")
+    doc = fitz.open()
+    object_sizes = {}
+
+    shared_sizes = []
+    for _ in range(2):
+        page = doc.new_page()
+        xref = page.show_pdf_page(page.rect, src, pno=0)
+        shared_sizes.append(remarks.utils.get_shared_size(doc, xref, object_sizes))
+
+    assert shared_sizes[0] == 0 and shared_sizes[1] > 0
+
+
+def test_export_writes_every_stroke_in_batches():
+    from remarks.export import run_export
+    import numpy as np
+
+    os.makedirs("tests/out/export", exist_ok=True)
+    num_rows = run_export("demo/on-computable-numbers/xochitl", "tests/out/export", batch_size=10)
+
+    # Batches are written between pages, 10 strokes or more each
+    batch_paths = sorted(pathlib.Path("tests/out/export").glob("strokes-*.npz"))
+    batches = [np.load(path) for path in batch_paths]
+    assert len(batches) > 1
+    assert num_rows["strokes"] == sum(len(b["tool"]) for b in batches) == 34
+
+    for b in batches:
+        assert b["offsets"][0] == 0 and b["offsets"][-1] == len(b["points"])
+        assert len(b["offsets"]) == len(b["doc_uuid"]) + 1
+    assert set(batches[0]["doc_uuid"]) == {"d3954b55-8429-4220-a2d5-64f1daab9727"}
+
+
+def test_smart_highlights_without_start_or_length():
+    from remarks.conversion.text import extract_groups_from_smart_hl
+    from remarks.export import new_batch, add_document_highlights, HIGHLIGHT_COLUMNS
+
+    def hl_data():
+        return {"highlights": [[
+            {"text": "numbers", "start": 14, "length": 7, "rects": []},
+            {"text": "On computable", "rects": []},
+        ]]}
+
+    # Sorted first, then grouped with the next one as usual
+    assert extract_groups_from_smart_hl(hl_data()) == [["On computable", "numbers"]]
+
+    batch = new_batch(HIGHLIGHT_COLUMNS)
+    add_document_highlights(batch, "doc", "page", 0, hl_data())
+    assert batch["start"] == [14, -1] and batch["length"] == [7, 13]
+
+
+def test_highlights_index_is_updated_in_place():
+    from remarks.index import search_index, update_document_index
+
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': False,
+        'combined_md': True,
+        'md_page_offset': 1,
+        'index_db': "tests/out/index/highlights.sqlite",
+    }
+    os.makedirs("tests/out/index", exist_ok=True)
+    if os.path.exists(args["index_db"]):
+        os.remove(args["index_db"])
+
+    # A document that isn't part of the library (anymore)
+    update_document_index(args["index_db"], "gone", "Gone", "", [{"page_uuid": "p", "page": 1, "color": "yellow", "text": "Church"}])
+
+    for _ in range(2):
+        remarks.run_remarks("demo/on-computable-numbers/xochitl", "tests/out/index", **args)
+
+    [(name, _, page, color, text)] = search_index(args["index_db"], "church")
+    assert name.startswith("1936 On Computable Numbers")
+    assert page == 2 and color == "yellow"
+    assert text.startswith("Church also reaches similar conclusions")
+
+
+def test_malformed_pdf_words_are_grouped_by_visual_line():
+    from remarks.conversion.text import extract_groups_from_pdf_ann_hl
+
+    doc = fitz.open()
+    page = doc.new_page()
+    lines = [["first", "line", "of", "words"], ["second", "line", "here"]]
+
+    # Baselines a bit off within each line, as on scanned pages
+    for i, words in enumerate(lines):
+        x = 72
+        for k, word in enumerate(words):
+            page.insert_text((x, 100 + 20 * i + (k % 2) * 0.7), word, fontsize=11)
+            x += fitz.get_text_length(word + " ", fontsize=11)
+        page.add_highlight_annot(fitz.Rect(70, 88 + 20 * i, x, 103 + 20 * i))
+
+    assert extract_groups_from_pdf_ann_hl(page, malformed=True) == lines
+
+
+def test_erasers_clip_and_drop_earlier_strokes():
+    from remarks.conversion.parsing import apply_erasers
+
+    def stroke(index, points, width="2.000"):
+        style = {"opacity": "1.000", "stroke-width": width, "color-code": 0}
+        return {"style": style, "index": index, "points": [[(f"{x:.3f}", f"{y:.3f}") for x, y in points]]}
+
+    parsed_data = {"layers": [{"strokes": {
+        "Ballpoint_15": {"segments": [
+            stroke(0, [(0, 0), (100, 0)]),
+            stroke(1, [(0, 50), (10, 50)]),
+            # After the eraser, so left alone
+            stroke(3, [(0, 10), (100, 10)]),
+        ]},
+        "Eraser_6": {"segments": [stroke(2, [(50, -20), (50, 20)], width="10.000")]},
+        "EraseArea_8": {"segments": [stroke(4, [(-5, 45), (20, 45), (20, 55), (-5, 55)])]},
+    }}]}
+
+    [layer] = apply_erasers(parsed_data)["layers"]
+    assert list(layer["strokes"]) == ["Ballpoint_15"]
+
+    [clipped, untouched] = layer["strokes"]["Ballpoint_15"]["segments"]
+    assert [[float(p[0]) for p in piece] for piece in clipped["points"]] == [[0, 45], [55, 100]]
+    assert untouched["points"] == [[("0.000", "10.000"), ("100.000", "10.000")]]
+
+
+def test_unchanged_outputs_are_not_rewritten():
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': True,
+        'combined_md': True,
+        'modified_pdf': True,
+        'per_page_targets': ['pdf', 'png'],
+    }
+    out_dir = pathlib.Path("tests/out/unchanged")
+    os.makedirs(out_dir, exist_ok=True)
+
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", out_dir, **args)
+    outputs = [p for p in out_dir.rglob("*") if p.is_file()]
+
+    # Left over by a previous run, e.g. a page that lost its annotations
+    stale_path = next(out_dir.rglob("png")) / "99.png"
+    stale_path.write_bytes(b"")
+
+    before = dict((p, (p.read_bytes(), p.stat().st_mtime_ns)) for p in outputs)
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", out_dir, **args)
+
+    assert not stale_path.exists()
+    assert dict((p, (p.read_bytes(), p.stat().st_mtime_ns)) for p in outputs) == before
+
+
+def test_plan_puts_most_expensive_documents_first():
+    from remarks.plan import plan_documents
+
+    index = remarks.build_collection_index("demo/on-computable-numbers/xochitl")
+    [(doc, estimate)] = plan_documents(index)
+    assert estimate["annotated_pages"] > 0 and estimate["cost"] > 0
+
+    # Same document, bigger and bigger
+    docs = [dict(doc, page_count=n) for n in [10, 1000, 100]]
+    planned = plan_documents(docs)
+    assert [d["page_count"] for d, _ in planned] == [1000, 100, 10]
+
+    out_dir = pathlib.Path("tests/out/plan")
+    remarks.run_remarks("demo/on-computable-numbers/xochitl", out_dir, plan=True)
+    assert not out_dir.exists()
+
+
+def test_notebook_outputs_hold_one_page_per_notebook_page():
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'per_page_targets': ['pdf'],
+    }
+
+    result = remarks.process_document_to_memory(
+        pathlib.Path("tests/in/v2_notebook_complex/bce041cf-ce31-4ede-ad11-2e53db0f6c77.metadata"),
+        "notebook",
+        combined_pdf=True,
+        **args,
+    )
+    combined_pdf = fitz.open(stream=result.combined_pdf, filetype="pdf")
+    assert len(combined_pdf) == 3
+    assert len(result.pages) > 0
+    for page in result.pages:
+        assert len(combined_pdf[page.idx].get_drawings()) > 0
+
+    result = remarks.process_document_to_memory(
+        pathlib.Path("tests/in/v2_notebook_complex/bce041cf-ce31-4ede-ad11-2e53db0f6c77.metadata"),
+        "notebook",
+        modified_pdf=True,
+        **args,
+    )
+    assert result.combined_pdf is None
+    assert len(fitz.open(stream=result.modified_pdf, filetype="pdf")) == len(result.pages)
+
+
+def get_template_xrefs(page):
+    from remarks.conversion.templates import TEMPLATE_XOBJECT_PREFIX
+
+    return set(
+        xref for xref, name, _, _ in page.get_xobjects() if name.startswith(TEMPLATE_XOBJECT_PREFIX)
+    )
+
+
+def test_templates_are_drawn_once_and_shown_on_every_page():
+    from remarks.conversion.templates import parse_template_name
+
+    assert parse_template_name("P Lines medium") == ("lines", 70, False)
+    assert parse_template_name("LS Grid small") == ("grid", 52, True)
+    assert parse_template_name("Blank") is None
+
+    metadata_path = pathlib.Path("tests/in/v2_notebook_complex/bce041cf-ce31-4ede-ad11-2e53db0f6c77.metadata")
+    shown = {}
+    for templates in [True, False]:
+        result = remarks.process_document_to_memory(
+            metadata_path,
+            "notebook",
+            ann_type=['scribbles', 'highlights'],
+            combined_pdf=True,
+            templates=templates,
+        )
+        combined_pdf = fitz.open(stream=result.combined_pdf, filetype="pdf")
+        shown[templates] = [get_template_xrefs(page) for page in combined_pdf]
+
+    # Every page of this notebook is "P Dots large", annotated or not, and
+    # they all show the very same XObject
+    [template_xrefs] = set(frozenset(xrefs) for xrefs in shown[True])
+    assert len(shown[True]) == 3 and len(template_xrefs) == 1
+    assert shown[False] == [set(), set(), set()]
+
+
+def test_templates_are_shared_across_chunks_and_flushes():
+    args = {
+        'ann_type': ['scribbles', 'highlights'],
+        'combined_pdf': False,
+        'combined_md': False,
+        'modified_pdf': True,
+    }
+    for out_dir, kwargs in [("tests/out/templates_chunks", {"chunk_size": 1}), ("tests/out/templates_flushes", {"max_memory_mb": 1})]:
+        os.makedirs(out_dir, exist_ok=True)
+        remarks.run_remarks("tests/in/v2_notebook_complex", out_dir, **args, **kwargs)
+
+        [out_path] = pathlib.Path(out_dir).rglob("* _remarks-only.pdf")
+        with fitz.open(out_path) as doc:
+            shown = [get_template_xrefs(page) for page in doc]
+            [[template_xref]] = set(frozenset(xrefs) for xrefs in shown)
+            # Leaving annotations aside, whose appearances are Form XObjects too
+            copies = [
+                xref for xref in range(1, doc.xref_length())
+                if doc.xref_is_stream(xref) and doc.xref_stream(xref) == doc.xref_stream(template_xref)
+            ]
+
+        # Every page was written out on its own, and yet they all show the
+        # same and only copy of the template
+        assert len(shown) == 3
+        assert copies == [template_xref]
+
+
+def test_combined_and_modified_pdfs_get_the_same_annotations():
+    result = remarks.process_document_to_memory(
+        pathlib.Path("demo/on-computable-numbers/xochitl/d3954b55-8429-4220-a2d5-64f1daab9727.metadata"),
+        "pdf",
+        ann_type=['scribbles', 'highlights'],
+        combined_pdf=True,
+        modified_pdf=True,
+        per_page_targets=['md'],
+    )
+    combined_pdf = fitz.open(stream=result.combined_pdf, filetype="pdf")
+    modified_pdf = fitz.open(stream=result.modified_pdf, filetype="pdf")
+
+    def annots(page):
+        return sorted((a.type[1], tuple(round(c, 1) for c in a.rect)) for a in page.annots())
+
+    assert len(result.pages) == len(modified_pdf)
+    for page, modified_page in zip(result.pages, modified_pdf):
+        assert annots(combined_pdf[page.idx]) == annots(modified_page)
+
+
+def test_smart_highlights_are_planned_once_for_every_page():
+    from remarks.conversion.drawing import prepare_smart_highlight_plan, apply_annotation_plan
+
+    doc = fitz.open()
+    for _ in range(2):
+        doc.new_page().insert_text((72, 72), "On computable numbers, with an application")
+
+    hl_data = {"highlights": [[
+        # No "color": older files don't have it, these are yellow
+        {"text": "computable numbers", "rects": [{"x": 0, "y": 0, "width": 1, "height": 1}]},
+        # Not on the page, placed after its rects
+        {"text": "Entscheidungsproblem", "color": 4, "rects": [{"x": 100, "y": 200, "width": 50, "height": 10}]},
+    ]]}
+
+    plan = prepare_smart_highlight_plan(hl_data, doc[0], 1)
+    for page in doc:
+        apply_annotation_plan(plan, page)
+
+    for page in doc:
+        [found, not_found] = page.annots()
+        assert tuple(found.colors["stroke"]) == fitz.utils.getColor("yellow")
+        assert found.rect.intersects(doc[0].search_for("computable numbers")[0])
+        assert tuple(not_found.colors["stroke"]) == fitz.utils.getColor("green")
+        assert not_found.rect.contains(fitz.Rect(100, 200, 150, 210))
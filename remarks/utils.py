@@ -1,19 +1,64 @@
+import filecmp
+import hashlib
+import inspect
 import json
+import logging
+import os
 import pathlib
-from functools import cache
+import re
+import time
+from functools import lru_cache
+
+from .archive import ArchivePath
+from .lazy import lazy_import
+
+fitz = lazy_import("fitz")  # PyMuPDF
 
 
 # reMarkable's device dimensions
 RM_WIDTH = 1404
 RM_HEIGHT = 1872
 
-
-@cache
+# How every output PDF gets written. `fast` is PyMuPDF's own defaults, while
+# the others trade some saving time for smaller files. See:
+# - https://pymupdf.readthedocs.io/en/latest/document.html#Document.save
+# - https://pymupdf.readthedocs.io/en/latest/document.html#Document.subset_fonts
+SAVE_PROFILES = {
+    "fast": {
+        "subset_fonts": False,
+        "options": {},
+    },
+    "compact": {
+        "subset_fonts": False,
+        "options": {
+            "garbage": 3,
+            "deflate": True,
+            "use_objstms": True,
+        },
+    },
+    "archive": {
+        "subset_fonts": True,
+        "options": {
+            "garbage": 4,
+            "clean": True,
+            "deflate": True,
+            "deflate_images": True,
+            "deflate_fonts": True,
+            "use_objstms": True,
+        },
+    },
+}
+
+
+# Bounded, so that long-running processes (e.g. `remarks watch`) don't hold on
+# to the metadata of whole libraries. Use `build_collection_index` when many
+# documents are involved
+@lru_cache(maxsize=1024)
 def read_meta_file(path, suffix=".metadata"):
     file = path.with_name(f"{path.stem}{suffix}")
     if not file.exists():
         return None
-    data = json.loads(open(file).read())
+    data = json.loads(file.read_text())
     return data
 
 
@@ -66,8 +111,16 @@ def get_pages_data(path):
     return content["pages"], []
 
 
+def get_page_templates(path):
+    # One template name per line, in the same order as pages in .content
+    pagedata_path = path.with_name(f"{path.stem}.pagedata")
+    if not pagedata_path.exists():
+        return []
+    return read_file_bytes(pagedata_path).decode("utf-8").splitlines()
+
+
 def list_ann_rm_files(path):
-    content_dir = pathlib.Path(f"{path.parents[0]}/{path.stem}/")
+    content_dir = path.with_name(path.stem)
     # print("content_dir", content_dir, not content_dir.is_dir())
     if not content_dir.is_dir():
         return []
@@ -75,7 +128,7 @@ def list_ann_rm_files(path):
 
 
 def list_hl_json_files(path):
-    hl_dir = pathlib.Path(f"{path.parents[0]}/{path.stem}.highlights/")
+    hl_dir = path.with_name(f"{path.stem}.highlights")
     # print("hl_dir", hl_dir, not hl_dir.is_dir())
     if not hl_dir.is_dir():
         return []
@@ -83,11 +136,24 @@ def list_hl_json_files(path):
 
 
 def load_json_file(path):
-    with open(path) as f:
-        data = json.load(f)
+    data = json.loads(read_file_bytes(path))
     return data
 
 
+# Paths may point to files on disk (`pathlib.Path` or str) or to files within
+# a tar/zip archive (`ArchivePath`), read everything through these two
+def read_file_bytes(path):
+    if isinstance(path, str):
+        path = pathlib.Path(path)
+    return path.read_bytes()
+
+
+def open_pdf(path):
+    if isinstance(path, ArchivePath):
+        return fitz.open(stream=path.read_bytes(), filetype="pdf")
+    return fitz.open(path)
+
+
 def prepare_subdir(base_dir, fmt):
     fmt_dir = pathlib.Path(f"{base_dir}/{fmt}/")
     fmt_dir.mkdir(parents=True, exist_ok=True)
@@ -118,3 +184,171 @@ def rescale_given_device_aspect_ratio(page_dims):
         page_height_rescaled = RM_HEIGHT * scale
 
     return (page_width_rescaled, page_height_rescaled), scale
+
+
+def prepare_pdf_for_saving(doc, save_profile="compact"):
+    profile = SAVE_PROFILES[save_profile]
+
+    if profile["subset_fonts"]:
+        try:
+            doc.subset_fonts()
+        except Exception as e:
+            logging.debug(f"- Couldn't subset fonts, will save them as is: {e}")
+
+    # Keep the file identifier (/ID) as it is instead of making up a new
+    # random one on every save, so that saving the same content twice gives
+    # the very same bytes
+    options = dict(profile["options"], no_new_id=True)
+
+    # Older PyMuPDF versions don't know about some of these options (e.g.
+    # `use_objstms` was introduced in 1.22), just leave those out
+    supported_options = inspect.signature(doc.save).parameters
+    return dict((k, v) for k, v in options.items() if k in supported_options)
+
+
+def set_stable_pdf_id(doc, path):
+    # Documents created from scratch have no /ID at all, give them one that
+    # stays the same from one run to the next (derived from the file name)
+    # - https://opensource.adobe.com/dc-acrobat-sdk-docs/pdfstandards/PDF32000_2008.pdf#page=45
+    if doc.xref_get_key(-1, "ID")[0] != "null":
+        return
+
+    file_id = hashlib.md5(pathlib.Path(path).name.encode()).hexdigest().upper()
+    doc.xref_set_key(-1, "ID", f"[<{file_id}><{file_id}>]")
+
+
+def save_pdf(doc, path, save_profile="compact"):
+    """Save `doc` to `path`, leaving `path` untouched if it already holds
+    the very same bytes (see `replace_if_changed`)."""
+
+    tmp_path = f"{path}.tmp"
+    saved = save_pdf_to(doc, tmp_path, save_profile, id_path=path)
+    replace_if_changed(tmp_path, path)
+    return saved
+
+
+def save_pdf_to(doc, path, save_profile="compact", id_path=None):
+    start = time.perf_counter()
+
+    options = prepare_pdf_for_saving(doc, save_profile)
+    set_stable_pdf_id(doc, id_path or path)
+    doc.save(path, **options)
+
+    size = os.path.getsize(path)
+    secs = time.perf_counter() - start
+    logging.debug(f'- Saved "{path}" ({format_size(size)} in {secs:.2f}s)')
+
+    return size, secs
+
+
+# Output files written, left untouched (their content didn't change) and
+# deleted (they're not part of the outputs anymore), see `get_write_stats`
+_write_stats = {"written": 0, "unchanged": 0, "deleted": 0}
+
+
+def get_write_stats():
+    return dict(_write_stats)
+
+
+def format_write_stats(before, after=None):
+    after = after or get_write_stats()
+    return ", ".join(f"{after[k] - before[k]} {k}" for k in _write_stats)
+
+
+def replace_if_changed(tmp_path, path):
+    """Move `tmp_path` over `path`, unless `path` already has the same
+    content: then it's left alone (same mtime, nothing for sync tools or
+    backups to pick up) and `tmp_path` is removed. Return True if `path` was
+    written."""
+
+    if os.path.exists(path) and filecmp.cmp(tmp_path, path, shallow=False):
+        os.remove(tmp_path)
+        _write_stats["unchanged"] += 1
+        return False
+
+    os.replace(tmp_path, path)
+    _write_stats["written"] += 1
+    return True
+
+
+def write_file(path, data):
+    """Write `data` (str or bytes) to `path`, unless it already holds
+    exactly that. Return True if `path` was written."""
+
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        with open(path, "rb") as f:
+            if f.read() == data:
+                _write_stats["unchanged"] += 1
+                return False
+
+    # Written aside and then moved in place, so that readers never get to
+    # see a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    _write_stats["written"] += 1
+    return True
+
+
+def delete_file(path):
+    if not os.path.exists(path):
+        return False
+
+    os.remove(path)
+    _write_stats["deleted"] += 1
+    return True
+
+
+def pdf_to_bytes(doc, save_profile="compact"):
+    options = prepare_pdf_for_saving(doc, save_profile)
+    return doc.tobytes(**options)
+
+
+# Indirect references within a PDF object's source, e.g. "12 0 R"
+PDF_REF_PATTERN = re.compile(r"\b(\d+) \d+ R\b")
+
+
+def get_shared_size(doc, xref, object_sizes):
+    """Size in bytes of the objects reachable from `xref` that were already
+    reachable from the `xref` of an earlier call, i.e. how much a document
+    of its own would have had to copy over once more. `object_sizes` keeps
+    track of every object seen so far (and its size) across calls."""
+
+    shared_size = 0
+    visited = set([xref])
+    # (xref, whether it was seen before, or is part of something that was)
+    stack = [(xref, False)]
+
+    while len(stack) > 0:
+        parent, parent_shared = stack.pop()
+
+        for ref in PDF_REF_PATTERN.findall(doc.xref_object(parent, compressed=True)):
+            ref = int(ref)
+            if ref in visited or ref <= 0 or ref >= doc.xref_length():
+                continue
+            visited.add(ref)
+
+            is_shared = parent_shared or ref in object_sizes
+            if ref not in object_sizes:
+                size = len(doc.xref_object(ref, compressed=True))
+                if doc.xref_is_stream(ref):
+                    size += len(doc.xref_stream_raw(ref))
+                object_sizes[ref] = size
+
+            if is_shared:
+                shared_size += object_sizes[ref]
+            stack.append((ref, is_shared))
+
+    return shared_size
+
+
+def format_size(num_bytes):
+    for unit in ["B", "KB", "MB"]:
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}" if unit != "B" else f"{num_bytes} B"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
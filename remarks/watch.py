@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import pathlib
+import time
+
+from .collection import build_collection_index, filter_collection_index
+from .index import prune_index
+from .remarks import run_remarks, run_document
+from .utils import read_meta_file
+
+# Only these files feed into remarks' outputs, everything else that gets
+# synced (thumbnails, caches, textconversion, etc) is ignored
+WATCHED_SUFFIXES = [".metadata", ".content", ".pagedata", ".pdf", ".epub", ".rm", ".json"]
+
+
+def get_doc_uuid(input_dir, path):
+    # Every file of a document is either named after its uuid or lives in a
+    # directory named after it, e.g.: <uuid>.metadata, <uuid>/<page>.rm or
+    # <uuid>.highlights/<page>.json
+    rel_path = pathlib.Path(path).relative_to(input_dir)
+    return rel_path.parts[0].split(".")[0]
+
+
+def take_snapshot(input_dir):
+    # Map every relevant file to its (mtime, size). Files are at most one
+    # level deep, so a couple of `scandir` passes are all we need
+    snapshot = {}
+
+    def add_entry(entry):
+        # Skip hidden files, which is how rsync names its temporary files
+        if entry.name.startswith(".") or not entry.is_file():
+            return
+        if os.path.splitext(entry.name)[1] not in WATCHED_SUFFIXES:
+            return
+        st = entry.stat()
+        snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            if entry.is_dir() and not entry.name.startswith("."):
+                with os.scandir(entry.path) as sub_it:
+                    for sub_entry in sub_it:
+                        add_entry(sub_entry)
+            else:
+                add_entry(entry)
+
+    return snapshot
+
+
+def diff_snapshots(prev_snapshot, snapshot):
+    return set(
+        path
+        for path in set(prev_snapshot) | set(snapshot)
+        if prev_snapshot.get(path) != snapshot.get(path)
+    )
+
+
+def is_document_ready(metadata_path):
+    # A document whose .metadata or .content are still being written can't
+    # be parsed, try it again on the next round. Deleted ones are "ready" to
+    # be dropped from the queue
+    if not metadata_path.exists():
+        return True
+
+    for suffix in [".metadata", ".content"]:
+        try:
+            with open(metadata_path.with_suffix(suffix)) as f:
+                json.load(f)
+        except (OSError, ValueError):
+            return False
+    return True
+
+
+def open_inotify():
+    # inotify is optional: it only lets us wake up as soon as something gets
+    # synced (instead of at the next poll), snapshots are still the source
+    # of truth on what has changed
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return None, None
+
+    watch_flags = (
+        flags.CREATE
+        | flags.CLOSE_WRITE
+        | flags.MOVED_TO
+        | flags.MOVED_FROM
+        | flags.DELETE
+    )
+    return INotify(), watch_flags
+
+
+def add_inotify_watches(inotify, watch_flags, watched_dirs, input_dir, snapshot):
+    dirs = set([str(input_dir)] + [os.path.dirname(path) for path in snapshot])
+
+    for d in dirs - watched_dirs:
+        try:
+            inotify.add_watch(d, watch_flags)
+            watched_dirs.add(d)
+        except OSError:
+            pass
+
+
+def wait_for_changes(inotify, timeout):
+    if inotify is None:
+        time.sleep(timeout)
+    else:
+        inotify.read(timeout=int(timeout * 1000))
+
+
+def run_watch(
+    input_dir,
+    output_dir,
+    poll_interval=5,
+    debounce=10,
+    max_rounds=None,
+    file_name=None,
+    file_uuid=None,
+    file_path=None,
+    **kwargs,
+):
+    input_dir = pathlib.Path(input_dir)
+
+    stats = {
+        "queue_depth": 0,
+        "processed": 0,
+        "failed": 0,
+        "last_latency": None,
+        "last_processed": None,
+    }
+
+    # Catch up with whatever changed while we weren't watching
+    snapshot = take_snapshot(input_dir)
+    run_remarks(
+        input_dir,
+        output_dir,
+        file_name=file_name,
+        file_uuid=file_uuid,
+        file_path=file_path,
+        **kwargs,
+    )
+
+    inotify, watch_flags = open_inotify()
+    watched_dirs = set()
+    mode = "polling" if inotify is None else "inotify"
+    logging.info(
+        f'\nWatching "{input_dir}" ({mode}, every {poll_interval}s, debounce of {debounce}s)'
+    )
+
+    # Documents that changed, mapped to the last time we saw them changing
+    pending = {}
+    rounds = 0
+
+    try:
+        while max_rounds is None or rounds < max_rounds:
+            rounds += 1
+
+            if inotify is not None:
+                add_inotify_watches(
+                    inotify, watch_flags, watched_dirs, input_dir, snapshot
+                )
+            wait_for_changes(inotify, poll_interval)
+
+            new_snapshot = take_snapshot(input_dir)
+            now = time.monotonic()
+
+            for path in diff_snapshots(snapshot, new_snapshot):
+                doc_uuid = get_doc_uuid(input_dir, path)
+                if file_uuid is None or doc_uuid == file_uuid:
+                    pending[doc_uuid] = now
+
+            snapshot = new_snapshot
+            stats["queue_depth"] = len(pending)
+
+            # An rsync run writes a document in many small steps, wait for it
+            # to settle down before touching it
+            ready = sorted(
+                doc_uuid for doc_uuid, t in pending.items() if now - t >= debounce
+            )
+            if len(ready) == 0:
+                continue
+
+            # Previous reads may be stale by now
+            read_meta_file.cache_clear()
+
+            for doc_uuid in list(ready):
+                if not is_document_ready(input_dir / f"{doc_uuid}.metadata"):
+                    pending[doc_uuid] = now
+                    ready.remove(doc_uuid)
+
+            if len(ready) == 0:
+                continue
+
+            # Folders may have been renamed or moved around as well, so
+            # rebuild the whole index (which is cheap) rather than patch it
+            index = build_collection_index(input_dir)
+            docs = filter_collection_index(index, file_name, file_uuid, file_path)
+            docs_by_uuid = dict((doc["uuid"], doc) for doc in docs)
+
+            for doc_uuid in ready:
+                del pending[doc_uuid]
+                stats["queue_depth"] = len(pending)
+
+                if doc_uuid not in docs_by_uuid:
+                    logging.debug(f"- Skipping {doc_uuid}: gone or filtered out")
+                    if kwargs.get("index_db") is not None:
+                        prune_index(kwargs["index_db"], [doc["uuid"] for doc in index])
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    run_document(docs_by_uuid[doc_uuid], output_dir, **kwargs)
+                    stats["processed"] += 1
+                except Exception as e:
+                    # Keep on watching, a later sync may fix whatever is wrong
+                    logging.error(f"- Failed to process document {doc_uuid}: {e}")
+                    stats["failed"] += 1
+
+                stats["last_latency"] = time.perf_counter() - start
+                stats["last_processed"] = doc_uuid
+
+                logging.info(
+                    f"- Took {stats['last_latency']:.2f}s (queue depth: {stats['queue_depth']}, processed: {stats['processed']}, failed: {stats['failed']})"
+                )
+
+    except KeyboardInterrupt:
+        logging.info(f'\nStopped watching "{input_dir}"')
+
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+    return stats